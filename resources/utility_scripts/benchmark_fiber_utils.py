@@ -0,0 +1,114 @@
+"""
+Benchmark the streamline transformations of tractseg.libs.fiber_utils (which work on one ArraySequence) against
+looping over the streamlines (the way they were implemented before). Also checks that the results are the same.
+
+Arguments:
+    nr_streamlines (optional, default: 100000)
+    trk_file (optional, benchmark on this tractogram instead of random streamlines)
+
+Example:
+    python benchmark_fiber_utils.py 100000
+"""
+
+import sys
+import time
+
+import numpy as np
+import nibabel as nib
+try:
+    from dipy.segment.featurespeed import ResampleFeature
+except ImportError:  # old dipy versions
+    from dipy.segment.metric import ResampleFeature
+from dipy.tracking.metrics import spline
+from dipy.tracking.streamline import Streamlines
+
+from tractseg.libs import fiber_utils
+
+
+def add_to_each_streamline_loop(streamlines, scalar):
+    return [np.array(sl) + scalar for sl in streamlines]
+
+
+def add_to_each_streamline_axis_loop(streamlines, scalar, axis="x"):
+    sl_new = []
+    for sl in streamlines:
+        s = np.array(sl)
+        s[:, "xyz".index(axis)] += scalar
+        sl_new.append(s)
+    return sl_new
+
+
+def flip_loop(streamlines, axis="x"):
+    new_sl = []
+    for sl in streamlines:
+        tmp = np.copy(sl)
+        tmp[:, "xyz".index(axis)] *= -1
+        new_sl.append(tmp)
+    return new_sl
+
+
+def invert_streamlines_loop(streamlines, reference_img, affine, axis="x"):
+    img_center_mm_space = fiber_utils.transform_point((np.array(reference_img.shape) - 1) / 2., affine)
+    affine_invert = np.eye(4)
+    affine_invert["xyz".index(axis), "xyz".index(axis)] = -1
+    affine_invert["xyz".index(axis), 3] = img_center_mm_space[1] * 2
+    return [nib.affines.apply_affine(affine_invert, sl) for sl in streamlines]
+
+
+def resample_fibers_loop(streamlines, nb_points=12):
+    feature = ResampleFeature(nb_points=nb_points)
+    return [feature.extract(sl) for sl in streamlines]
+
+
+def smooth_streamlines_loop(streamlines, smoothing_factor=10):
+    return [spline(sl, s=smoothing_factor) for sl in streamlines]
+
+
+def random_streamlines(nr_streamlines, seed=0):
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(20, 200, nr_streamlines)
+    steps = rng.normal(0, 0.3, (lengths.sum(), 3)) + [0.5, 0, 0]
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.cumsum(steps, axis=0)
+    points -= np.repeat(points[offsets], lengths, axis=0) - rng.uniform(10, 100, (nr_streamlines, 3)).repeat(lengths, 0)
+    return Streamlines(np.split(points.astype(np.float32), np.cumsum(lengths)[:-1]))
+
+
+def benchmark(name, func_loop, func_new, streamlines, *args, **kwargs):
+    start = time.time()
+    res_loop = func_loop(streamlines, *args, **kwargs)
+    time_loop = time.time() - start
+    start = time.time()
+    res_new = func_new(streamlines, *args, **kwargs)
+    time_new = time.time() - start
+    same = len(res_loop) == len(res_new) and all(np.allclose(a, b, atol=1e-4) for a, b in zip(res_loop, res_new))
+    print("{:<30} loop: {:7.2f}s   ArraySequence: {:7.2f}s   speedup: {:6.1f}x   same result: {}".format(
+        name, time_loop, time_new, time_loop / max(time_new, 1e-6), same))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    nr_streamlines = int(args[0]) if len(args) > 0 else 100000
+    if len(args) > 1:
+        streamlines = nib.streamlines.load(args[1]).streamlines
+    else:
+        streamlines = random_streamlines(nr_streamlines)
+    print("Number of streamlines: {}, number of points: {}".format(len(streamlines), len(streamlines._data)))
+
+    affine = np.array([[-1.25, 0., 0., 90.],
+                       [0., 1.25, 0., -126.],
+                       [0., 0., 1.25, -72.],
+                       [0., 0., 0., 1.]])
+    reference_img = np.zeros((145, 174, 145))
+
+    benchmark("add_to_each_streamline", add_to_each_streamline_loop, fiber_utils.add_to_each_streamline,
+              streamlines, -0.5)
+    benchmark("add_to_each_streamline_axis", add_to_each_streamline_axis_loop,
+              fiber_utils.add_to_each_streamline_axis, streamlines, 0.5, axis="y")
+    benchmark("flip", flip_loop, fiber_utils.flip, streamlines, axis="z")
+    benchmark("invert_streamlines", invert_streamlines_loop, fiber_utils.invert_streamlines, streamlines,
+              reference_img, affine, axis="x")
+    benchmark("resample_fibers", resample_fibers_loop, fiber_utils.resample_fibers, streamlines, nb_points=100)
+    nr_smooth = min(len(streamlines), 10000)  # spline fitting is slow
+    benchmark("smooth_streamlines ({})".format(nr_smooth), smooth_streamlines_loop, fiber_utils.smooth_streamlines,
+              streamlines[:nr_smooth], smoothing_factor=5)
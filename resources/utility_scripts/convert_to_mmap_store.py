@@ -0,0 +1,39 @@
+"""
+Convert a training dataset (one folder per subject containing .nii.gz files) to the uncompressed memory-mapped store
+of tractseg.data.mmap_store. Afterwards set Config.TRAINING_DATA_FORMAT = "mmap" (and Config.DATASET_FOLDER to the
+output folder if it is different from the input folder).
+
+Arguments:
+    dataset_dir
+    out_dir (can be the same as dataset_dir)
+    --filenames (optional, default: all .nii.gz files of each subject)
+    --axes (optional, slice directions for which to store a copy with contiguous slices, default: xyz)
+    --nr_cpus (optional, default: -1)
+
+Example:
+    python convert_to_mmap_store.py HCP_preproc HCP_preproc --filenames 12g_125mm_peaks 90g_125mm_peaks
+        270g_125mm_peaks bundle_masks_72
+"""
+
+import os
+import argparse
+
+from joblib import Parallel, delayed
+
+from tractseg.data import mmap_store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert training data to uncompressed memory-mapped arrays.")
+    parser.add_argument("dataset_dir")
+    parser.add_argument("out_dir")
+    parser.add_argument("--filenames", nargs="+", default=None)
+    parser.add_argument("--axes", default="xyz")
+    parser.add_argument("--nr_cpus", type=int, default=-1)
+    args = parser.parse_args()
+
+    subjects = sorted(s for s in os.listdir(args.dataset_dir) if os.path.isdir(os.path.join(args.dataset_dir, s)))
+    print("Number of subjects: {}".format(len(subjects)))
+    Parallel(n_jobs=args.nr_cpus)(delayed(mmap_store.convert_subject)(args.dataset_dir, args.out_dir, subject,
+                                                                      filenames=args.filenames, axes=args.axes)
+                                  for subject in subjects)
@@ -4,8 +4,10 @@ from __future__ import division
 from __future__ import print_function
 
 import unittest
+import numpy as np
 
 from tractseg.data import dataset_specific_utils
+from tractseg.libs import exp_utils
 
 
 class test_functions(unittest.TestCase):
@@ -17,5 +19,438 @@ class test_functions(unittest.TestCase):
         bundles = dataset_specific_utils.get_bundle_names("CST_right")
         self.assertListEqual(bundles, ["BG", "CST_right"], "Error in list of bundle names")
 
+    def test_fused_direction_merging(self):
+        from tractseg.libs import direction_merger
+        from tractseg.experiments.pretrained_models.TractSeg_PeakRot4 import Config
+
+        class DummyModel:
+            def predict(self, x):
+                x = np.asarray(x)[:, :4].transpose(0, 2, 3, 1)  # (bs, x, y, nr_classes)
+                return (1 / (1 + np.exp(-x))).astype(np.float32)
+
+        Config = exp_utils.get_correct_labels_type(Config())
+        Config.INPUT_DIM = (16, 16)
+        Config.NR_OF_CLASSES = 4
+        Config.VERBOSE = False
+        data = np.random.RandomState(0).randn(16, 16, 16, 9).astype(np.float32)
+
+        probs_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config, DummyModel(), data=data,
+                                                                         scale_to_world_shape=False,
+                                                                         only_prediction=True, batch_size=5)
+        for probs in [True, False]:
+            seg_ref = direction_merger.mean_fusion(Config.THRESHOLD, probs_xyz.copy(), probs=probs)
+            seg_new, _ = direction_merger.get_seg_single_img_3_directions_fused(Config, DummyModel(), data=data,
+                                                                               only_prediction=True, batch_size=5,
+                                                                               fusion="mean", probs=probs)
+            self.assertTrue(np.array_equal(seg_ref, seg_new), "Fused mean fusion not correct")
+
+        seg_ref = direction_merger.majority_fusion(Config.THRESHOLD, probs_xyz.copy())
+        seg_new, _ = direction_merger.get_seg_single_img_3_directions_fused(Config, DummyModel(), data=data,
+                                                                           only_prediction=True, batch_size=5,
+                                                                           fusion="majority")
+        self.assertTrue(np.array_equal(seg_ref, seg_new), "Fused majority fusion not correct")
+
+    def test_tensors_to_peaks(self):
+        from tractseg.libs import peak_utils
+
+        rng = np.random.RandomState(0)
+        peaks = rng.randn(6, 5, 4, 2 * 3).astype(np.float32)
+        peaks[0] = 0
+        tensors = peak_utils.peaks_to_tensors(peaks)
+        tensors = (tensors + peak_utils.peaks_to_tensors(peaks * (1 + 0.1 * rng.randn(*peaks.shape)))) / 2.
+
+        # Reference: np.linalg.eig per voxel
+        peaks_ref = np.zeros(peaks.shape, dtype=np.float32)
+        for idx in np.ndindex(*peaks.shape[:3]):
+            for b in range(2):
+                val, vec = np.linalg.eig(peak_utils.flat_tensor_to_matrix_tensor(tensors[idx][b * 6:b * 6 + 6]))
+                peaks_ref[idx][b * 3:b * 3 + 3] = vec[:, val.argmax()] * val.max()
+
+        peaks_new = peak_utils.tensors_to_peaks(tensors, chunk_size=7)
+        sign = np.where(np.sum((peaks_ref * peaks_new).reshape(-1, 3), axis=-1) < 0, -1, 1)
+        peaks_new = (peaks_new.reshape(-1, 3) * sign[:, None]).reshape(peaks.shape)  # sign of eigenvector arbitrary
+        self.assertTrue(np.allclose(peaks_ref, peaks_new, atol=1e-5), "tensors_to_peaks not correct")
+        self.assertTrue(np.all(peaks_new[0] == 0), "Zero tensors must result in zero peaks")
+
+    def test_crop_pad_and_scale_img_to_square_img(self):
+        from scipy import ndimage
+        from tractseg.libs import data_utils
+
+        data = np.zeros((30, 37, 33, 3), dtype=np.float32)
+        data[2:27, 4:35, 1:30] = np.random.RandomState(0).rand(25, 31, 29, 3)
+
+        # Reference: crop, pad with zeros and zoom each channel
+        cropped = data[2:27, 4:35, 1:30]
+        padded = np.zeros((31, 31, 31, 3), dtype=np.float32)
+        padded[3:28, :, 1:30] = cropped
+        ref = np.array([ndimage.zoom(padded[..., c], 144 / 31., order=0) for c in range(3)]).transpose(1, 2, 3, 0)
+
+        img, bbox, original_shape, t = data_utils.crop_pad_and_scale_img_to_square_img(data, target_size=144)
+        self.assertTrue(np.array_equal(img, ref), "Fused crop, pad and scale not correct")
+        self.assertListEqual(bbox, [[2, 27], [4, 35], [1, 30]])
+        self.assertEqual(original_shape, data.shape)
+        self.assertEqual((t["pad_x"], t["pad_y"], t["pad_z"]), (3., 0., 1.))
+
+        # zoom=1 -> transforming back has to give the original image
+        img, bbox, original_shape, t = data_utils.crop_pad_and_scale_img_to_square_img(data, target_size=31)
+        img_back = data_utils.cut_scale_and_pad_img_back_to_original_img(img, t, bbox, original_shape)
+        self.assertTrue(np.array_equal(img_back, data), "Transforming back to original image not correct")
+
+    def test_process_seedpoints(self):
+        from tractseg.libs import tractseg_prob_tracking
+
+        # Straight bundle along x axis
+        bundle_mask = np.zeros((50, 10, 10), dtype=np.uint8)
+        bundle_mask[5:45, 3:7, 3:7] = 1
+        peaks = np.zeros((50, 10, 10, 3), dtype=np.float32)
+        peaks[bundle_mask == 1] = [1, 0, 0]
+        start_mask = np.zeros_like(bundle_mask)
+        start_mask[5:8] = bundle_mask[5:8]
+        end_mask = np.zeros_like(bundle_mask)
+        end_mask[42:45] = bundle_mask[42:45]
+
+        tractseg_prob_tracking._PEAKS = peaks
+        tractseg_prob_tracking._BUNDLE_MASK = bundle_mask
+        tractseg_prob_tracking._START_MASK = start_mask
+        tractseg_prob_tracking._END_MASK = end_mask
+        tractseg_prob_tracking._TRACKING_UNCERTAINTIES = None
+
+        seeds = np.array(np.where(bundle_mask == 1)).transpose()
+        streamlines = tractseg_prob_tracking.process_seedpoints(seeds, spacing=2, next_step_displacement_std=0.15,
+                                                                random_seed=0)
+        self.assertGreater(len(streamlines), len(seeds) / 5, "Too few streamlines")
+        for sl in streamlines:
+            self.assertTrue(sl[:, 0].min() < 8 and sl[:, 0].max() >= 42, "Streamline not connecting start and end")
+            self.assertTrue(np.all(bundle_mask[tuple(sl.astype(int).T)] == 1), "Streamline leaving bundle mask")
+
+        streamlines, accepted = tractseg_prob_tracking.process_seedpoints(seeds, spacing=2,
+                                                                          next_step_displacement_std=0.15,
+                                                                          random_seed=0, return_accepted=True)
+        self.assertEqual(accepted.sum(), len(streamlines))
+        probs = tractseg_prob_tracking.get_adaptive_seed_probabilities(np.ones(len(seeds)), accepted.astype(int))
+        self.assertAlmostEqual(probs.sum(), 1)
+        self.assertGreater(probs[accepted].min(), probs[~accepted].max(), "Productive voxels not preferred")
+
+    def test_adaptive_seeding(self):
+        from tractseg.libs import tractseg_prob_tracking
+
+        # Synthetic mask: acceptance rate 0 in 100 voxels, 2% in 50 voxels and 20% in 50 voxels. With uniform
+        # seeding the voxels with 2% contribute 0.02 / 0.22 = 9.1% of the streamlines.
+        acceptance_rates = np.array([0.] * 100 + [0.02] * 50 + [0.2] * 50)
+        mask_coords = np.stack([np.arange(len(acceptance_rates)), np.zeros(len(acceptance_rates)),
+                                np.zeros(len(acceptance_rates))], axis=1).astype(int)
+
+        class FakeResult:
+            def __init__(self, seeds, random_seed):
+                rates = acceptance_rates[seeds[:, 0]]
+                self.accepted = np.random.RandomState(random_seed).rand(len(seeds)) < rates
+                self.streamlines = [np.array([seed, seed]) for seed in seeds[self.accepted]]
+
+            def get(self):
+                return self.streamlines, self.accepted
+
+        class FakePool:
+            def apply_async(self, func, args):
+                return FakeResult(args[1], args[2])
+
+        def streamline_shares(adaptive_seeding):
+            np.random.seed(0)
+            nr_seeds_voxel = np.zeros(len(mask_coords), dtype=np.int64)
+            nr_accepted_voxel = np.zeros(len(mask_coords), dtype=np.int64)
+            weights_voxel = np.zeros(len(mask_coords))
+            nr_streamlines = 0
+            for streamlines, weights in tractseg_prob_tracking._track_batches(
+                    None, mask_coords, 20000, 1., 0.15, 1, FakePool(), adaptive_seeding, nr_seeds_voxel,
+                    nr_accepted_voxel, False):
+                np.add.at(weights_voxel, [sl[0, 0] for sl in streamlines], weights)
+                nr_streamlines += len(streamlines)
+            self.assertEqual(nr_streamlines, 20000)
+            return weights_voxel / weights_voxel.sum(), nr_seeds_voxel.sum()
+
+        shares_uniform, nr_seeds_uniform = streamline_shares(False)
+        shares_adaptive, nr_seeds_adaptive = streamline_shares(True)
+        self.assertAlmostEqual(shares_uniform[100:150].sum(), 0.091, delta=0.01)
+        self.assertAlmostEqual(shares_adaptive[100:150].sum(), shares_uniform[100:150].sum(), delta=0.015)
+        self.assertLess(nr_seeds_adaptive, 0.5 * nr_seeds_uniform)
+
+    def test_det_tracking(self):
+        from tractseg.libs import tractseg_det_tracking
+
+        # Straight bundle along x axis; x axis of image is flipped in coordinate space
+        affine = np.diag([-2., 2., 2., 1.])
+        bundle_mask = np.zeros((50, 10, 10), dtype=np.uint8)
+        bundle_mask[5:45, 3:7, 3:7] = 1
+        peaks = np.zeros((50, 10, 10, 3), dtype=np.float32)
+        peaks[bundle_mask == 1] = [1, 0, 0]
+        start_mask = np.zeros_like(bundle_mask)
+        start_mask[5:8] = bundle_mask[5:8]
+        end_mask = np.zeros_like(bundle_mask)
+        end_mask[42:45] = bundle_mask[42:45]
+
+        streamlines = tractseg_det_tracking.track(peaks, affine, max_nr_fibers=100, seed_mask=bundle_mask,
+                                                  mask=bundle_mask, include_masks=[start_mask, end_mask],
+                                                  random_seed=0)
+        self.assertEqual(len(streamlines), 100)
+        for sl in streamlines:
+            self.assertTrue(np.allclose(sl[:, 1:], sl[0, 1:]), "Streamline not following peaks")
+            x = sl[:, 0] / -2.  # voxel space
+            self.assertTrue(x.min() < 7.5 and x.max() >= 41.5, "Streamline not connecting start and end")
+
+        streamlines = tractseg_det_tracking.track(peaks, affine, max_nr_fibers=100, seed_mask=bundle_mask,
+                                                  min_length=90, max_nr_seeds=2000, random_seed=0)
+        self.assertEqual(len(streamlines), 0, "Streamlines shorter than min_length")
+
+    def test_streamline_transformations(self):
+        from dipy.tracking.streamline import Streamlines
+        from tractseg.libs import fiber_utils
+
+        rng = np.random.RandomState(0)
+        streamlines = [rng.rand(rng.randint(2, 20), 3) for _ in range(10)]
+        for sls in [streamlines, Streamlines(streamlines)[::2]]:
+            sls_ref = [np.copy(sl) for sl in sls]
+            sls_new = fiber_utils.flip(fiber_utils.add_to_each_streamline_axis(sls, 1, axis="y"), axis="z")
+            self.assertEqual(len(sls_new), len(sls_ref))
+            for sl, sl_ref in zip(sls_new, sls_ref):
+                self.assertTrue(np.allclose(sl, sl_ref * [1, 1, -1] + [0, 1, 0]), "Streamline transformation not correct")
+            self.assertTrue(all(np.array_equal(sl, sl_ref) for sl, sl_ref in zip(sls, sls_ref)),
+                            "Input streamlines were changed")
+        self.assertEqual(len(fiber_utils.add_to_each_streamline([], 0.5)), 0)
+        sls_int = [np.arange(12).reshape(4, 3), np.arange(6).reshape(2, 3)]
+        sls_new = fiber_utils.add_to_each_streamline(sls_int, 0.5)
+        self.assertTrue(all(np.array_equal(sl, sl_ref + 0.5) for sl, sl_ref in zip(sls_new, sls_int)))
+        self.assertEqual(np.array(fiber_utils.resample_fibers(streamlines, nb_points=5)).shape, (10, 5, 3))
+
+    def test_compress_streamlines(self):
+        from dipy.tracking.streamline import compress_streamlines
+        from tractseg.libs import fiber_utils
+
+        rng = np.random.RandomState(0)
+        streamlines = [np.cumsum(rng.normal(0, 0.3, (rng.randint(2, 100), 3)) + [0.5, 0, 0], axis=0)
+                       for _ in range(100)]
+        streamlines_ref = compress_streamlines(streamlines, tol_error=0.1)
+        streamlines_new = fiber_utils.compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=2)
+        self.assertEqual(len(streamlines_new), len(streamlines_ref))
+        for sl, sl_ref in zip(streamlines_new, streamlines_ref):
+            self.assertTrue(np.array_equal(sl, sl_ref), "Parallel compression not correct")
+
+    def test_aggregate_by_segment(self):
+        from tractseg.libs import tractometry
+
+        values = np.array([1., 2., 3., 4., 5., 6.])
+        segment_idxs = np.array([2, 0, 2, 0, 2, 3])
+        means, stds = tractometry._aggregate_by_segment(values, segment_idxs, fill_values={0: 9., 1: 7.})
+        self.assertEqual(means, [3., 7., 3., 6.])
+        self.assertEqual(stds, [np.std([2., 4.]), 0., np.std([1., 3., 5.]), 0.])
+
+    def test_tractometry_shared_segments(self):
+        from tractseg.libs import tractometry
+
+        rng = np.random.RandomState(0)
+        affine = np.array([[-2., 0, 0, 30], [0, 2, 0, -20], [0, 0, 2, -10], [0, 0, 0, 1]])
+        streamlines = []
+        for idx in range(20):
+            x = np.linspace(2, 17, rng.randint(10, 30))
+            sl = np.stack([x, 10 + rng.rand() + 0 * x, 10 + np.sin(x / 5) + rng.rand()], axis=1)
+            sl = sl[::-1] if idx % 2 else sl
+            streamlines.append(np.dot(sl, affine[:3, :3].T) + affine[:3, 3])
+        beginnings = np.zeros((20, 20, 20))
+        beginnings[:4, 8:14, 8:14] = 1
+        scalar_imgs = [rng.rand(20, 20, 20) for _ in range(2)]
+
+        segments = tractometry.get_segments(streamlines, beginnings, 10, dilate=1, affine=affine)
+        for scalar_img in scalar_imgs:
+            mean_ref, std_ref = tractometry.evaluate_along_streamlines(scalar_img, streamlines, beginnings, 10,
+                                                                       dilate=1, affine=affine)
+            mean, std = tractometry.evaluate_segments(scalar_img, segments, 10)
+            self.assertEqual(mean, mean_ref)
+            self.assertEqual(std, std_ref)
+
+    def test_vectorized_stats(self):
+        import scipy.stats
+        from tractseg.libs import metric_utils
+
+        rng = np.random.RandomState(0)
+        data = rng.rand(12, 20)
+        y_perm = np.array([rng.permutation(6) for _ in range(3)])
+        groups = np.array([rng.permutation(12) for _ in range(3)]) < 5
+        c, p_c = metric_utils.pearsonr_matrix(y_perm, data[:6])
+        t, p_t = metric_utils.ttest_ind_matrix(groups, data)
+        for i in range(3):
+            for j in range(20):
+                self.assertTrue(np.allclose([c[i, j], p_c[i, j]], scipy.stats.pearsonr(y_perm[i], data[:6, j])))
+                self.assertTrue(np.allclose([t[i, j], p_t[i, j]],
+                                            scipy.stats.ttest_ind(data[groups[i], j], data[~groups[i], j])))
+
+        # Confound regression with intercept for all columns at once
+        confound = np.stack([groups[0], rng.rand(12)], axis=1).astype(np.float64)
+        design = np.concatenate([np.ones((12, 1)), confound], axis=1)
+        coef = np.linalg.lstsq(design, data, rcond=None)[0]
+        self.assertTrue(np.allclose(metric_utils.unconfound(data, confound), data - np.dot(confound, coef[1:])))
+        self.assertTrue(np.allclose(metric_utils.unconfound(data, confound, group_data=True),
+                                    data - np.dot(confound[:, 1:], coef[2:])))
+
+    def test_multi_comp_correction(self):
+        from tractseg.libs import AFQ_MultiCompCorrection as mcc
+
+        significant = np.array([[0, 1, 1, 0, 1], [0, 0, 0, 0, 0], [1, 1, 1, 1, 1]], dtype=bool)
+        self.assertEqual(list(mcc._get_max_cluster_sizes(significant)), [3, 1, 6])
+
+        data = np.random.RandomState(0).rand(12, 20)
+        y = np.array([0] * 6 + [1] * 6)
+        results = [mcc.AFQ_MultiCompCorrection(data, y, nperm=100, random_seed=1)[:3] for _ in range(2)]
+        self.assertEqual(results[0], results[1])
+
+    def test_mmap_store(self):
+        import os
+        import shutil
+        import tempfile
+        import nibabel as nib
+        from tractseg.data import mmap_store
+        from tractseg.libs import data_utils
+
+        rng = np.random.RandomState(0)
+        data = rng.rand(6, 7, 8, 3)
+        seg = (rng.rand(6, 7, 8, 2) > 0.5).astype(np.float64)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for name, img in [("data", data), ("seg", seg)]:
+                nib.save(nib.Nifti1Image(img, np.eye(4)), os.path.join(tmp_dir, name + ".nii.gz"))
+                dtype = mmap_store.convert_nifti(os.path.join(tmp_dir, name + ".nii.gz"), os.path.join(tmp_dir, name))
+                self.assertEqual(dtype, np.float16 if name == "data" else np.uint8)
+            data_mm = mmap_store.MmapVolume(os.path.join(tmp_dir, "data"))
+            seg_mm = mmap_store.MmapVolume(os.path.join(tmp_dir, "seg"))
+            self.assertEqual(len(data_mm.axis_copies), 3)
+            self.assertTrue(np.array_equal(np.asarray(data_mm), data.astype(np.float16)))
+
+            slice_idxs = np.array([4, 1, 2])
+            for slice_direction in range(3):
+                x, y = data_utils.sample_slices(data_mm, seg_mm, slice_idxs, slice_direction=slice_direction)
+                x_ref, y_ref = data_utils.sample_slices(data.astype(np.float16), seg, slice_idxs,
+                                                        slice_direction=slice_direction)
+                self.assertTrue(np.array_equal(x, x_ref))
+                self.assertTrue(np.array_equal(y, y_ref))
+                self.assertTrue(np.array_equal(data_mm[(slice(None),) * slice_direction + (3,)],
+                                               np.take(data.astype(np.float16), 3, axis=slice_direction)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lru_volume_cache(self):
+        try:
+            from tractseg.data.data_loader_training import LRUVolumeCache
+        except ImportError:
+            self.skipTest("batchgenerators not installed")
+
+        loaded = []
+
+        def load_func(key, size):
+            def load():
+                loaded.append(key)
+                return np.zeros(size, dtype=np.uint8)
+            return load
+
+        cache = LRUVolumeCache(max_bytes=300)
+        for key in ["a", "b", "c", "a"]:
+            cache.get(key, load_func(key, 100))
+        self.assertEqual(loaded, ["a", "b", "c"])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # "b" is the least recently used volume -> evicted first
+        cache.get("d", load_func("d", 100))
+        self.assertEqual(list(cache.volumes.keys()), ["c", "a", "d"])
+        self.assertEqual(cache.nbytes, 300)
+
+        # evicts as many volumes as needed to stay within the byte budget
+        cache.get("e", load_func("e", 200))
+        self.assertEqual(list(cache.volumes.keys()), ["d", "e"])
+        self.assertEqual(cache.nbytes, 300)
+
+        # volume larger than budget is returned but not cached
+        volume = cache.get("f", load_func("f", 301))
+        self.assertEqual(volume.nbytes, 301)
+        self.assertFalse(volume.flags.writeable)
+        self.assertEqual(list(cache.volumes.keys()), ["d", "e"])
+        cache.get("f", load_func("f", 301))
+        self.assertEqual(loaded[-2:], ["f", "f"])
+
+    def test_subject_affinity_batches(self):
+        from unittest import mock
+        try:
+            from tractseg.data import data_loader_training
+        except ImportError:
+            self.skipTest("batchgenerators not installed")
+
+        class Config:
+            SUBJECT_AFFINITY_BATCHES = 3
+            SUBJECT_CACHE_MB = 0
+            NR_OF_GRADIENTS = 9
+            NR_SLICES = 1
+            TRAINING_SLICE_DIRECTION = "x"
+            LABELS_TYPE = np.int16
+            PAD_TO_SQUARE = False
+
+        loaded_subjects = []
+
+        def load_training_data(Config, subject, cache=None):
+            loaded_subjects.append(subject)
+            return np.zeros((16, 16, 16, 9), dtype=np.float32), np.zeros((16, 16, 16, 2), dtype=np.uint8)
+
+        subjects = ["s0", "s1", "s2"]
+        batch_gen = data_loader_training.BatchGenerator2D_Nifti_random((subjects, []), batch_size=2)
+        batch_gen.Config = Config
+        with mock.patch.object(data_loader_training, "load_training_data", side_effect=load_training_data), \
+                mock.patch.object(data_loader_training.random, "uniform", side_effect=[0, 1, 2]):
+            for _ in range(7):
+                batch = batch_gen.generate_train_batch()
+        self.assertEqual(loaded_subjects, ["s0"] * 3 + ["s1"] * 3 + ["s2"])
+        self.assertEqual(batch["data"].shape, (2, 9, 16, 16))
+
+    def test_sample_Xslices(self):
+        from tractseg.libs import data_utils
+
+        rng = np.random.RandomState(0)
+        data = rng.rand(7, 8, 9, 2)
+        seg = rng.rand(7, 8, 9, 3) > 0.5
+        data_pad = np.pad(data, ((2, 2), (2, 2), (2, 2), (0, 0)), mode="constant")
+        slice_idxs = np.array([0, 6, 3])
+        for slice_direction in range(3):
+            x, y = data_utils.sample_Xslices(data, seg, slice_idxs, slice_direction=slice_direction, slice_window=5)
+            # Reference: sample each slice of the window from the zero padded volume
+            x_ref = np.concatenate([data_utils.sample_slices(data_pad, data_pad, slice_idxs + offset,
+                                                             slice_direction=slice_direction)[0][:, :, 2:-2, 2:-2]
+                                    for offset in range(5)], axis=1)
+            y_ref = data_utils.sample_slices(data, seg, slice_idxs, slice_direction=slice_direction)[1]
+            self.assertTrue(np.array_equal(x, x_ref), "Multi-slice windows not correct")
+            self.assertTrue(np.array_equal(y, y_ref))
+
+    def test_auto_batch_size(self):
+        from unittest import mock
+        from tractseg.libs import pytorch_utils
+
+        class Config:
+            DIM = "2D"
+            INPUT_DIM = (144, 144)
+            UNET_NR_FILT = 64
+            NR_OF_CLASSES = 72
+            NR_OF_GRADIENTS = 9
+            DROPOUT_SAMPLING = False
+
+        mem_per_slice = pytorch_utils.estimate_inference_memory_per_slice(Config)
+        # Measured on CPU (bs=48: 30GB vs bs=1: 4.5GB): about 0.54GB per slice for this config
+        self.assertTrue(0.4e9 < mem_per_slice < 0.7e9)
+
+        for available_memory, batch_size in [(mem_per_slice * 20.5, 10), (mem_per_slice * 0.1, 1),
+                                             (mem_per_slice * 1000, 144)]:
+            with mock.patch.object(pytorch_utils, "get_available_memory", return_value=int(available_memory)):
+                self.assertEqual(pytorch_utils.get_auto_batch_size(Config, memory_fraction=0.5), batch_size)
+        Config.DIM = "3D"
+        self.assertEqual(pytorch_utils.get_auto_batch_size(Config), 1)
+
+        self.assertTrue(pytorch_utils.is_out_of_memory_error(MemoryError()))
+        self.assertTrue(pytorch_utils.is_out_of_memory_error(RuntimeError("CUDA out of memory. Tried to allocate")))
+        self.assertTrue(pytorch_utils.is_out_of_memory_error(
+            RuntimeError("DefaultCPUAllocator: can't allocate memory: you tried to allocate 123 bytes.")))
+        self.assertFalse(pytorch_utils.is_out_of_memory_error(RuntimeError("Expected memory format channels_last")))
+        self.assertFalse(pytorch_utils.is_out_of_memory_error(ValueError("out of memory")))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -5,6 +5,9 @@ from __future__ import print_function
 
 from os.path import join
 from builtins import object
+import time
+import threading
+from queue import Queue, Empty, Full
 import numpy as np
 
 from tractseg.libs.system_config import SystemConfig as C
@@ -110,6 +113,80 @@ class BatchGenerator3D_data_ordered_standalone(object):
         return data_dict
 
 
+class BackgroundBatchGenerator(object):
+    """
+    Runs a batch generator in a background thread. This way the next batches are prepared (slicing,
+    normalization, conversion to torch) while the network is predicting the current batch. At most queue_size
+    batches are prepared in advance, so the slices are never all in memory at the same time.
+
+    Call close() if not iterating until the end (e.g. if the prediction failed). Otherwise the background thread
+    blocks forever and keeps the prepared batches and the input data in memory.
+    """
+    _END = object()
+
+    def __init__(self, batch_generator, queue_size=2):
+        self.batch_generator = batch_generator
+        self.preparation_time = 0  # time the background thread spent on preparing batches
+        self._queue = Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """
+        Put item into the queue. Returns False if stopped by close() before there was space in the queue.
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                start_time = time.time()
+                try:
+                    batch = next(self.batch_generator)
+                except StopIteration:
+                    break
+                self.preparation_time += time.time() - start_time
+                if not self._put(batch):
+                    return
+        except Exception as e:
+            self._put(e)  # raise in main thread
+            return
+        self._put(self._END)
+
+    def close(self):
+        """
+        Stop the background thread and free the prepared batches.
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+        self._thread.join()
+        self.batch_generator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is self._END:
+            self._thread.join()
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
 class DataLoaderInference():
     """
     Data loader for only one subject and returning slices in ordered way.
@@ -159,17 +236,16 @@ class DataLoaderInference():
             else:
                 from tractseg.data.data_loader_training import load_training_data
                 data, seg = load_training_data(self.Config, self.subject)
+                data, seg = np.asarray(data), np.asarray(seg)
 
                 # Convert peaks to tensors if tensor model
                 if self.Config.NR_OF_GRADIENTS == 18 * self.Config.NR_SLICES:
                     data = peak_utils.peaks_to_tensors(data)
 
                 data, transformation = data_utils.pad_and_scale_img_to_square_img(data,
-                                                                                  target_size=self.Config.INPUT_DIM[0],
-                                                                                  nr_cpus=1)
+                                                                                  target_size=self.Config.INPUT_DIM[0])
                 seg, transformation = data_utils.pad_and_scale_img_to_square_img(seg,
-                                                                                 target_size=self.Config.INPUT_DIM[0],
-                                                                                 nr_cpus=1)
+                                                                                 target_size=self.Config.INPUT_DIM[0])
         else:
             raise ValueError("Neither 'data' nor 'subject' set.")
 
@@ -50,8 +50,8 @@ class BatchGenerator3D_Nifti_random(SlimDataLoaderBase):
         y = []
         for subject_idx in subject_idxs:
             data, seg = load_training_data(self.Config, subjects[subject_idx])  # (x, y, z, channels)
-            data = data.transpose(3, 0, 1, 2)  # channels have to be first
-            seg = seg.transpose(3, 0, 1, 2)
+            data = np.asarray(data).transpose(3, 0, 1, 2)  # channels have to be first
+            seg = np.asarray(seg).transpose(3, 0, 1, 2)
 
             # Crop here instead of cropping entire batch at once to make each element in batch have same dimensions
             data, seg = crop(data[None,...], seg[None,...], crop_size=self.Config.INPUT_DIM)
@@ -0,0 +1,147 @@
+"""
+Uncompressed, memory-mapped training data store.
+
+Loading a .nii.gz file for each training batch means decompressing the entire volume (and converting it to float64)
+only to sample a few slices from it. This store saves each volume as uncompressed typed numpy arrays (float16 for
+features and uint8 for binary labels) which are memory-mapped when loading. Only the slices which are actually
+sampled are read from disk.
+
+Layout of one volume "<name>" in the subject folder:
+    <name>.npy            [x, y, z, channels]    (x slices are contiguous on disk; plain npy file)
+    <name>_slices_y.npy   [y, x, z, channels]    (copy with y slices contiguous on disk)
+    <name>_slices_z.npy   [z, x, y, channels]    (copy with z slices contiguous on disk)
+
+The copies for y and z are optional (see 'axes' in convert_nifti()). Without them slices along y and z are read from
+<name>.npy, which touches a much bigger part of the file.
+
+Use resources/utility_scripts/convert_to_mmap_store.py to convert a dataset and set
+Config.TRAINING_DATA_FORMAT = "mmap" to train on it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from os.path import join
+
+import numpy as np
+import nibabel as nib
+
+
+def get_axis_copy_path(filepath, axis):
+    """
+    Args:
+        filepath: path without file ending
+        axis: 1 (y) or 2 (z)
+    """
+    return filepath + "_slices_" + "xyz"[axis] + ".npy"
+
+
+def get_store_dtype(data):
+    """
+    uint8 if all values are integers in [0, 255] (binary masks), otherwise float16. If values are out of the range of
+    float16 fall back to float32.
+    """
+    if np.all(np.isfinite(data)) and data.min() >= 0 and data.max() <= 255 and np.all(np.mod(data, 1) == 0):
+        return np.uint8
+    elif np.nanmax(np.abs(data)) < np.finfo(np.float16).max:
+        return np.float16
+    else:
+        print("WARNING: values out of range of float16. Using float32.")
+        return np.float32
+
+
+def convert_nifti(nifti_path, out_path, axes="xyz", dtype=None):
+    """
+    Convert one nifti image to the memory-mapped store.
+
+    Args:
+        nifti_path: path to .nii.gz file
+        out_path: path of output without file ending
+        axes: for which slice directions to save a copy with contiguous slices (x always gets saved)
+        dtype: dtype of the store. If None: chosen by get_store_dtype()
+
+    Returns:
+        dtype of the store
+    """
+    data = nib.load(nifti_path).get_fdata()
+    if dtype is None:
+        dtype = get_store_dtype(data)
+    data = data.astype(dtype)
+    np.save(out_path + ".npy", data)
+    for axis in [1, 2]:
+        if "xyz"[axis] in axes:
+            np.save(get_axis_copy_path(out_path, axis), np.ascontiguousarray(np.moveaxis(data, axis, 0)))
+    return dtype
+
+
+def convert_subject(dataset_dir, out_dir, subject, filenames=None, axes="xyz"):
+    """
+    Convert all (or the selected) nifti images of one subject.
+
+    Args:
+        dataset_dir: folder containing one folder for each subject
+        out_dir: output folder (can be the same as dataset_dir)
+        subject: subject id
+        filenames: list of filenames without file ending. If None: all .nii.gz files of the subject.
+        axes: see convert_nifti()
+    """
+    if filenames is None:
+        filenames = sorted(f[:-len(".nii.gz")] for f in os.listdir(join(dataset_dir, subject))
+                           if f.endswith(".nii.gz"))
+    if not os.path.exists(join(out_dir, subject)):
+        os.makedirs(join(out_dir, subject))
+    for filename in filenames:
+        nifti_path = join(dataset_dir, subject, filename + ".nii.gz")
+        if not os.path.exists(nifti_path):
+            raise IOError("File missing: {}".format(nifti_path))
+        convert_nifti(nifti_path, join(out_dir, subject, filename), axes=axes)
+
+
+class MmapVolume(object):
+    """
+    Read-only memory-mapped volume [x, y, z, (channels)] from the store.
+
+    Indexing with exactly one index along x, y or z (e.g. data[:, slice_idxs, :] like in data_utils.sample_slices())
+    reads from the copy in which the slices along this axis are contiguous. Everything else is passed on to the
+    memory-mapped [x, y, z, channels] array. np.asarray(volume) reads the entire volume into memory (writable copy).
+    """
+    def __init__(self, filepath):
+        """
+        Args:
+            filepath: path without file ending
+        """
+        self.volume = np.load(filepath + ".npy", mmap_mode="r")
+        self.axis_copies = {0: self.volume}
+        for axis in [1, 2]:
+            if os.path.exists(get_axis_copy_path(filepath, axis)):
+                self.axis_copies[axis] = np.load(get_axis_copy_path(filepath, axis), mmap_mode="r")
+
+    @property
+    def shape(self):
+        return self.volume.shape
+
+    @property
+    def dtype(self):
+        return self.volume.dtype
+
+    @property
+    def ndim(self):
+        return self.volume.ndim
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.volume, dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        selected_axes = [axis for axis, idx in enumerate(key) if not (isinstance(idx, slice) and idx == slice(None))]
+        if len(selected_axes) == 1 and selected_axes[0] in self.axis_copies:
+            axis = selected_axes[0]
+            idx = key[axis]
+            if isinstance(idx, (int, np.integer)):
+                return self.axis_copies[axis][idx]
+            if isinstance(idx, slice) or np.ndim(idx) == 1:
+                return np.moveaxis(self.axis_copies[axis][idx], 0, axis)
+        return self.volume[key]
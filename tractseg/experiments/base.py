@@ -32,6 +32,9 @@ class Config:
     FEATURES_FILENAME = "12g90g270g"
     LABELS_FILENAME = ""  # autofilled
     LABELS_TYPE = "int"
+    TRAINING_DATA_FORMAT = "nifti"  # nifti | mmap (uncompressed store created by tractseg/data/mmap_store.py)
+    SUBJECT_CACHE_MB = 0  # in-memory cache of loaded nifti volumes per data loading worker (LRU); 0 = no cache
+    SUBJECT_AFFINITY_BATCHES = 1  # nr of consecutive batches a data loading worker samples from the same subject
     THRESHOLD = 0.5  # Binary: 0.5, Regression: 0.01
 
     # hyperparameters
@@ -119,3 +122,4 @@ class Config:
     KEEP_INTERMEDIATE_FILES = False
     CSD_RESOLUTION = "LOW"  # HIGH | LOW
     NR_CPUS = -1
+    INFERENCE_MEMORY_FRACTION = 0.5  # fraction of free memory used if inference batch size is "auto"
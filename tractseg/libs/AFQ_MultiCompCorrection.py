@@ -3,9 +3,13 @@ This is a python version of this function:
 https://github.com/yeatmanlab/AFQ/blob/master/functions/AFQ_MultiCompCorrection.m
 """
 
-import random
+import multiprocessing
+from functools import partial
+
+import psutil
 import numpy as np
-import scipy.stats
+
+from tractseg.libs import metric_utils
 
 
 def get_significant_areas(pvals, clusterFWE, alpha=0.05):
@@ -39,29 +43,36 @@ def get_significant_areas(pvals, clusterFWE, alpha=0.05):
     return np.array(result)
 
 
-def _corr(a, b):
+def _get_permuted_labels(y, nperm, random_state):
+    """
+    Each row is a random permutation of y.
+
+    Returns:
+        2d array [nperm, len(y)]
+    """
+    return np.asarray(y)[np.argsort(random_state.rand(nperm, len(y)), axis=1)]
+
+
+def _get_max_cluster_sizes(significant):
     """
-    Correlate a with each row of b
+    Size of biggest cluster of consecutive True values in each row (vectorized run-length encoding).
+
+    Like in the original implementation this is the distance between the non-significant values enclosing the
+    cluster (= cluster size + 1).
 
     Args:
-        a: 1d array
-        b: 2d array
+        significant: 2d bool array [nr_permutations, nr_positions]
 
     Returns:
-        c: 1d array with correlations
-        p: 1d array with p-values
+        1d array [nr_permutations]
     """
-    b = b.T
-    c = []
-    p = []
-    for i in range(len(b)):
-        c_i, p_i = scipy.stats.pearsonr(a, b[i])
-        c.append(c_i)
-        p.append(p_i)
-    return c, p
+    ctr = np.cumsum(significant, axis=1)
+    # number of significant values before the start of the current cluster
+    ctr_before_cluster = np.maximum.accumulate(np.where(significant, 0, ctr), axis=1)
+    return (ctr - ctr_before_cluster).max(axis=1) + 1
 
 
-def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1000):
+def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1000, random_seed=None):
     """
     Compute a multiple comparison correction for Tract Profile data
 
@@ -92,6 +103,7 @@ def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1
                  you can set a cluster threshold of 0.01 and then find clusters
                  that a large enough to pass FWE at a threshold of 0.05.
         nperm: number of permutations
+        random_seed: seed for the random permutations (same seed gives same results)
 
     Returns:
         alphaFWE: This is the alpha (p value) that corresponds after adjustment
@@ -111,9 +123,12 @@ def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1
     if cThresh is None:
         cThresh = alpha
 
+    random_state = np.random.RandomState(random_seed)
+    data = np.asarray(data, dtype=np.float64)
+
     # If y is continues perform a correlation if binary perform a ttest
     if y is None or len(y) == 0:
-        y = np.random.randn(data.shape[0], 1)
+        y = random_state.randn(data.shape[0])
         print('No behavioral data provided so randn will be used')
         stattest = 'corr'
     else:
@@ -124,56 +139,70 @@ def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1
 
     # print("using stattest: {}".format(stattest))
 
-    p = np.zeros([nperm, data.shape[1]])
-    stat = np.zeros([nperm, data.shape[1]])
-    clusMax = np.zeros([nperm])
-    stats = {}
-
-    if ('corr') == (stattest):
-        for ii in range(nperm):
-            # Shuffle the rows of the data
-            rows = np.array(random.sample(range(len(y)), len(y)))  # random shuffling of row indices
-            stat[ii, :], p[ii, :] = _corr(y, data[rows, :])
-    else:
-        if ('ttest') == (stattest):
-            for ii in range(nperm):
-                rows = np.array(random.sample(list(y), len(y)))
-                rows = rows > 0  # to bool
-                ttest_res = scipy.stats.ttest_ind(data[rows, :], data[~rows, :])   #independent t-test
-                p[ii, :] = ttest_res.pvalue
-                stat[ii, :] = ttest_res.statistic
+    # All permutations of a batch are calculated at once. Only the statistics needed for the FWE correction are
+    # kept, the p-values of the batch are discarded afterwards.
+    batch_size = max(1, 2 ** 20 // max(data.shape[1], 1))
+    pMin = []
+    statMax = []
+    clusMax = []
+    for start in range(0, nperm, batch_size):
+        # Shuffling the labels gives the same null distribution as shuffling the rows of the data
+        y_perm = _get_permuted_labels(y, min(batch_size, nperm - start), random_state)
+        if ('corr') == (stattest):
+            stat, p = metric_utils.pearsonr_matrix(y_perm, data)
+        else:
+            stat, p = metric_utils.ttest_ind_matrix(y_perm > 0, data)   #independent t-test
+        pMin.append(p.min(axis=1))
+        statMax.append(stat.max(axis=1))
+        # If a cluster size is defined, also determine the significant
+        # cluster size at the specified alpha value
+        # Threshold the pvalue
+        clusMax.append(_get_max_cluster_sizes(p < cThresh))
 
     # Sort the pvals and associated statistics such that the first
     # entry is the most significant
-    stats["pMin"] = np.sort(p.min(axis=1))
-    stats["statMax"] = np.sort(stat.max(axis=1))[::-1]
+    stats = {}
+    stats["pMin"] = np.sort(np.concatenate(pMin))
+    stats["statMax"] = np.sort(np.concatenate(statMax))[::-1]
     alphaFWE = stats["pMin"][int(round(alpha*nperm))]
     statFWE = stats["statMax"][int(round(alpha*nperm))]
 
-    # If a cluster size is defined, also determine the significant
-    # cluster size at the specified alpha value
-    # Threshold the pvalue
-    pThresh = p < cThresh
-    pThresh = np.array(pThresh)
-
-    for ii in range(nperm):
-        # Find indices where significant clusters end.
-        # The method used requires significant p-values to be included
-        # between non-significant p-values. 0 are therefore added at
-        # both ends of the thresholded p-value vector
-        # (for cases when significant p-values are located at its ends)
-        pThresh_ii = [0] + list(pThresh[ii, :].astype(np.uint8)) + [0]
-        pThresh_ii = np.array(pThresh_ii)
-        clusEnd = np.where(pThresh_ii == 0)[0]
-        clusSiz = np.diff(clusEnd)
-        clusMax[ii] = clusSiz.max()
     # Sort the clusters in descending order of significance
-    stats["clusMax"] = np.sort(clusMax)[::-1]
+    stats["clusMax"] = np.sort(np.concatenate(clusMax).astype(np.float64))[::-1]
     clusterFWE = stats["clusMax"][int(round(alpha*nperm))]
 
     return alphaFWE, statFWE, clusterFWE, stats
 
 
+def multi_comp_correction_per_bundle(data_bundles, y, alpha=0.05, cThresh=None, nperm=1000, random_seed=None,
+                                     nr_cpus=1):
+    """
+    Run AFQ_MultiCompCorrection for each bundle (optionally several bundles in parallel).
+
+    All bundles use the same random_seed, so the results do not depend on nr_cpus.
+
+    Args:
+        data_bundles: list of data matrices (one per bundle)
+        nr_cpus: number of bundles to process in parallel. -1 means all available cpus.
+        (for other arguments see AFQ_MultiCompCorrection)
+
+    Returns:
+        list of (alphaFWE, statFWE, clusterFWE, stats) for each bundle
+    """
+    job = partial(AFQ_MultiCompCorrection, y=y, alpha=alpha, cThresh=cThresh, nperm=nperm, random_seed=random_seed)
+    nr_processes = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    nr_processes = min(nr_processes, len(data_bundles))
+    if nr_processes <= 1:
+        return [job(data) for data in data_bundles]
+
+    pool = multiprocessing.Pool(processes=nr_processes)
+    try:
+        return pool.map(job, data_bundles)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 # if __name__ == '__main__':
 #     data = np.array([[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], [1, 4, 2, 3, 5],
 #                      [1, 4, 2, 9, 5], [5, 4, 2, 9, 5], [5, 4, 2, 9, 1]])
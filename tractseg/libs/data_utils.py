@@ -3,11 +3,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import warnings
+
 import numpy as np
 from scipy import ndimage
 import random
 
-from tractseg.libs import img_utils
+
+def _warn_nr_cpus_deprecated(nr_cpus):
+    """
+    The nr_cpus argument of pad_and_scale_img_to_square_img and cut_and_scale_img_back_to_original_img is deprecated
+    and has no effect: Scaling is done by a single index gather now, which is faster than zooming each channel in a
+    separate process.
+    """
+    if nr_cpus != -1:
+        warnings.warn("nr_cpus is deprecated and has no effect.", DeprecationWarning, stacklevel=3)
 
 
 def pad_and_scale_img_to_square_img(data, target_size=144, nr_cpus=-1):
@@ -18,42 +28,75 @@ def pad_and_scale_img_to_square_img(data, target_size=144, nr_cpus=-1):
     1. Pad image with 0 to make it square
         (if uneven padding -> adds one more px "behind" img; but resulting img shape will be correct)
     2. Scale image to target size
+
+    nr_cpus is deprecated.
     """
+    _warn_nr_cpus_deprecated(nr_cpus)
     nr_dims = len(data.shape)
     assert (nr_dims >= 3 and nr_dims <= 4), "image has to be 3D or 4D"
 
-    shape = data.shape
-    biggest_dim = max(shape)
+    bbox = [[0, data.shape[0]], [0, data.shape[1]], [0, data.shape[2]]]
+    new_img, _, _, transformation = crop_pad_and_scale_img_to_square_img(data, target_size=target_size, bbox=bbox)
+    return new_img, transformation
 
-    # Pad to make square
-    if nr_dims == 4:
-        new_img = np.zeros((biggest_dim, biggest_dim, biggest_dim, shape[3])).astype(data.dtype)
-    else:
-        new_img = np.zeros((biggest_dim, biggest_dim, biggest_dim)).astype(data.dtype)
-    pad1 = (biggest_dim - shape[0]) / 2.
-    pad2 = (biggest_dim - shape[1]) / 2.
-    pad3 = (biggest_dim - shape[2]) / 2.
-    new_img[int(pad1):int(pad1) + shape[0],
-            int(pad2):int(pad2) + shape[1],
-            int(pad3):int(pad3) + shape[2]] = data
-
-    # Scale to right size
+
+def _zoom_index_map(in_size, zoom):
+    """
+    Index of the source voxel for each output voxel of ndimage.zoom(order=0) along one axis. Zooming with order=0
+    is separable, so doing it on a 1D index array gives exactly the same mapping as zooming the 3D image.
+    """
+    return ndimage.zoom(np.arange(in_size, dtype=np.float64), zoom, order=0).astype(np.int64)
+
+
+def crop_pad_and_scale_img_to_square_img(data, target_size=144, bbox=None):
+    """
+    Same as crop_to_nonzero followed by pad_and_scale_img_to_square_img, but done in one pass:
+    Scaling with order=0 only selects voxels. Therefore we compute the source voxel for each voxel of the output
+    image once and gather all channels at once. No cropped and padded intermediate images are created.
+
+    Args:
+        data: 3D or 4D image
+        target_size: size of the output image
+        bbox: bounding box to crop to (if None: bounding box of nonzero voxels)
+
+    Returns:
+        image, bbox, original_shape, transformation (compatible with cut_and_scale_img_back_to_original_img
+        and add_original_zero_padding_again)
+    """
+    nr_dims = len(data.shape)
+    assert (nr_dims >= 3 and nr_dims <= 4), "image has to be 3D or 4D"
+
+    original_shape = data.shape
+    if bbox is None:
+        bbox = get_bbox_from_mask(data, 0)
+
+    shape = tuple(b[1] - b[0] for b in bbox) + data.shape[3:]  # shape after cropping
+    biggest_dim = max(shape)
+    pads = [(biggest_dim - shape[axis]) / 2. for axis in range(3)]
     zoom = float(target_size) / biggest_dim
-    if nr_dims == 4:
-        #use order=0, otherwise does not work for peak images (results would be wrong)
-        new_img = img_utils.resize_first_three_dims(new_img, order=0, zoom=zoom, nr_cpus=nr_cpus)
-    else:
-        new_img = ndimage.zoom(new_img, zoom, order=0)
+
+    # Index in padded image -> index in original image (only where not in padding)
+    idx_map = _zoom_index_map(biggest_dim, zoom)
+    src_idxs = []
+    dst_slices = []
+    for axis in range(3):
+        idxs = idx_map - int(pads[axis])
+        valid = np.nonzero((idxs >= 0) & (idxs < shape[axis]))[0]
+        src_idxs.append(idxs[valid] + bbox[axis][0])
+        dst_slices.append(slice(valid[0], valid[-1] + 1) if len(valid) > 0 else slice(0, 0))
+
+    new_img = np.zeros((len(idx_map),) * 3 + data.shape[3:], dtype=data.dtype)
+    new_img[tuple(dst_slices)] = data[np.ix_(*src_idxs)]
 
     transformation = {
         "original_shape": shape,
-        "pad_x": pad1,
-        "pad_y": pad2,
-        "pad_z": pad3,
+        "pad_x": pads[0],
+        "pad_y": pads[1],
+        "pad_z": pads[2],
         "zoom": zoom
     }
 
-    return new_img, transformation
+    return new_img, bbox, original_shape, transformation
 
 
 def cut_and_scale_img_back_to_original_img(data, t, nr_cpus=-1):
@@ -63,7 +106,32 @@ def cut_and_scale_img_back_to_original_img(data, t, nr_cpus=-1):
     Args:
         data: 3D or 4D image
         t: transformation dict
-        nr_cpus: nr of cpus to use
+        nr_cpus: deprecated
+
+    Returns:
+        3D or 4D image
+    """
+    _warn_nr_cpus_deprecated(nr_cpus)
+    nr_dims = len(data.shape)
+    assert (nr_dims >= 3 and nr_dims <= 4), "image has to be 3D or 4D"
+
+    shape = t["original_shape"][:3]
+    bbox = [[0, shape[0]], [0, shape[1]], [0, shape[2]]]
+    return cut_scale_and_pad_img_back_to_original_img(data, t, bbox, shape)
+
+
+def cut_scale_and_pad_img_back_to_original_img(data, t, bbox, original_shape, dtype=None):
+    """
+    Same as cut_and_scale_img_back_to_original_img followed by add_original_zero_padding_again, but done in one
+    pass: For each voxel inside of bbox the source voxel in data is computed once and all channels are gathered
+    at once directly into the output image (no upscaled and cut intermediate images).
+
+    Args:
+        data: 3D or 4D image
+        t: transformation dict (from crop_pad_and_scale_img_to_square_img)
+        bbox: bounding box (from crop_pad_and_scale_img_to_square_img)
+        original_shape: shape of image before cropping
+        dtype: dtype of output image (default: dtype of data). E.g. np.uint8 for binary segmentations.
 
     Returns:
         3D or 4D image
@@ -71,42 +139,29 @@ def cut_and_scale_img_back_to_original_img(data, t, nr_cpus=-1):
     nr_dims = len(data.shape)
     assert (nr_dims >= 3 and nr_dims <= 4), "image has to be 3D or 4D"
 
-    # Back to old size
     # use order=0, otherwise image values of a DWI will be quite different after downsampling and upsampling
-    if nr_dims == 3:
-        new_data = ndimage.zoom(data, (1. / t["zoom"]), order=0)
-    elif nr_dims == 4:
-        new_data = img_utils.resize_first_three_dims(data, order=0, zoom=(1. / t["zoom"]), nr_cpus=nr_cpus)
-
-    x_residual = 0
-    y_residual = 0
-    z_residual = 0
-
-    # check if has 0.5 residual -> we have to cut 1 pixel more at the end
-    if t["pad_x"] - int(t["pad_x"]) == 0.5:
-        x_residual = 1
-    if t["pad_y"] - int(t["pad_y"]) == 0.5:
-        y_residual = 1
-    if t["pad_z"] - int(t["pad_z"]) == 0.5:
-        z_residual = 1
-
-    # Cut padding
-    shape = new_data.shape
-    new_data = new_data[int(t["pad_x"]): shape[0] - int(t["pad_x"]) - x_residual,
-                        int(t["pad_y"]): shape[1] - int(t["pad_y"]) - y_residual,
-                        int(t["pad_z"]): shape[2] - int(t["pad_z"]) - z_residual]
+    src_idxs = []
+    for axis, pad in enumerate([t["pad_x"], t["pad_y"], t["pad_z"]]):
+        idx_map = _zoom_index_map(data.shape[axis], 1. / t["zoom"])
+        residual = 1 if pad - int(pad) == 0.5 else 0  # has 0.5 residual -> we have to cut 1 pixel more at the end
+        src_idxs.append(idx_map[int(pad): len(idx_map) - int(pad) - residual])
+
+    dtype = data.dtype if dtype is None else dtype
+    new_data = np.zeros(original_shape[:3] + data.shape[3:], dtype=dtype)
+    new_data[bbox[0][0]:bbox[0][1], bbox[1][0]:bbox[1][1], bbox[2][0]:bbox[2][1]] = data[np.ix_(*src_idxs)]
     return new_data
 
 
 def get_bbox_from_mask(mask, outside_value=0):
-    mask_voxel_coords = np.where(mask != outside_value)
-    minzidx = int(np.min(mask_voxel_coords[0]))
-    maxzidx = int(np.max(mask_voxel_coords[0])) + 1
-    minxidx = int(np.min(mask_voxel_coords[1]))
-    maxxidx = int(np.max(mask_voxel_coords[1])) + 1
-    minyidx = int(np.min(mask_voxel_coords[2]))
-    maxyidx = int(np.max(mask_voxel_coords[2])) + 1
-    return [[minzidx, maxzidx], [minxidx, maxxidx], [minyidx, maxyidx]]
+    mask = mask != outside_value
+    if mask.ndim > 3:
+        mask = mask.any(axis=tuple(range(3, mask.ndim)))
+    bbox = []
+    for axis in range(3):
+        # projection onto axis is faster than getting the coordinates of all voxels
+        nonzero = np.nonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))[0]
+        bbox.append([int(np.min(nonzero)), int(np.max(nonzero)) + 1])
+    return bbox
 
 
 def crop_to_bbox(image, bbox):
@@ -190,7 +245,7 @@ def sample_slices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int16
 
 def sample_Xslices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int16, slice_window=5):
     """
-    Sample slices but add slices_window/2 above and below.
+    Sample slices but add slices_window/2 above and below. Slices outside of the volume are zero.
     """
     sw = slice_window  # slice_window (only odd numbers allowed)
     assert sw % 2 == 1, "Slice_window has to be an odd number"
@@ -206,26 +261,16 @@ def sample_Xslices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int1
         y = seg[:, :, slice_idxs].astype(labels_type)
         y = np.array(y).transpose(2, 3, 0, 1)
 
-    data_pad = np.zeros((data.shape[0] + sw - 1, data.shape[1] + sw - 1, data.shape[2] + sw - 1, data.shape[3])).astype(
-        data.dtype)
-    data_pad[pad:-pad, pad:-pad, pad:-pad, :] = data  # padded with two slices of zeros on all sides
-    batch = []
-    for s_idx in slice_idxs:
-        if slice_direction == 0:
-            # (s_idx+2)-2:(s_idx+2)+3 = s_idx:s_idx+5
-            x = data_pad[s_idx:s_idx + sw:, pad:-pad, pad:-pad, :].astype(np.float32)  # (5, y, z, channels)
-            x = np.array(x).transpose(0, 3, 1, 2)  # channels dim has to be before width and height for Unet (but after batches)
-            x = np.reshape(x, (x.shape[0] * x.shape[1], x.shape[2], x.shape[3]))  # (5*channels, y, z)
-            batch.append(x)
-        elif slice_direction == 1:
-            x = data_pad[pad:-pad, s_idx:s_idx + sw, pad:-pad, :].astype(np.float32)  # (5, y, z, channels)
-            x = np.array(x).transpose(1, 3, 0, 2)
-            x = np.reshape(x, (x.shape[0] * x.shape[1], x.shape[2], x.shape[3]))  # (5*channels, y, z)
-            batch.append(x)
-        elif slice_direction == 2:
-            x = data_pad[pad:-pad, pad:-pad, s_idx:s_idx + sw, :].astype(np.float32)  # (5, y, z, channels)
-            x = np.array(x).transpose(2, 3, 0, 1)
-            x = np.reshape(x, (x.shape[0] * x.shape[1], x.shape[2], x.shape[3]))  # (5*channels, y, z)
-            batch.append(x)
-
-    return np.array(batch), y  # (bs, channels, x, y)
+    # Indices of all slices of all windows: (bs, sw). Read them with one fancy indexing operation instead of padding
+    # the entire volume and looping over the windows.
+    nr_slices = data.shape[slice_direction]
+    window_idxs = np.asarray(slice_idxs)[:, None] + np.arange(-pad, pad + 1)[None, :]
+    outside = ((window_idxs < 0) | (window_idxs >= nr_slices)).ravel()
+    key = (slice(None),) * slice_direction + (np.clip(window_idxs, 0, nr_slices - 1).ravel(),)
+    x = np.moveaxis(data[key].astype(np.float32), slice_direction, 0)  # (bs*sw, width, height, channels)
+    x[outside] = 0
+    x = x.reshape((len(window_idxs), sw) + x.shape[1:])  # (bs, sw, width, height, channels)
+    # channels dim has to be before width and height for Unet (but after batches)
+    x = x.transpose(0, 1, 4, 2, 3)
+    x = x.reshape((x.shape[0], x.shape[1] * x.shape[2]) + x.shape[3:])  # (bs, sw*channels, width, height)
+    return x, y
@@ -3,6 +3,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import shutil
+import tempfile
+from os.path import join
+
 import numpy as np
 
 from tractseg.data.data_loader_inference import DataLoaderInference
@@ -40,6 +44,54 @@ def get_seg_single_img_3_directions(Config, model, subject=None, data=None, scal
     return probs_combined, img_y
 
 
+def get_seg_single_img_3_directions_fused(Config, model, subject=None, data=None, only_prediction=False,
+                                          batch_size=1, fusion="mean", probs=True):
+    """
+    Same result as get_seg_single_img_3_directions() followed by mean_fusion() or majority_fusion(), but the
+    predictions of each direction are directly added to one accumulator. This way only one image has to be kept
+    in memory instead of one per direction plus the concatenated image.
+
+    Args:
+        fusion: "mean" or "majority"
+        probs: Only for mean fusion: return probabilities or binary image
+
+    Returns:
+        4D image (x, y, z, nr_classes), img_y of the last direction
+    """
+    from tractseg.libs import trainer
+
+    img_shape = (Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.NR_OF_CLASSES)
+    if fusion == "mean":
+        accumulator = np.zeros(img_shape, dtype=np.float32)  # sum of probabilities
+    elif fusion == "majority":
+        accumulator = np.zeros(img_shape, dtype=np.uint8)  # number of votes
+    else:
+        raise ValueError("fusion has to be 'mean' or 'majority'")
+
+    directions = ["x", "y", "z"]
+    for idx, direction in enumerate(directions):
+        Config.SLICE_DIRECTION = direction
+        print("Processing direction ({} of 3)".format(idx+1))
+
+        if subject:
+            dataManagerSingle = DataLoaderInference(Config, subject=subject)
+        else:
+            dataManagerSingle = DataLoaderInference(Config, data=data)
+
+        # for majority fusion each direction adds its binary vote
+        accumulator, img_y = trainer.predict_img(Config, model, dataManagerSingle, probs=fusion == "mean",
+                                                 scale_to_world_shape=False, only_prediction=only_prediction,
+                                                 batch_size=batch_size, accumulator=accumulator)
+
+    if fusion == "majority":
+        return (accumulator >= 2).astype(np.int16), img_y   #majority is at least 2 of 3
+
+    accumulator /= len(directions)
+    if not probs:
+        accumulator = (accumulator >= Config.THRESHOLD).astype(np.int16)
+    return accumulator, img_y
+
+
 def mean_fusion(threshold, img, probs=True):
     """
     Merge along last axis by mean.
@@ -60,38 +112,60 @@ def mean_fusion(threshold, img, probs=True):
     return probs_mean
 
 
+def _mean_fusion_peaks_bundle(img, merged_peaks, idx):
+    """
+    Merge the 3 directions of one bundle and write the result directly into merged_peaks (can be a memmap shared
+    between workers).
+    """
+    dirs_per_bundle = []
+    for jdx in range(3):  # 3 orientations
+        peak = img[:, :, :, idx*3:idx*3+3, jdx]
+        tensor = peak_utils.peaks_to_tensors(peak)
+        dirs_per_bundle.append(tensor)
+    merged_tensor = np.array(dirs_per_bundle).mean(axis=0)
+    merged_peaks[:, :, :, idx*3:idx*3+3] = peak_utils.tensors_to_peaks(merged_tensor)
+
+
 def mean_fusion_peaks(img, nr_cpus=-1):
     """
     Calculating mean in tensor space (if simply taking mean in peak space most voxels look fine but a few are
     completely wrong (e.g. some voxels in transition to lateral projections of CST)).
 
+    img is written to a memmap once and the workers read their bundle from there and write their result into
+    a memmapped output. So img is not copied to every worker and memory does not grow with nr_cpus.
+
     Args:
         img: 5D Image with probability per direction (x, y, z, nr_classes, 3)
+        nr_cpus: nr of cpus to use (-1 means all available)
 
     Returns:
         4D image (x, y, z, nr_classes)
     """
-    from joblib import Parallel, delayed
+    import psutil
+    from joblib import Parallel, delayed, dump, load
 
     nr_classes = int(img.shape[3] / 3)
-
-    def process_bundle(idx):
-        print("idx: {}".format(idx))
-        dirs_per_bundle = []
-        for jdx in range(3):  # 3 orientations
-            peak = img[:, :, :, idx*3:idx*3+3, jdx]
-            tensor = peak_utils.peaks_to_tensors(peak)
-            dirs_per_bundle.append(tensor)
-        merged_tensor = np.array(dirs_per_bundle).mean(axis=0)
-        merged_peak = peak_utils.tensors_to_peaks(merged_tensor)
-        return merged_peak
-
-    n_jobs = 5 if nr_cpus == -1 else min(nr_cpus, 5)
-    merged_peaks_all = Parallel(n_jobs=n_jobs)(delayed(process_bundle)(idx) for idx in range(nr_classes))
-
-    merged_peaks_all = np.array(merged_peaks_all).transpose(1, 2, 3, 0, 4)
-    s = merged_peaks_all.shape
-    merged_peaks_all = merged_peaks_all.reshape([s[0], s[1], s[2], s[3] * s[4]])
+    n_jobs = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    n_jobs = max(min(n_jobs, nr_classes), 1)
+
+    if n_jobs == 1:
+        merged_peaks_all = np.zeros(img.shape[:4], dtype=np.float32)
+        for idx in range(nr_classes):
+            _mean_fusion_peaks_bundle(img, merged_peaks_all, idx)
+        return merged_peaks_all
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        img_path = join(tmp_dir, "img.mmap")
+        dump(img, img_path)
+        img = load(img_path, mmap_mode="r")
+        merged_peaks_all = np.memmap(join(tmp_dir, "merged_peaks.mmap"), dtype=np.float32,
+                                     shape=img.shape[:4], mode="w+")
+        Parallel(n_jobs=n_jobs)(delayed(_mean_fusion_peaks_bundle)(img, merged_peaks_all, idx)
+                                for idx in range(nr_classes))
+        merged_peaks_all = np.array(merged_peaks_all)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     return merged_peaks_all
 
@@ -75,16 +75,18 @@ def get_best_weights_path(exp_path, load_weights):
         return ""
 
 
-def get_bvals_bvecs_path(args):
-    input_file_without_ending = os.path.basename(args.input).split(".")[0]
+def get_bvals_bvecs_path(args, input_path=None):
+    if input_path is None:
+        input_path = args.input
+    input_file_without_ending = os.path.basename(input_path).split(".")[0]
     if args.bvals:
         bvals = args.bvals
     else:
-        bvals = join(os.path.dirname(args.input), input_file_without_ending + ".bvals")
+        bvals = join(os.path.dirname(input_path), input_file_without_ending + ".bvals")
     if args.bvecs:
         bvecs = args.bvecs
     else:
-        bvecs = join(os.path.dirname(args.input), input_file_without_ending + ".bvecs")
+        bvecs = join(os.path.dirname(input_path), input_file_without_ending + ".bvecs")
     return bvals, bvecs
 
 
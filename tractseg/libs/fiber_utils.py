@@ -3,78 +3,106 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import shutil
+import tempfile
 import multiprocessing
-from os import getpid
 import numpy as np
 import nibabel as nib
 from dipy.tracking.streamline import compress_streamlines as compress_streamlines_dipy
-from dipy.segment.metric import ResampleFeature
 from dipy.tracking.metrics import spline
 from dipy.tracking import utils as utils_trk
-from dipy.tracking.streamline import transform_streamlines
 from dipy.tracking.streamline import set_number_of_points
 from dipy.tracking.streamline import length as sl_length
+from dipy.tracking.streamline import Streamlines
+from nibabel.streamlines import ArraySequence
 
-from tractseg.libs import utils
 from tractseg.libs import peak_utils
 
-# Global variables needed for shared memory of parallel fiber compression
-global _COMPRESSION_ERROR_THRESHOLD
-_COMPRESSION_ERROR_THRESHOLD = None
-global _FIBER_BATCHES
-_FIBER_BATCHES = None
-
+def _compress_streamlines_chunk(volume_paths, start, end, error_threshold):
+    """
+    Worker function for compress_streamlines. Compresses the streamlines start:end of the memory mapped streamlines.
+    The points of the compressed streamlines are saved next to the input files (shared memory) instead of sending
+    them back to the main process.
 
-def compress_fibers_worker_shared_mem(idx):
+    Returns:
+        path of the points of the compressed streamlines, nr of points of each compressed streamline
     """
-    Worker Functions for multithreaded compression.
+    offsets = np.load(volume_paths["offsets"], mmap_mode="r")[start:end]
+    lengths = np.array(np.load(volume_paths["lengths"], mmap_mode="r")[start:end])
+    data = np.load(volume_paths["data"], mmap_mode="r")[offsets[0]:offsets[-1] + lengths[-1]]
+    streamlines = _create_array_sequence(np.array(data), lengths)
+    streamlines_compressed = compress_streamlines_dipy(streamlines, tol_error=error_threshold)
+    out_path = os.path.join(os.path.dirname(volume_paths["data"]), "compressed_{}.npy".format(start))
+    np.save(out_path, np.concatenate(streamlines_compressed))
+    return out_path, np.array([len(sl) for sl in streamlines_compressed])
 
-    Function that runs in parallel must be on top level (not in class/function) otherwise it can
-    not be pickled.
+
+def compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=-1, pool=None):
     """
-    streamlines_chunk = _FIBER_BATCHES[idx]  # shared memory; by using indices each worker accesses only his part
-    result = compress_streamlines_dipy(streamlines_chunk, tol_error=_COMPRESSION_ERROR_THRESHOLD)
-    # print('PID {}, DONE'.format(getpid()))
-    return result
+    Compress streamlines (see dipy.tracking.streamline.compress_streamlines) using several processes.
+
+    The points of all streamlines are shared with the workers as memory mapped files (in /dev/shm if available) and
+    the workers save the compressed streamlines there as well. Only file paths and the number of points of each
+    streamline are sent between the processes. This does not depend on the start method of multiprocessing (fork,
+    spawn, forkserver).
 
+    Args:
+        streamlines: list of streamlines or ArraySequence
+        error_threshold: maximal distance of removed points to compressed streamline (mm)
+        nr_cpus: -1 means all available cpus
+        pool: existing multiprocessing pool (e.g. tractseg_prob_tracking.create_pool()) to avoid starting new workers
+            for each call. If None a new pool is started.
 
-def compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=-1):
+    Returns:
+        list of compressed streamlines
+    """
     import psutil
     if nr_cpus == -1:
         nr_processes = psutil.cpu_count()
     else:
         nr_processes = nr_cpus
-    number_streamlines = len(streamlines)
-
-    if nr_processes >= number_streamlines:
-        nr_processes = number_streamlines - 1
-        if nr_processes < 1:
-            nr_processes = 1
 
-    chunk_size = int(number_streamlines / nr_processes)
-
-    if chunk_size < 1:
+    if len(streamlines) == 0:
         return streamlines
-    fiber_batches = list(utils.chunks(streamlines, chunk_size))
-
-    global _COMPRESSION_ERROR_THRESHOLD
-    global _FIBER_BATCHES
-    _COMPRESSION_ERROR_THRESHOLD = error_threshold
-    _FIBER_BATCHES = fiber_batches
-
-    # print("Main program using: {} GB".format(round(Utils.mem_usage(print_usage=False), 3)))
-    pool = multiprocessing.Pool(processes=nr_processes)
 
-    #Do not pass in data (doubles amount of memory needed), but only idx of shared memory
-    #  (needs only as much memory as single thread version (only main thread needs memory, others almost 0).
-    #  Shared memory version also faster (around 20-30%?).
-    result = pool.map(compress_fibers_worker_shared_mem, range(0, len(fiber_batches)))
-
-    pool.close()
-    pool.join()
-
-    streamlines_c = utils.flatten(result)
-    return streamlines_c
+    # Less overhead than starting a pool if only few streamlines (also works inside of daemonic processes)
+    if nr_processes == 1 or len(streamlines) < 10 * nr_processes:
+        return compress_streamlines_dipy(streamlines, tol_error=error_threshold)
+
+    # Chunks with similar number of points. More chunks than processes for better load balancing.
+    streamlines = _as_array_sequence(streamlines)
+    nr_chunks = min(4 * nr_processes, len(streamlines))
+    cum_lengths = np.cumsum(streamlines._lengths)
+    chunk_ends = np.searchsorted(cum_lengths, np.linspace(0, cum_lengths[-1], nr_chunks + 1)[1:], side="left") + 1
+    chunk_ends[-1] = len(streamlines)
+    chunks = [(start, end) for start, end in zip(np.concatenate([[0], chunk_ends[:-1]]), chunk_ends) if end > start]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes=nr_processes)
+    tmp_dir = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        volume_paths = {}
+        for name, array in [("data", streamlines._data), ("offsets", streamlines._offsets),
+                            ("lengths", streamlines._lengths)]:
+            volume_paths[name] = os.path.join(tmp_dir, name + ".npy")
+            np.save(volume_paths[name], array)
+        results = [pool.apply_async(_compress_streamlines_chunk, (volume_paths, start, end, error_threshold))
+                   for start, end in chunks]
+        data = []
+        lengths = []
+        for result in results:
+            out_path, lengths_chunk = result.get()
+            data.append(np.load(out_path))
+            lengths.append(lengths_chunk)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return list(_create_array_sequence(np.concatenate(data), np.concatenate(lengths)))
 
 
 def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
@@ -84,7 +112,8 @@ def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
 
     Args:
         out_file: string with filepath of the output file
-        streamlines: sequence of streamlines in RASmm coordinate (list of 2D numpy arrays)
+        streamlines: sequence of streamlines in RASmm coordinate (list of 2D numpy arrays). Can also be an iterator
+            (e.g. generator), then the streamlines are written while iterating without having all of them in memory.
         affine: 4d array with voxel to RASmm transformation
         shape: 1d array with dimensions of the brain volume, default [145, 174, 145]
 
@@ -101,8 +130,22 @@ def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
     trackvis_header['voxel_order'] = 'RAS'
     trackvis_header['dim'] = shape
     nib.trackvis.aff_to_hdr(affine, trackvis_header, pos_vox=False, set_order=False)
-    streamlines_trk_format = [(sl, None, None) for sl in streamlines]
-    nib.trackvis.write(out_file, streamlines_trk_format, trackvis_header, points_space="rasmm")
+    if hasattr(streamlines, "__len__"):
+        streamlines_trk_format = [(sl, None, None) for sl in streamlines]
+        nib.trackvis.write(out_file, streamlines_trk_format, trackvis_header, points_space="rasmm")
+    else:
+        # Number of streamlines only known after writing -> set in header afterwards
+        nr_streamlines = [0]
+
+        def streamlines_trk_format():
+            for sl in streamlines:
+                nr_streamlines[0] += 1
+                yield sl, None, None
+
+        nib.trackvis.write(out_file, streamlines_trk_format(), trackvis_header, points_space="rasmm")
+        with open(out_file, "r+b") as f:
+            f.seek(nib.trackvis.header_2_dtype.fields["n_count"][1])
+            f.write(np.array(nr_streamlines[0], dtype=np.int32).tobytes())
 
 
 def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=None, vox_order='RAS'):
@@ -123,7 +166,8 @@ def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=N
 
     Args:
         out_file: string with filepath of the output file
-        streamlines: sequence of streamlines in RASmm coordinate
+        streamlines: sequence of streamlines in RASmm coordinate. Can also be an iterator (e.g. generator), then
+            the streamlines are written while iterating without having all of them in memory.
         affine: 4d array with voxel to RASmm transformation
         shape: 1d array with dimensions of the brain volume, default [145, 174, 145]
         vox_sizes: 1d array with the voxels sizes, if None takes the absolute values of the diagonal of the affine
@@ -151,13 +195,18 @@ def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=N
     hdr['voxel_order'] = vox_order
     hdr['dimensions'] = shape
     hdr['voxel_to_rasmm'] = affine
-    hdr['nb_streamlines'] = len(streamlines)
+    if hasattr(streamlines, "__len__"):
+        hdr['nb_streamlines'] = len(streamlines)
+        tractogram = nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4))
+    else:
+        # nb_streamlines is set by nibabel after writing all streamlines
+        tractogram = nib.streamlines.LazyTractogram(lambda: streamlines, affine_to_rasmm=np.eye(4))
 
-    nib.streamlines.save(nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)), out_file, header=hdr)
+    nib.streamlines.save(tractogram, out_file, header=hdr)
 
 
 def convert_tck_to_trk(filename_in, filename_out, reference_affine, reference_shape,
-                       compress_err_thr=0.1, smooth=None, nr_cpus=-1, tracking_format="trk_legacy"):
+                       compress_err_thr=0.1, smooth=None, nr_cpus=-1, tracking_format="trk_legacy", pool=None):
 
     streamlines = nib.streamlines.load(filename_in).streamlines  # Load Fibers (Tck)
 
@@ -169,7 +218,7 @@ def convert_tck_to_trk(filename_in, filename_out, reference_affine, reference_sh
 
     #Compressing also good to remove checkerboard artefacts from tracking on peaks
     if compress_err_thr is not None:
-        streamlines = compress_streamlines(streamlines, compress_err_thr, nr_cpus=nr_cpus)
+        streamlines = compress_streamlines(streamlines, compress_err_thr, nr_cpus=nr_cpus, pool=pool)
 
     if tracking_format == "trk_legacy":
         save_streamlines_as_trk_legacy(filename_out, streamlines, reference_affine, reference_shape)
@@ -193,11 +242,18 @@ def create_empty_tractogram(filename_out, reference_file,
 
 
 def resample_fibers(streamlines, nb_points=12):
-    streamlines_new = []
-    for sl in streamlines:
-        feature = ResampleFeature(nb_points=nb_points)
-        streamlines_new.append(feature.extract(sl))
-    return streamlines_new
+    """
+    Resample all streamlines to nb_points (all streamlines at once on one ArraySequence).
+
+    Returns:
+        list of streamlines (views of one array [nr_streamlines, nb_points, 3])
+    """
+    streamlines = _as_array_sequence(streamlines)
+    if len(streamlines) == 0:
+        return []
+    streamlines._data = streamlines._data.astype(np.float32, copy=False)  # same as ResampleFeature
+    streamlines = set_number_of_points(streamlines, nb_points=nb_points)
+    return list(streamlines._data.reshape(-1, nb_points, 3))
 
 
 def smooth_streamlines(streamlines, smoothing_factor=10):
@@ -209,12 +265,10 @@ def smooth_streamlines(streamlines, smoothing_factor=10):
         smoothing_factor: 10: slight smoothing,  100: very smooth from beginning to end
 
     Returns:
-        smoothed streamlines
+        smoothed streamlines (ArraySequence)
     """
-    streamlines_smooth = []
-    for sl in streamlines:
-        streamlines_smooth.append(spline(sl, s=smoothing_factor))
-    return streamlines_smooth
+    # Splines have to be fitted for each streamline separately (scipy splprep)
+    return _as_array_sequence([spline(sl, s=smoothing_factor) for sl in streamlines])
 
 
 def get_streamline_statistics(streamlines, subsample=False, raw=False):
@@ -327,43 +381,80 @@ def get_weighted_mean_of_peaks(best_orig, tom, weight=0.5):
     return np.average(stacked, axis=0, weights=[1 - weight, weight])
 
 
+def _as_array_sequence(streamlines):
+    """
+    Copy of streamlines as one compact ArraySequence. Operations can then be applied to all points at once (_data).
+
+    Faster than ArraySequence.copy() and ArraySequence(list) which loop over the streamlines.
+    """
+    if isinstance(streamlines, ArraySequence):
+        lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+        offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+        new_offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.intp)
+        if len(lengths) > 0 and np.array_equal(offsets, new_offsets):
+            data = streamlines._data[:lengths.sum()].copy()
+        elif len(lengths) > 0:  # e.g. streamlines[::2] -> gather points of the selected streamlines
+            data = streamlines._data[np.arange(lengths.sum()) + np.repeat(offsets - new_offsets, lengths)]
+        else:
+            return Streamlines()
+    else:
+        streamlines = [np.asarray(sl) for sl in streamlines]
+        if len(streamlines) == 0:
+            return Streamlines()
+        lengths = [len(sl) for sl in streamlines]
+        data = np.concatenate(streamlines)
+
+    return _create_array_sequence(data, lengths)
+
+
+def _create_array_sequence(data, lengths):
+    """
+    ArraySequence from all points [nr_points, 3] and the number of points of each streamline (without copying).
+    """
+    sl_new = Streamlines()
+    if len(lengths) == 0:
+        return sl_new
+    sl_new._data = data
+    sl_new._lengths = np.asarray(lengths, dtype=np.intp)
+    sl_new._offsets = np.concatenate([[0], np.cumsum(sl_new._lengths)[:-1]]).astype(np.intp)
+    return sl_new
+
+
+def _get_axis_idx(axis):
+    if axis == "x":
+        return 0
+    elif axis == "y":
+        return 1
+    elif axis == "z":
+        return 2
+    raise ValueError("Unsupported axis")
+
+
 def add_to_each_streamline(streamlines, scalar):
     """
     Add scalar value to each coordinate of each streamline
     """
-    sl_new = []
-    for sl in streamlines:
-        sl_new.append(np.array(sl) + scalar)
+    sl_new = _as_array_sequence(streamlines)
+    if len(sl_new) > 0:
+        if np.result_type(sl_new._data, scalar) == sl_new._data.dtype:
+            sl_new._data += scalar
+        else:  # e.g. integer coordinates + float: upcast like np.array(sl) + scalar
+            sl_new._data = sl_new._data + scalar
     return sl_new
 
 
 def add_to_each_streamline_axis(streamlines, scalar, axis="x"):
-    sl_new = []
-    for sl in streamlines:
-        s = np.array(sl)
-        if axis == "x":
-            s[:, 0] += scalar
-        elif axis == "y":
-            s[:, 1] += scalar
-        elif axis == "z":
-            s[:, 2] += scalar
-        sl_new.append(s)
+    sl_new = _as_array_sequence(streamlines)
+    if len(sl_new) > 0 and axis in ["x", "y", "z"]:
+        sl_new._data[:, _get_axis_idx(axis)] += scalar
     return sl_new
 
 
 def flip(streamlines, axis="x"):
-    new_sl = []
-    for sl in streamlines:
-        tmp = np.copy(sl)
-        if axis == "x":
-            tmp[:, 0] = tmp[:, 0] * -1
-        elif axis == "y":
-            tmp[:, 1] = tmp[:, 1] * -1
-        elif axis == "z":
-            tmp[:, 2] = tmp[:, 2] * -1
-        else:
-            raise ValueError("Unsupported axis")
-        new_sl.append(tmp)
+    axis_idx = _get_axis_idx(axis)
+    new_sl = _as_array_sequence(streamlines)
+    if len(new_sl) > 0:
+        new_sl._data[:, axis_idx] *= -1
     return new_sl
 
 
@@ -395,7 +486,7 @@ def invert_streamlines(streamlines, reference_img, affine, axis="x"):
         axis: x | y | z
 
     Returns:
-        streamlines
+        streamlines (ArraySequence)
     """
 
     img_shape = np.array(reference_img.shape)
@@ -424,7 +515,10 @@ def invert_streamlines(streamlines, reference_img, affine, axis="x"):
     else:
         raise ValueError("invalid axis")
 
-    return list(transform_streamlines(streamlines, affine_invert))
+    streamlines = _as_array_sequence(streamlines)
+    if len(streamlines) > 0:
+        streamlines._data[:] = np.dot(streamlines._data, affine_invert[:3, :3].T) + affine_invert[:3, 3]
+    return streamlines
 
 
 def resample_to_same_distance(streamlines, max_nr_points=10, ANTI_INTERPOL_MULT=1):
@@ -107,7 +107,7 @@ def remove_small_blobs(img, threshold=1, debug=True):
     mask, number_of_blobs = ndimage.label(img)
     if debug:
         print('Number of blobs before: ' + str(number_of_blobs))
-    counts = np.bincount(mask.flatten())  # number of pixels in each blob
+    counts = np.bincount(mask.ravel())  # number of pixels in each blob
 
     #If only one blob (only background) abort because nothing to remove
     if len(counts) <= 1:
@@ -120,13 +120,11 @@ def remove_small_blobs(img, threshold=1, debug=True):
     if debug:
         print(counts)
 
-    remove = counts <= threshold
-    remove_idx = np.nonzero(remove)[0]
-
-    for idx in remove_idx:
-        if idx != second_largest_blob_idx:  # make sure to keep at least one blob
-            mask[mask == idx] = 0  # set blobs we remove to 0
-    mask[mask > 0] = 1  # set everything else to 1
+    # Lookup table from blob label to new value (one pass over the image instead of one pass per removed blob)
+    keep = counts > threshold
+    keep[second_largest_blob_idx] = True  # make sure to keep at least one blob
+    keep[0] = False  # background
+    mask = keep.astype(mask.dtype)[mask]
 
     if debug:
         mask_after, number_of_blobs_after = ndimage.label(mask)
@@ -135,34 +133,50 @@ def remove_small_blobs(img, threshold=1, debug=True):
     return mask
 
 
-def postprocess_segmentations(data, bundles, blob_thr=50, hole_closing=None):
+def _postprocess_bundle(data, data_new, idx, bundle, blob_thr=50, hole_closing=None):
+    """
+    Postprocess one bundle and write the result directly into data_new[idx].
+    """
+    skip_hole_closing = ["CST_right", "CST_left", "MCP"]
+    increased_hole_closing = []  # not needed anymore because already done in bundle-specific postprocessing
+
+    data_single = np.ascontiguousarray(data[:,:,:,idx])  # ndimage is faster on contiguous data
+
+    #Fill holes
+    if hole_closing is not None and bundle not in skip_hole_closing:
+        size = hole_closing  # Working as expected (size 2-3 good value)
+        if bundle in increased_hole_closing:
+            size *= 2
+        data_single = ndimage.binary_closing(data_single,
+                                             structure=np.ones((size, size, size))).astype(data_single.dtype)
+
+    # Remove small blobs
+    if blob_thr is not None:
+        data_single = remove_small_blobs(data_single, threshold=blob_thr, debug=False)
+
+    data_new[idx] = data_single
+
+
+def postprocess_segmentations(data, bundles, blob_thr=50, hole_closing=None, nr_cpus=-1):
     """
     Postprocessing of segmentations. Fill holes and remove small blobs.
 
     hole_closing is deactivated per default because it incorrectly fills up the gyri (e.g. in AF).
+
+    Bundles are processed in parallel threads (ndimage releases the GIL), which write their result directly into
+    the output array.
     """
-    skip_hole_closing = ["CST_right", "CST_left", "MCP"]
-    increased_hole_closing = []  # not needed anymore because already done in bundle-specific postprocessing
+    nr_cpus = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    n_jobs = max(min(nr_cpus, len(bundles)), 1)
 
-    data_new = []
-    for idx, bundle in enumerate(bundles):
-        data_single = data[:,:,:,idx]
-
-        #Fill holes
-        if hole_closing is not None and bundle not in skip_hole_closing:
-            size = hole_closing  # Working as expected (size 2-3 good value)
-            if bundle in increased_hole_closing:
-                size *= 2
-            data_single = ndimage.binary_closing(data_single,
-                                                 structure=np.ones((size, size, size))).astype(data_single.dtype)
-
-        # Remove small blobs
-        if blob_thr is not None:
-            data_single = remove_small_blobs(data_single, threshold=blob_thr, debug=False)
-
-        data_new.append(data_single)
-    data_new = np.array(data_new).transpose(1, 2, 3, 0)
-    return data_new
+    # remove_small_blobs returns int32 labels
+    dtype = np.result_type(np.int32, data.dtype) if blob_thr is not None else data.dtype
+    data_new = np.zeros((len(bundles),) + data.shape[:3], dtype=dtype)  # bundles first: each bundle is contiguous
+
+    Parallel(n_jobs=n_jobs, backend="threading")(delayed(_postprocess_bundle)(data, data_new, idx, bundle, blob_thr,
+                                                                               hole_closing)
+                                                 for idx, bundle in enumerate(bundles))
+    return data_new.transpose(1, 2, 3, 0)
 
 
 def has_two_big_blobs(img, bundle, debug=True):
@@ -193,34 +207,43 @@ def bundle_specific_postprocessing(data, bundles):
     """
     For certain bundles checks if bundle contains two big blobs. Then it reduces the threshold for conversion to
     binary and applies hole closing.
+
+    These bundles are small, therefore only the bounding box of the bundle (plus a margin which is big enough that
+    the closing is not affected by the image border) is processed.
     """
     bundles_thresholds = {
         "CA": 0.3,
         "FX_left": 0.4,
         "FX_right": 0.4,
     }
+    size = 6
+    margin = 2 * size
 
-    data_new = []
+    data_new = (data > 0.5).astype(np.uint8)
     for idx, bundle in enumerate(bundles):
-        data_single = data[:, :, :, idx]
-
-        if bundle in list(bundles_thresholds.keys()):
-            if has_two_big_blobs(data_single > 0.5, bundle, debug=False):
-                print("INFO: Using bundle specific postprocessing for {} because bundle incomplete.".format(bundle))
-                thr = bundles_thresholds[bundle]
-            else:
-                thr = 0.5
-            data_single = data_single > thr
-
-            size = 6
-            data_single = ndimage.binary_closing(data_single,
-                                                 structure=np.ones((size, size, size)))  # returns bool
-        else:
-            data_single = data_single > 0.5
+        if bundle not in bundles_thresholds:
+            continue
 
-        data_new.append(data_single)
+        # Bounding box of all voxels which can be part of the bundle (lowest threshold)
+        data_single = data[:, :, :, idx]
+        mask = data_single > bundles_thresholds[bundle]
+        if not mask.any():
+            continue  # closing of empty image is empty
+        bbox = []
+        for axis in range(3):
+            nonzero = np.nonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))[0]
+            bbox.append(slice(max(nonzero[0] - margin, 0), min(nonzero[-1] + 1 + margin, mask.shape[axis])))
+        bbox = tuple(bbox)
+        data_single = data_single[bbox]
+
+        data_single_bin = data_single > 0.5
+        if has_two_big_blobs(data_single_bin, bundle, debug=False):
+            print("INFO: Using bundle specific postprocessing for {} because bundle incomplete.".format(bundle))
+            data_single_bin = data_single > bundles_thresholds[bundle]
+
+        data_new[bbox + (idx,)] = ndimage.binary_closing(data_single_bin, structure=np.ones((size, size, size)))
 
-    return np.array(data_new).transpose(1, 2, 3, 0).astype(np.uint8)
+    return data_new
 
 
 def resize_first_three_dims(img, order=0, zoom=0.62, nr_cpus=-1):
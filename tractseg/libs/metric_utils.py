@@ -4,8 +4,8 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import scipy.stats
 from sklearn.metrics import f1_score
-from sklearn.linear_model import LinearRegression
 
 from tractseg.data import dataset_specific_utils
 from tractseg.libs import peak_utils
@@ -373,10 +373,72 @@ def unconfound(y, confound, group_data=False):
     #y = demean(y)
     #confound = demean(confound)
 
-    lr = LinearRegression(fit_intercept=True).fit(confound, y)  # lr.coef_: [targets, confounds]
+    # Least squares fit with intercept (same as sklearn LinearRegression(fit_intercept=True): fit on centered data).
+    # The pseudo-inverse of the design is calculated once and applied to all targets at the same time.
+    y = np.asarray(y, dtype=np.float64)
+    confound = np.asarray(confound, dtype=np.float64)
+    coef = np.dot(np.linalg.pinv(confound - confound.mean(axis=0)), y - y.mean(axis=0))  # [confounds, targets]
     if group_data:
-        y_predicted_by_confound = lr.coef_[:, 1:] @ confound[:, 1:].T
+        y_predicted_by_confound = np.dot(confound[:, 1:], coef[1:])
     else:
-        y_predicted_by_confound = lr.coef_ @ confound.T  # [targets, samples]
-    y_corrected = y.T - y_predicted_by_confound
-    return y_corrected.T  # [samples, targets]
+        y_predicted_by_confound = np.dot(confound, coef)  # [samples, targets]
+    y_corrected = y - y_predicted_by_confound
+    return y_corrected  # [samples, targets]
+
+
+def pearsonr_matrix(x, data):
+    """
+    Pearson correlation of each row of x with each column of data (one matrix product for all pairs).
+
+    Args:
+        x: [n, samples]
+        data: [samples, positions]
+
+    Returns:
+        c: correlations [n, positions]
+        p: p-values (same as scipy.stats.pearsonr) [n, positions]
+    """
+    x = np.asarray(x, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    nr_samples = data.shape[0]
+    data = data - data.mean(axis=0)
+    data = data / np.sqrt((data ** 2).sum(axis=0))
+    x = x - x.mean(axis=1, keepdims=True)
+    x = x / np.sqrt((x ** 2).sum(axis=1, keepdims=True))
+    c = np.clip(np.dot(x, data), -1, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = c * np.sqrt((nr_samples - 2) / (1 - c ** 2))
+    p = 2 * scipy.stats.t.sf(np.abs(t), nr_samples - 2)
+    return c, p
+
+
+def ttest_ind_matrix(groups, data):
+    """
+    Independent t-test between the samples where groups is True and the samples where groups is False for each row
+    of groups and each column of data (group sums as matrix products).
+
+    Args:
+        groups: bool [n, samples]
+        data: [samples, positions]
+
+    Returns:
+        t: t-statistics (mean of True samples - mean of False samples) [n, positions]
+        p: p-values (same as scipy.stats.ttest_ind) [n, positions]
+    """
+    data = np.asarray(data, dtype=np.float64)
+    nr_samples = data.shape[0]
+    data = data - data.mean(axis=0)  # better precision of sum of squares
+    groups = np.asarray(groups).astype(np.float64)
+    n1 = groups.sum(axis=1, keepdims=True)
+    n0 = nr_samples - n1
+    sum1 = np.dot(groups, data)
+    sum0 = data.sum(axis=0) - sum1
+    sum_sq = (data ** 2).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean1 = sum1 / n1
+        mean0 = sum0 / n0
+        # pooled variance: sum of squared deviations from the mean of the respective group
+        var = (sum_sq - sum1 * mean1 - sum0 * mean0) / (nr_samples - 2)
+        t = (mean1 - mean0) / np.sqrt(var * (1. / n1 + 1. / n0))
+    p = 2 * scipy.stats.t.sf(np.abs(t), nr_samples - 2)
+    return t, p
@@ -133,45 +133,40 @@ def matrix_tensor_to_flat_tensor(matrix):
     return tensor
 
 
-def tensors_to_peaks(tensors):
+def tensors_to_peaks(tensors, chunk_size=1000000):
     """
     Convert tensor image to peak image.
 
+    The tensors are symmetric, so we can use np.linalg.eigh instead of np.linalg.eig. It is run on all non-zero
+    tensors of all bundles at once (in chunks of chunk_size tensors to limit memory).
+    Runtime for 4 bundles on 145x174x145 image: np.linalg.eig per bundle: 48s, np.linalg.eigh: 7s. The peaks are the
+    same, only their sign can differ (the sign of an eigenvector is arbitrary).
+
     Args:
         tensors: shape: [x,y,z,nr_peaks*6]
+        chunk_size: number of tensors passed to np.linalg.eigh at once
 
     Returns:
         peaks with shape: [x,y,z, nr_peaks*3]
     """
-
-    def _tensor_to_peak(tensor):
-        t_matrix = flat_tensor_to_matrix_tensor(tensor)
-
-        val, vec = np.linalg.eig(t_matrix)  # get eigenvalues and eigenvectors
-        argmax = val.argmax(axis=-1)  # get largest eigenvalue [x,y,z]
-        max = val.max(axis=-1)
-
-        vec2 = vec.transpose(4, 0, 1, 2, 3)  # [3,x,y,z,3]  (bring list of eigenvectors to first dim)
-
-        # select eigenvector with largest eigenvalue
-        x, y, z = (vec2.shape[1], vec2.shape[2], vec2.shape[3])
-        peak = vec2[tuple([argmax] + np.ogrid[:x, :y, :z])]
-
-        # peak[max == 0] = 0  # remove eigenvecs where eigenvalue is zero (everywhere outside of bundle)
-        peak *= max[..., None]  # scale by eigenvalue (otherwise all have equal length)
-        return peak
-
     nr_tensors = int(tensors.shape[3] / 6)
-    peaks = np.zeros(tensors.shape[:3] + (nr_tensors * 3,), dtype=np.float32)
-    for idx in range(nr_tensors):
-        peak = _tensor_to_peak(tensors[..., idx * 6:(idx * 6) + 6])
-
-        # filter small peaks
-        mask = np.linalg.norm(peak, axis=-1) < 0.001  # 0.001 does not really filter anything
-        peak[mask] = 0
-
-        peaks[..., idx * 3:(idx * 3) + 3] = peak
-    return peaks
+    tensors_flat = tensors.reshape(-1, 6)  # [x*y*z*nr_peaks, 6]
+    peaks = np.zeros((tensors_flat.shape[0], 3), dtype=np.float32)
+
+    # Zero tensors (everywhere outside of bundle) result in zero peaks -> skip them
+    nonzero_idxs = np.nonzero(np.any(tensors_flat != 0, axis=-1))[0]
+    for idx in range(0, len(nonzero_idxs), chunk_size):
+        idxs = nonzero_idxs[idx:idx + chunk_size]
+        t_matrix = flat_tensor_to_matrix_tensor(tensors_flat[idxs])  # [n,3,3]
+        val, vec = np.linalg.eigh(t_matrix)  # eigenvalues in ascending order
+        # select eigenvector with largest eigenvalue and scale by eigenvalue (otherwise all have equal length)
+        peaks[idxs] = vec[:, :, -1] * val[:, -1:]
+
+    # filter small peaks
+    mask = np.linalg.norm(peaks, axis=-1) < 0.001  # 0.001 does not really filter anything
+    peaks[mask] = 0
+
+    return peaks.reshape(tensors.shape[:3] + (nr_tensors * 3,))
 
 
 def peaks_to_tensors(peaks):
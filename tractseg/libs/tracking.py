@@ -3,30 +3,71 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import tempfile
 import shutil
 import subprocess
+import multiprocessing
+from functools import partial
 
+import psutil
 import nibabel as nib
 import numpy as np
+from tqdm import tqdm
+from scipy.ndimage.morphology import binary_dilation
 
 from tractseg.libs import fiber_utils
 from tractseg.libs import img_utils
 from tractseg.libs import tractseg_prob_tracking
+from tractseg.libs import tractseg_det_tracking
 from tractseg.libs import peak_utils
 
+global _WORKER_POOL
+_WORKER_POOL = None
 
-def _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus):
+
+def _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus, pool=None):
     ref_img = nib.load(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz")
     reference_affine = ref_img.affine
     reference_shape = ref_img.get_fdata().shape[:3]
     fiber_utils.convert_tck_to_trk(output_dir + "/" + tracking_folder + "/" + bundle + ".tck",
                                    output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
                                    reference_affine, reference_shape, compress_err_thr=0.1, smooth=None,
-                                   nr_cpus=nr_cpus, tracking_format=output_format)
+                                   nr_cpus=nr_cpus, tracking_format=output_format, pool=pool)
     subprocess.call("rm -f " + output_dir + "/" + tracking_folder + "/" + bundle + ".tck", shell=True)
 
 
+def _load_dilated_mask(filename, dilation):
+    """
+    Same as img_utils.dilate_binary_mask, but without saving the mask to disk.
+    """
+    data = nib.load(filename).get_fdata()
+    if dilation > 0:
+        data = binary_dilation(data, iterations=dilation)
+    return (data > 0.5).astype(np.uint8)
+
+
+def _save_tractseg_det_tracking(streamlines, output_dir, tracking_folder, bundle, output_format, reference_img,
+                                nr_cpus, pool=None):
+    """
+    Save output of tractseg_det_tracking. Same postprocessing as for tck files from Mrtrix (see _mrtrix_tck_to_trk).
+    """
+    reference_shape = reference_img.shape[:3]
+    if output_format == "tck":
+        fiber_utils.save_streamlines(output_dir + "/" + tracking_folder + "/" + bundle + ".tck",
+                                     streamlines, reference_img.affine, reference_shape)
+        return
+
+    #Compressing also good to remove checkerboard artefacts from tracking on peaks
+    streamlines = fiber_utils.compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=nr_cpus, pool=pool)
+    if output_format == "trk_legacy":
+        fiber_utils.save_streamlines_as_trk_legacy(output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
+                                                   streamlines, reference_img.affine, reference_shape)
+    else:
+        fiber_utils.save_streamlines(output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
+                                     streamlines, reference_img.affine, reference_shape)
+
+
 def get_tracking_folder_name(tracking_algorithm, use_best_original_peaks):
     if tracking_algorithm == "FACT":
         tracking_folder = "Peaks_FACT_trackings"
@@ -45,7 +86,8 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
           use_best_original_peaks=False, use_as_prior=False, filter_by_endpoints=True,
           tracking_folder="auto", dir_postfix="", dilation=1,
           next_step_displacement_std=0.15,
-          output_format="trk", nr_fibers=2000, nr_cpus=-1):
+          output_format="trk", nr_fibers=2000, nr_cpus=-1, pool=None, orig_peaks_img=None,
+          adaptive_seeding=False, save_seeding_stats=False):
 
     ################### Preparing ###################
 
@@ -62,10 +104,12 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
 
     # Misc
     subprocess.call("export PATH=/code/mrtrix3/bin:$PATH", shell=True)
-    subprocess.call("mkdir -p " + output_dir + "/" + tracking_folder, shell=True)
+    if not os.path.exists(output_dir + "/" + tracking_folder):
+        os.makedirs(output_dir + "/" + tracking_folder)
     tmp_dir = tempfile.mkdtemp()
 
     # Check if bundle masks are valid
+    bundle_mask_ok = beginnings_mask_ok = endings_mask_ok = True
     if filter_by_endpoints:
         bundle_mask_ok = nib.load(output_dir + "/bundle_segmentations" + dir_postfix
                                   + "/" + bundle + ".nii.gz").get_fdata().max() > 0
@@ -126,7 +170,8 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                     " -select " + str(nr_fibers) + " -cutoff 0.05 -force" + nthreads,
                                     shell=True)
                     if output_format == "trk" or output_format == "trk_legacy":
-                        _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
+                        _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus,
+                                           pool)
 
                 else:
                     # FACT tracking on TOMs
@@ -143,7 +188,8 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                         " -force -quiet" + nthreads,
                                         shell=True)
                         if output_format == "trk" or output_format == "trk_legacy":
-                            _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
+                            _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus,
+                                               pool)
 
                     # iFOD2 tracking on TOMs
                     elif tracking_algorithm == "iFOD2":
@@ -162,12 +208,28 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                         " -force -quiet" + nthreads,
                                         shell=True)
                         if output_format == "trk" or output_format == "trk_legacy":
-                            _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
+                            _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus,
+                                               pool)
 
                     else:
                         raise ValueError("Unknown tracking algorithm: {}".format(tracking_algorithm))
 
 
+            # TractSeg deterministic tracking (FACT) on TOMs
+            elif tracking_algorithm == "FACT":
+                tom_peaks_img = nib.load(output_dir + "/" + TOM_folder + "/" + bundle + ".nii.gz")
+                bundle_mask = _load_dilated_mask(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle +
+                                                 ".nii.gz", dilation)
+                beginnings = _load_dilated_mask(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz",
+                                                dilation + 1)
+                endings = _load_dilated_mask(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz",
+                                             dilation + 1)
+                streamlines = tractseg_det_tracking.track(tom_peaks_img.get_fdata(), tom_peaks_img.affine,
+                                                          max_nr_fibers=nr_fibers, seed_mask=bundle_mask,
+                                                          mask=bundle_mask, include_masks=[beginnings, endings])
+                _save_tractseg_det_tracking(streamlines, output_dir, tracking_folder, bundle, output_format,
+                                            tom_peaks_img, nr_cpus, pool)
+
             # TractSeg probabilistic tracking
             else:
 
@@ -193,9 +255,10 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
 
                 #Get best original peaks
                 if use_best_original_peaks:
-                    orig_peaks_img = nib.load(peaks)
-                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(orig_peaks_img.get_fdata(),
-                                                                                   orig_peaks_img.affine)
+                    if orig_peaks_img is None:
+                        orig_peaks_img = nib.load(peaks)
+                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(
+                        orig_peaks_img.get_fdata(dtype=np.float32), orig_peaks_img.affine)
                     best_orig_peaks = fiber_utils.get_best_original_peaks(tom_peaks, orig_peaks)
                     for axis in flip_axis:
                         best_orig_peaks = img_utils.flip_axis(best_orig_peaks, axis)
@@ -205,9 +268,10 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
 
                 #Get weighted mean between best original peaks and TOMs
                 if use_as_prior:
-                    orig_peaks_img = nib.load(peaks)
-                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(orig_peaks_img.get_fdata(),
-                                                                                   orig_peaks_img.affine)
+                    if orig_peaks_img is None:
+                        orig_peaks_img = nib.load(peaks)
+                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(
+                        orig_peaks_img.get_fdata(dtype=np.float32), orig_peaks_img.affine)
                     best_orig_peaks = fiber_utils.get_best_original_peaks(tom_peaks, orig_peaks)
                     weighted_peaks = fiber_utils.get_weighted_mean_of_peaks(best_orig_peaks, tom_peaks, weight=0.5)
                     for axis in flip_axis:
@@ -225,21 +289,38 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                                            next_step_displacement_std=next_step_displacement_std,
                                                            nr_cpus=nr_cpus, affine=bundle_mask_img.affine,
                                                            spacing=bundle_mask_img.header.get_zooms()[0],
-                                                           verbose=False)
+                                                           verbose=False, pool=pool,
+                                                           adaptive_seeding=adaptive_seeding,
+                                                           return_seeding_stats=True, return_weights=True,
+                                                           lazy=True)
+                streamlines, seeding_stats, weights = streamlines
 
+                # Streamlines are tracked while writing them (see tractseg_prob_tracking.track)
                 if output_format == "trk_legacy":
                     fiber_utils.save_streamlines_as_trk_legacy(output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
                                                                streamlines, bundle_mask_img.affine,
-                                                               bundle_mask_img.get_fdata().shape)
+                                                               bundle_mask_img.shape)
                 else:  # tck or trk (determined by file ending)
                     fiber_utils.save_streamlines(
                         output_dir + "/" + tracking_folder + "/" + bundle + "." + output_format,
                         streamlines, bundle_mask_img.affine,
-                        bundle_mask_img.get_fdata().shape)
+                        bundle_mask_img.shape)
+
+                if adaptive_seeding:
+                    # Adaptive seeding under-represents streamlines from voxels with a low acceptance rate. The
+                    # weights correct for this (format of MRtrix -tck_weights_in).
+                    np.savetxt(output_dir + "/" + tracking_folder + "/" + bundle + "_weights.txt", weights,
+                               fmt="%.6f")
+
+                if save_seeding_stats:
+                    for axis in flip_axis:
+                        seeding_stats = img_utils.flip_axis(seeding_stats, axis)
+                    nib.save(nib.Nifti1Image(seeding_stats, bundle_mask_img.affine),
+                             output_dir + "/" + tracking_folder + "/" + bundle + "_seeding_stats.nii.gz")
 
 
         # No streamline filtering
-        else:
+        elif tracking_software == "mrtrix":
 
             peak_utils.peak_image_to_binary_mask_path(peaks, tmp_dir + "/peak_mask.nii.gz",
                                                       peak_length_threshold=0.01)
@@ -253,7 +334,113 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                             " -force -quiet" + nthreads, shell=True)
 
             if output_format == "trk" or output_format == "trk_legacy":
-                _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
+                _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus, pool)
+
+        # No streamline filtering: FACT tracking on TOMs (in-process)
+        else:
+            peak_mask = peak_utils.peak_image_to_binary_mask(nib.load(peaks).get_fdata(), len_thr=0.01).any(axis=-1)
+            tom_peaks_img = nib.load(output_dir + "/" + TOM_folder + "/" + bundle + ".nii.gz")
+            streamlines = tractseg_det_tracking.track(tom_peaks_img.get_fdata(), tom_peaks_img.affine,
+                                                      max_nr_fibers=nr_fibers, seed_mask=peak_mask)
+            _save_tractseg_det_tracking(streamlines, output_dir, tracking_folder, bundle, output_format,
+                                        tom_peaks_img, nr_cpus, pool)
 
 
     shutil.rmtree(tmp_dir)
+
+
+def _estimate_tracking_cost(bundle, output_dir, dir_postfix, nr_fibers):
+    bundle_mask_path = output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz"
+    if not os.path.exists(bundle_mask_path):
+        return 0  # not needed if not filtering by endpoints
+    return np.count_nonzero(nib.load(bundle_mask_path).get_fdata()) * nr_fibers
+
+
+def _init_bundle_worker():
+    """
+    Each worker of track_bundles tracks with one cpu. The same (thread) pool is reused for all bundles of this worker.
+    """
+    global _WORKER_POOL
+    _WORKER_POOL = tractseg_prob_tracking.create_pool(1)
+
+
+def _track_bundle_job(bundle, orig_peaks_path=None, orig_peaks_affine=None, **kwargs):
+    """
+    Tracking of one bundle in a worker of track_bundles.
+    """
+    orig_peaks_img = None
+    if orig_peaks_path is not None:
+        # All workers memory map the same float32 copy
+        orig_peaks_img = nib.Nifti1Image(np.load(orig_peaks_path, mmap_mode="r"), orig_peaks_affine)
+    track(bundle, nr_cpus=1, pool=_WORKER_POOL, orig_peaks_img=orig_peaks_img, **kwargs)
+    return bundle
+
+
+def track_bundles(bundles, peaks, output_dir, tracking_on_FODs, tracking_software, tracking_algorithm,
+                  use_best_original_peaks=False, use_as_prior=False, filter_by_endpoints=True,
+                  tracking_folder="auto", dir_postfix="", dilation=1,
+                  next_step_displacement_std=0.15,
+                  output_format="trk", nr_fibers=2000, nr_cpus=-1, adaptive_seeding=False,
+                  save_seeding_stats=False):
+    """
+    Track several bundles (see track() for arguments).
+
+    If there are at least as many bundles as cpus, several bundles are tracked at the same time (one cpu per
+    bundle). The bundles with the highest estimated cost (nr of voxels in bundle mask * nr_fibers) are started first,
+    so that in the end the small bundles fill up the cpus which are idle. The input peaks are only loaded once and
+    all workers memory map the same float32 copy. Each worker reuses the same (thread) pool for all of its bundles.
+
+    Otherwise the bundles are tracked one after another using all cpus for each bundle.
+    """
+    nr_processes = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    load_orig_peaks = tracking_software == "tractseg" and tracking_algorithm == "fixed_prob" and \
+        filter_by_endpoints and (use_best_original_peaks or use_as_prior)
+    kwargs = {"peaks": peaks, "output_dir": output_dir, "tracking_on_FODs": tracking_on_FODs,
+              "tracking_software": tracking_software, "tracking_algorithm": tracking_algorithm,
+              "use_best_original_peaks": use_best_original_peaks, "use_as_prior": use_as_prior,
+              "filter_by_endpoints": filter_by_endpoints, "tracking_folder": tracking_folder,
+              "dir_postfix": dir_postfix, "dilation": dilation,
+              "next_step_displacement_std": next_step_displacement_std, "output_format": output_format,
+              "nr_fibers": nr_fibers, "adaptive_seeding": adaptive_seeding,
+              "save_seeding_stats": save_seeding_stats}
+
+    if nr_processes <= 1 or len(bundles) < nr_processes:
+        # Same workers for tracking and compressing streamlines of all bundles
+        pool = tractseg_prob_tracking.create_pool(nr_cpus)
+        orig_peaks_img = nib.load(peaks) if load_orig_peaks else None  # data is cached after first get_fdata()
+        try:
+            for bundle in tqdm(bundles):
+                track(bundle, nr_cpus=nr_cpus, pool=pool, orig_peaks_img=orig_peaks_img, **kwargs)
+        finally:
+            pool.terminate()
+            pool.join()
+        return
+
+    # Biggest bundles first
+    costs = [_estimate_tracking_cost(bundle, output_dir, dir_postfix, nr_fibers) for bundle in bundles]
+    bundles = [bundles[idx] for idx in np.argsort(costs, kind="stable")[::-1]]
+
+    orig_peaks = None
+    if load_orig_peaks:
+        orig_peaks_img = nib.load(peaks)
+        orig_peaks = orig_peaks_img.get_fdata(dtype=np.float32)
+        kwargs["orig_peaks_affine"] = orig_peaks_img.affine
+    tmp_dir = tempfile.mkdtemp(dir=tractseg_prob_tracking.get_shared_tmp_dir(0 if orig_peaks is None
+                                                                              else orig_peaks.nbytes))
+    try:
+        if orig_peaks is not None:
+            kwargs["orig_peaks_path"] = os.path.join(tmp_dir, "orig_peaks.npy")
+            np.save(kwargs["orig_peaks_path"], orig_peaks)
+            del orig_peaks
+
+        pool = multiprocessing.Pool(processes=nr_processes, initializer=_init_bundle_worker)
+        try:
+            # chunksize=1: next bundle is only assigned to a worker when it is idle
+            for _ in tqdm(pool.imap_unordered(partial(_track_bundle_job, **kwargs), bundles, chunksize=1),
+                          total=len(bundles)):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
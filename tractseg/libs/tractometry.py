@@ -3,9 +3,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
+import os
+from os.path import join
+import multiprocessing
+from functools import partial
 
+import psutil
 import numpy as np
+import nibabel as nib
+from nibabel import trackvis
+from tqdm import tqdm
 from scipy.ndimage.morphology import binary_dilation
 from scipy.ndimage.interpolation import map_coordinates
 from dipy.segment.clustering import QuickBundles
@@ -19,6 +26,37 @@ import dipy.stats.analysis as dsa
 from tractseg.libs import fiber_utils
 
 
+def _aggregate_by_segment(values, segment_idxs, fill_values=None):
+    """
+    Mean and std of all values with the same segment index.
+
+    The values of each segment are kept in their original order and reduced with np.mean / np.std, so the results
+    are exactly the same as when collecting the values of each segment in a list.
+
+    Args:
+        values: 1d array of values
+        segment_idxs: 1d array with segment index of each value
+        fill_values: dict {segment_idx: value} used for segments which do not have any values
+
+    Returns:
+        list of means, list of stds (sorted by segment index)
+    """
+    order = np.argsort(segment_idxs, kind="stable")
+    keys, starts = np.unique(segment_idxs[order], return_index=True)
+    segments = dict(zip(keys, np.split(values[order], starts[1:])))
+    if fill_values is not None:
+        for key, value in fill_values.items():
+            if key not in segments:
+                segments[key] = np.array([value])
+
+    results_mean = []
+    results_std = []
+    for key in sorted(segments.keys()):
+        results_mean.append(segments[key].mean())
+        results_std.append(segments[key].std())
+    return results_mean, results_std
+
+
 def _get_length_best_orig_peak(predicted_img, orig_img, x, y, z):
     predicted = predicted_img[x, y, z, :]       # 1 peak
     orig = [orig_img[x, y, z, 0:3], orig_img[x, y, z, 3:6], orig_img[x, y, z, 6:9]]     # 3 peaks
@@ -46,6 +84,84 @@ def _orient_to_same_start_region(streamlines, beginnings):
     return streamlines_new
 
 
+def _prepare_streamlines(streamlines, beginnings, dilate, affine):
+    """
+    Transform streamlines to voxel space and orient them to all start in the (dilated) beginnings region.
+    """
+    streamlines = list(transform_streamlines(streamlines, np.linalg.inv(affine)))
+
+    for i in range(dilate):
+        beginnings = binary_dilation(beginnings)
+    beginnings = beginnings.astype(np.uint8)
+    return _orient_to_same_start_region(streamlines, beginnings)
+
+
+def _get_peak_length_img(peaks_img, predicted_peaks):
+    best_orig_peaks = fiber_utils.get_best_original_peaks(predicted_peaks, peaks_img, peak_len_thr=0.00001)
+    return np.linalg.norm(best_orig_peaks, axis=-1)
+
+
+def _get_distance_map_segments(streamlines, nr_points):
+    """
+    Resample the streamlines to nr_points and assign each point to the closest point of the centroid (QuickBundles).
+
+    Returns:
+        sampling coordinates [3, nr_points, nr_streamlines], segment of each point [nr_streamlines, nr_points] and
+        centroid coordinates [3, nr_points, 1]
+    """
+    streamlines = fiber_utils.resample_fibers(streamlines, nb_points=nr_points)
+
+    metric = AveragePointwiseEuclideanMetric()
+    qb = QuickBundles(threshold=100., metric=metric)
+    clusters = qb.cluster(streamlines)
+    centroids = Streamlines(clusters.centroids)
+    if len(centroids) > 1:
+        print("WARNING: number clusters > 1 ({})".format(len(centroids)))
+    _, segment_idxs = cKDTree(centroids.data, 1, copy_data=True).query(streamlines, k=1)  # (2000, 100)
+
+    return np.array(streamlines).T, segment_idxs, np.array([centroids[0]]).T
+
+
+def _evaluate_distance_map_segments(scalar_img, segments, nr_points):
+    coords, segment_idxs, centroid_coords = segments
+    values = map_coordinates(scalar_img, coords, order=1)
+    values_t = np.array(values).T  # (2000, 100)
+
+    # If we want to take weighted mean like in AFQ:
+    # weights = dsa.gaussian_weights(Streamlines(streamlines))
+    # values_t = weights * values_t
+    # return np.sum(values_t, 0), None
+
+    fill_values = None
+    if len(np.unique(segment_idxs)) < nr_points:
+        print("WARNING: found less than required points. Filling up with centroid values.")
+        centroid_values = map_coordinates(scalar_img, centroid_coords, order=1)
+        fill_values = dict(zip(range(nr_points), np.array(centroid_values).T[0]))
+
+    return _aggregate_by_segment(values_t.ravel(), segment_idxs.ravel(), fill_values)
+
+
+def get_segments(streamlines, beginnings, nr_points, dilate=0, affine=None):
+    """
+    Sampling points along the streamlines and the segment each of them belongs to (distance_map approach of
+    evaluate_along_streamlines). Only depends on the tractogram, so it can be calculated once and then be used for
+    several scalar images with the same affine (see evaluate_segments).
+    """
+    streamlines = _prepare_streamlines(streamlines, beginnings, dilate, affine)
+    return _get_distance_map_segments(streamlines, nr_points)
+
+
+def evaluate_segments(scalar_img, segments, nr_points, predicted_peaks=None):
+    """
+    Mean and std of scalar_img for each segment (segments from get_segments). Same result as
+    evaluate_along_streamlines.
+    """
+    if predicted_peaks is not None:
+        # scalar img can also be orig peaks
+        scalar_img = _get_peak_length_img(scalar_img, predicted_peaks)
+    return _evaluate_distance_map_segments(scalar_img, segments, nr_points)
+
+
 def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, dilate=0, predicted_peaks=None,
                                affine=None):
     # Runtime:
@@ -56,16 +172,10 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
     # - AFQ:                      ?s (test),     ?s (all),      85s  (test 4 bundles, 100 points)
     # => AFQ a lot slower than others
 
-    streamlines = list(transform_streamlines(streamlines, np.linalg.inv(affine)))
-
-    for i in range(dilate):
-        beginnings = binary_dilation(beginnings)
-    beginnings = beginnings.astype(np.uint8)
-    streamlines = _orient_to_same_start_region(streamlines, beginnings)
+    streamlines = _prepare_streamlines(streamlines, beginnings, dilate, affine)
     if predicted_peaks is not None:
         # scalar img can also be orig peaks
-        best_orig_peaks = fiber_utils.get_best_original_peaks(predicted_peaks, scalar_img, peak_len_thr=0.00001)
-        scalar_img = np.linalg.norm(best_orig_peaks, axis=-1)
+        scalar_img = _get_peak_length_img(scalar_img, predicted_peaks)
 
     algorithm = "distance_map"  # equal_dist | distance_map | cutting_plane | afq
 
@@ -81,51 +191,8 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
 
 
     if algorithm == "distance_map":  # cKDTree
-
-        ### Sampling ###
-        streamlines = fiber_utils.resample_fibers(streamlines, nb_points=nr_points)
-        values = map_coordinates(scalar_img, np.array(streamlines).T, order=1)
-
-        ### Aggregating by cKDTree approach ###
-        metric = AveragePointwiseEuclideanMetric()
-        qb = QuickBundles(threshold=100., metric=metric)
-        clusters = qb.cluster(streamlines)
-        centroids = Streamlines(clusters.centroids)
-        if len(centroids) > 1:
-            print("WARNING: number clusters > 1 ({})".format(len(centroids)))
-        _, segment_idxs = cKDTree(centroids.data, 1, copy_data=True).query(streamlines, k=1)  # (2000, 100)
-
-        values_t = np.array(values).T  # (2000, 100)
-
-        # If we want to take weighted mean like in AFQ:
-        # weights = dsa.gaussian_weights(Streamlines(streamlines))
-        # values_t = weights * values_t
-        # return np.sum(values_t, 0), None
-
-        results_dict = defaultdict(list)
-        for idx, sl in enumerate(values_t):
-            for jdx, seg in enumerate(sl):
-                results_dict[segment_idxs[idx, jdx]].append(seg)
-
-        if len(results_dict.keys()) < nr_points:
-            print("WARNING: found less than required points. Filling up with centroid values.")
-            centroid_values = map_coordinates(scalar_img, np.array([centroids[0]]).T, order=1)
-            for i in range(nr_points):
-                if len(results_dict[i]) == 0:
-                    results_dict[i].append(np.array(centroid_values).T[0, i])
-
-        results_mean = []
-        results_std = []
-        for key in sorted(results_dict.keys()):
-            value = results_dict[key]
-            if len(value) > 0:
-                results_mean.append(np.array(value).mean())
-                results_std.append(np.array(value).std())
-            else:
-                print("WARNING: empty segment")
-                results_mean.append(0)
-                results_std.append(0)
-        return results_mean, results_std
+        segments = _get_distance_map_segments(streamlines, nr_points)
+        return _evaluate_distance_map_segments(scalar_img, segments, nr_points)
 
 
     elif algorithm == "cutting_plane":
@@ -138,7 +205,7 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         ### Sampling ###
         streamlines = fiber_utils.resample_to_same_distance(streamlines, max_nr_points=nr_points)
         # map_coordinates does not allow streamlines with different lengths -> use values_from_volume
-        values = np.array(values_from_volume(scalar_img, streamlines, affine=np.eye(4))).T
+        values = values_from_volume(scalar_img, streamlines, affine=np.eye(4))
 
         ### Aggregating by Cutting Plane approach ###
         # Resample to all fibers having same number of points -> needed for QuickBundles
@@ -155,16 +222,10 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         segment_idxs = fiber_utils.get_idxs_of_closest_points(streamlines, middle_point)
 
         # Align along the middle and assign indices
-        segment_idxs_eqlen = []
+        # indices for one streamline e.g. [998, 999, 1000, 1001, 1002, 1003]; 1000 is middle
         base_idx = 1000  # use higher index to avoid negative numbers for area below middle
-        for idx, sl in enumerate(streamlines):
-            sl_middle_pos = segment_idxs[idx]
-            before_elems = sl_middle_pos
-            after_elems = len(sl) - sl_middle_pos
-            # indices for one streamline e.g. [998, 999, 1000, 1001, 1002, 1003]; 1000 is middle
-            r = range((base_idx - before_elems), (base_idx + after_elems))
-            segment_idxs_eqlen.append(r)
-        segment_idxs = segment_idxs_eqlen
+        segment_idxs = [np.arange(base_idx - sl_middle_pos, base_idx - sl_middle_pos + len(sl))
+                        for sl, sl_middle_pos in zip(streamlines, segment_idxs)]
 
         # Calcuate maximum number of indices to not result in more indices than nr_points.
         # (this could be case if one streamline is very off-center and therefore has a lot of points only on one
@@ -172,37 +233,23 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         max_idx = base_idx + int(nr_points / 2)
         min_idx = base_idx - int(nr_points / 2)
 
-        # Group by segment indices
-        results_dict = defaultdict(list)
-        for idx, sl in enumerate(values):
-            for jdx, seg in enumerate(sl):
-                current_idx = segment_idxs[idx][jdx]
-                if current_idx >= min_idx and current_idx < max_idx:
-                    results_dict[current_idx].append(seg)
+        # Group by segment indices (same order as values)
+        segment_idxs = np.concatenate([segment_idxs[idx][:len(sl)] for idx, sl in enumerate(values)])
+        values = np.concatenate([np.asarray(sl) for sl in values])
+        inside = (segment_idxs >= min_idx) & (segment_idxs < max_idx)
+        values = values[inside]
+        segment_idxs = segment_idxs[inside]
 
         # If values missing fill up with centroid values
-        if len(results_dict.keys()) < nr_points:
+        fill_values = None
+        if len(np.unique(segment_idxs)) < nr_points:
             print("WARNING: found less than required points. Filling up with centroid values.")
             centroid_sl = [centroids[0]]
             centroid_sl = np.array(centroid_sl).T
             centroid_values = map_coordinates(scalar_img, centroid_sl, order=1)
-            for idx, seg_idx in enumerate(range(min_idx, max_idx)):
-                if len(results_dict[seg_idx]) == 0:
-                    results_dict[seg_idx].append(np.array(centroid_values).T[0, idx])
-
-        # Aggregate by mean
-        results_mean = []
-        results_std = []
-        for key in sorted(results_dict.keys()):
-            value = results_dict[key]
-            if len(value) > 0:
-                results_mean.append(np.array(value).mean())
-                results_std.append(np.array(value).std())
-            else:
-                print("WARNING: empty segment")
-                results_mean.append(0)
-                results_std.append(0)
-        return results_mean, results_std
+            fill_values = dict(zip(range(min_idx, max_idx), np.array(centroid_values).T[0]))
+
+        return _aggregate_by_segment(values, segment_idxs, fill_values)
 
 
     elif algorithm == "afq":
@@ -213,3 +260,116 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         results_mean = dsa.afq_profile(scalar_img, streamlines, affine=np.eye(4), weights=weights)
         results_std = np.zeros(nr_points)
         return results_mean, results_std
+
+
+def load_streamlines(trk_path, tracking_format="trk_legacy"):
+    if tracking_format == "trk_legacy":
+        streams, hdr = trackvis.read(trk_path)
+        return [s[0] for s in streams]
+    return nib.streamlines.load(trk_path).streamlines
+
+
+def evaluate_subject(tracking_dir, endings_dir, scalar_img_paths, bundles, nr_points, dilation=2,
+                     tracking_format="trk_legacy", TOM_dir=None, min_nr_streamlines=5, show_progress=False):
+    """
+    Tractometry of several bundles of one subject for several scalar images.
+
+    Each tractogram and endings mask is only loaded once. The segments along the streamlines (resampling, QuickBundles
+    centroid, cKDTree) are calculated once per bundle and all scalar images are sampled at the same points.
+
+    Args:
+        tracking_dir: folder containing the tractograms
+        endings_dir: folder containing the endings segmentations
+        scalar_img_paths: list of scalar images (e.g. FA, MD). Peak images if TOM_dir is set.
+        bundles: list of bundle names
+        nr_points: number of segments along each bundle
+        dilation: dilation of the beginnings masks
+        tracking_format: tck | trk | trk_legacy
+        TOM_dir: folder containing the TOMs. If set, the length of the peak pointing in the same direction as the TOM
+            is evaluated instead of the value of the scalar image.
+        min_nr_streamlines: bundles with less streamlines are set to 0
+        show_progress: show progress bar over bundles
+
+    Returns:
+        means, stds: [nr_scalar_imgs, nr_bundles, nr_points]
+    """
+    scalar_imgs = [nib.load(path) for path in scalar_img_paths]
+    scalar_data = [np.nan_to_num(img.get_fdata()) for img in scalar_imgs]
+    file_ending = "trk" if tracking_format == "trk_legacy" else tracking_format
+
+    means = np.zeros((len(scalar_imgs), len(bundles), nr_points))
+    stds = np.zeros((len(scalar_imgs), len(bundles), nr_points))
+    for b_idx, bundle in enumerate(tqdm(bundles, disable=not show_progress)):
+        trk_path = join(tracking_dir, bundle + "." + file_ending)
+        if not os.path.exists(trk_path):
+            print("WARNING: No tracking found for bundle {}. Returning zeros.".format(bundle))
+            continue
+        streamlines = load_streamlines(trk_path, tracking_format)
+        if len(streamlines) < min_nr_streamlines:
+            print("WARNING: bundle {} contains less than {} streamlines. Saving value 0 for this bundle.".
+                  format(bundle, min_nr_streamlines))
+            continue
+
+        beginnings = nib.load(join(endings_dir, bundle + "_b.nii.gz")).get_fdata()
+        predicted_peaks = None
+        if TOM_dir is not None:
+            predicted_peaks = nib.load(join(TOM_dir, bundle + ".nii.gz")).get_fdata()
+
+        segments = {}  # segments only depend on the affine of the scalar image
+        for s_idx, (img, data) in enumerate(zip(scalar_imgs, scalar_data)):
+            key = img.affine.tobytes()
+            if key not in segments:
+                segments[key] = get_segments(streamlines, beginnings, nr_points, dilate=dilation, affine=img.affine)
+            means[s_idx, b_idx], stds[s_idx, b_idx] = evaluate_segments(data, segments[key], nr_points,
+                                                                        predicted_peaks=predicted_peaks)
+    return means, stds
+
+
+def _evaluate_subject_job(subject, tracking_dir, endings_dir, scalar_img_paths, bundles, nr_points, TOM_dir=None,
+                          **kwargs):
+    """
+    Tractometry of one subject in a worker of evaluate_subjects. If the subject can not be evaluated (e.g. missing
+    scalar image or endings mask) means and stds are None.
+    """
+    def subject_path(path):
+        return None if path is None else path.replace("SUBJECT_ID", subject)
+
+    try:
+        means, stds = evaluate_subject(subject_path(tracking_dir), subject_path(endings_dir),
+                                       [subject_path(path) for path in scalar_img_paths], bundles, nr_points,
+                                       TOM_dir=subject_path(TOM_dir), **kwargs)
+    except Exception as e:
+        print("WARNING: Tractometry failed for subject {} ({}: {}).".format(subject, type(e).__name__, e))
+        means, stds = None, None
+    return subject, means, stds
+
+
+def evaluate_subjects(subjects, tracking_dir, endings_dir, scalar_img_paths, bundles, nr_points, nr_cpus=-1,
+                      **kwargs):
+    """
+    Run evaluate_subject for several subjects in parallel (one subject per cpu).
+
+    "SUBJECT_ID" in tracking_dir, endings_dir, scalar_img_paths and TOM_dir gets replaced by each subject ID (e.g.
+    "/data/SUBJECT_ID/tractseg_output/TOM_trackings").
+
+    For subjects which can not be evaluated (e.g. missing scalar image) means and stds are None.
+
+    Returns:
+        generator of (subject, means, stds) in the order of subjects (see evaluate_subject)
+    """
+    job = partial(_evaluate_subject_job, tracking_dir=tracking_dir, endings_dir=endings_dir,
+                  scalar_img_paths=scalar_img_paths, bundles=bundles, nr_points=nr_points, **kwargs)
+    nr_processes = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    nr_processes = min(nr_processes, len(subjects))
+    if nr_processes <= 1:
+        for subject in subjects:
+            yield job(subject)
+        return
+
+    pool = multiprocessing.Pool(processes=nr_processes)
+    try:
+        for result in pool.imap(job, subjects, chunksize=1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
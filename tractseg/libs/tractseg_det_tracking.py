@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def _get_voxel_idxs(points, shape):
+    """
+    Nearest voxel of points (voxel centers at integer coordinates like in MRtrix) and if they are inside of the image.
+    """
+    idxs = np.floor(points + 0.5).astype(np.int64)
+    inside = np.all((idxs >= 0) & (idxs < np.array(shape[:3])), axis=1)
+    return idxs, inside
+
+
+def _get_at_idxs(img, idxs):
+    return img[idxs[:, 0], idxs[:, 1], idxs[:, 2]]
+
+
+def process_seedpoints(seed_points, peaks, affine, step_size, min_length, max_length, peak_len_thr=0.1,
+                       mask=None, include_masks=None):
+    """
+    Create FACT streamlines from several seed points.
+
+    Same as MRtrix FACT: In each step the peak of the nearest voxel is looked up and a step of step_size is done in
+    this direction (flipped if not aligned with the last step). Tracking is done in both directions of each seed point.
+    All streamlines are tracked at the same time (see tractseg_prob_tracking.process_seedpoints).
+
+    A streamline stops if the peak length is below peak_len_thr, if it would leave the image or the mask or if it
+    gets longer than max_length. It is accepted if its length is between min_length and max_length and it passes
+    through each of the include_masks.
+
+    Args:
+        seed_points: array of 3d points in voxel space [nr_seeds, 3]
+        peaks: [x, y, z, 3] peaks in coordinate space (like in MRtrix)
+        affine: voxel to coordinate space transformation
+        step_size: in mm
+        min_length: in mm
+        max_length: in mm
+        peak_len_thr: minimal length of peak to continue tracking
+        mask: binary mask [x, y, z] or None
+        include_masks: list of binary masks [x, y, z]
+
+    Returns:
+        list of streamlines in coordinate space
+    """
+    if include_masks is None:
+        include_masks = []
+    shape = peaks.shape[:3]
+    inv_rotation = np.linalg.inv(affine[:3, :3])
+    max_nr_steps = int(max_length / step_size) + 1
+
+    seed_points = np.asarray(seed_points, dtype=np.float64)
+    nr_seeds = len(seed_points)
+
+    # Streamline idx < nr_seeds: forward direction; idx >= nr_seeds: backward direction of same seed point
+    points = np.concatenate([seed_points, seed_points])
+    reverse = np.arange(2 * nr_seeds) >= nr_seeds
+    last_dirs = np.zeros(points.shape)
+    sl_lens = np.zeros(2 * nr_seeds)
+    running = np.arange(2 * nr_seeds)
+
+    idxs, inside = _get_voxel_idxs(points, shape)
+    idxs[~inside] = 0
+    included = [(_get_at_idxs(include_mask, idxs) != 0) & inside for include_mask in include_masks]
+
+    # Each point added to a streamline is stored as (streamline idx, point)
+    point_sl_idxs = [running]
+    point_coords = [points.copy()]
+
+    for i in range(max_nr_steps):
+        if len(running) == 0:
+            break
+        last_points = points[running]
+        idxs, keep = _get_voxel_idxs(last_points, shape)
+        idxs[~keep] = 0
+
+        dir_raw = _get_at_idxs(peaks, idxs)
+        dir_raw_len = np.linalg.norm(dir_raw, axis=1)
+        keep &= dir_raw_len >= peak_len_thr
+
+        # step of step_size mm in coordinate space transformed to voxel space
+        dir_scaled = (dir_raw / (dir_raw_len[:, None] + 1e-20)) * step_size
+        dir_scaled = np.dot(dir_scaled, inv_rotation.T)
+        if i == 0:
+            dir_scaled[reverse[running]] *= -1  # inverse first step
+        else:
+            angle = np.sum(dir_scaled * last_dirs[running], axis=1)
+            dir_scaled[angle < 0] *= -1  # flip dir if not aligned with the direction of the streamline
+
+        next_points = last_points + dir_scaled
+        next_idxs, inside = _get_voxel_idxs(next_points, shape)
+        keep &= inside
+        next_idxs[~keep] = 0
+        if mask is not None:
+            keep &= _get_at_idxs(mask, next_idxs) != 0
+
+        running = running[keep]
+        next_points = next_points[keep]
+        next_idxs = next_idxs[keep]
+        points[running] = next_points
+        last_dirs[running] = dir_scaled[keep]
+        sl_lens[running] += step_size
+        for include, include_mask in zip(included, include_masks):
+            include[running] |= _get_at_idxs(include_mask, next_idxs) != 0
+        point_sl_idxs.append(running)
+        point_coords.append(next_points)
+
+        # Do not track further than max_length (would be discarded anyways)
+        running = running[sl_lens[running] < max_length]
+
+    # Group points by streamline (stable sort keeps order of steps)
+    point_sl_idxs = np.concatenate(point_sl_idxs)
+    point_coords = np.concatenate(point_coords)
+    order = np.argsort(point_sl_idxs, kind="stable")
+    nr_points = np.bincount(point_sl_idxs, minlength=2 * nr_seeds)
+    sl_parts = np.split(point_coords[order], np.cumsum(nr_points)[:-1])
+
+    lengths = sl_lens[:nr_seeds] + sl_lens[nr_seeds:]
+    valid = (lengths >= min_length) & (lengths <= max_length)
+    for include in included:
+        valid &= include[:nr_seeds] | include[nr_seeds:]
+
+    streamlines = []
+    for idx in np.nonzero(valid)[0]:
+        # remove first element of backward part otherwise we have seed_point 2 times
+        sl = np.concatenate([sl_parts[nr_seeds + idx][:0:-1], sl_parts[idx]])
+        streamlines.append((np.dot(sl, affine[:3, :3].T) + affine[:3, 3]).astype(np.float32))
+    return streamlines
+
+
+def track(peaks, affine, max_nr_fibers=2000, seed_mask=None, mask=None, include_masks=None, min_length=40,
+          max_length=250, step_size=None, peak_len_thr=0.1, max_nr_seeds=None, random_seed=None, verbose=False):
+    """
+    Deterministic FACT tracking. Replaces "tckgen -algorithm FACT" with the options used by TractSeg (-seed_image,
+    -mask, -include, -minlength, -maxlength, -select) and the MRtrix defaults (step size 0.1 voxels, cutoff 0.1,
+    1000 * max_nr_fibers seeds at most). Runs in-process on the images in memory.
+
+    Seeds are placed at random positions inside of random voxels of the seed_mask.
+
+    Args:
+        peaks: [x, y, z, 3] peaks in coordinate space (e.g. TOM of one bundle)
+        affine: affine of peaks
+        max_nr_fibers: tracking stops when this number of streamlines is reached
+        seed_mask: binary mask [x, y, z]. If None seeding in all voxels with peak length >= peak_len_thr. Voxels
+            with shorter peaks are never seeded.
+        mask: streamlines stop when leaving this binary mask
+        include_masks: list of binary masks. Streamlines have to pass through each of them.
+        min_length: in mm
+        max_length: in mm
+        step_size: in mm. If None 0.1 * voxel size
+        peak_len_thr: streamlines stop at peaks shorter than this
+        max_nr_seeds: after how many seeds to abort. If None 1000 * max_nr_fibers
+        random_seed: seed for random number generator
+        verbose: print progress
+
+    Returns:
+        list of streamlines in coordinate space (can be saved as tck without further transformation)
+    """
+    peaks = np.nan_to_num(peaks[..., :3])
+    voxel_sizes = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    if step_size is None:
+        step_size = 0.1 * voxel_sizes.min()
+    if max_nr_seeds is None:
+        max_nr_seeds = 1000 * max_nr_fibers
+    # Seeds in voxels with too short peaks stop immediately (nearest voxel of seed point is the seed voxel)
+    seed_voxels = np.linalg.norm(peaks, axis=-1) >= peak_len_thr
+    if seed_mask is not None:
+        seed_voxels &= seed_mask > 0
+    seeds_per_batch = 1000
+
+    random_state = np.random.RandomState(random_seed)
+    mask_coords = np.array(np.where(seed_voxels)).transpose()
+    if len(mask_coords) == 0:
+        return []
+
+    streamlines = []
+    seed_ctr = 0
+    while len(streamlines) < max_nr_fibers and seed_ctr < max_nr_seeds:
+        nr_seeds = min(seeds_per_batch, max_nr_seeds - seed_ctr)
+        seed_points = mask_coords[random_state.randint(len(mask_coords), size=nr_seeds)] + \
+                      random_state.uniform(-0.5, 0.5, (nr_seeds, 3))
+        streamlines += process_seedpoints(seed_points, peaks, affine, step_size, min_length, max_length,
+                                          peak_len_thr=peak_len_thr, mask=mask, include_masks=include_masks)
+        seed_ctr += nr_seeds
+        if verbose:
+            print("nr_fibs: {}".format(len(streamlines)))
+
+    if verbose and len(streamlines) < max_nr_fibers:
+        print("Early stopping because max nr of seeds reached.")
+    return streamlines[:max_nr_fibers]
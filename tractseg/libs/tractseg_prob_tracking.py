@@ -1,12 +1,17 @@
 
+import os
+import shutil
+import tempfile
+from collections import deque
+
 import psutil
 import numpy as np
 import multiprocessing
-from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from dipy.tracking.streamline import transform_streamlines
+from dipy.tracking.streamline import compress_streamlines as compress_streamlines_dipy
 from scipy.ndimage.morphology import binary_dilation
-from dipy.tracking.streamline import Streamlines
 
 from tractseg.libs import fiber_utils
 from tractseg.libs import img_utils
@@ -26,93 +31,41 @@ _END_MASK = None
 global _TRACKING_UNCERTAINTIES
 _TRACKING_UNCERTAINTIES = None
 
+global _VOLUME_PATHS
+_VOLUME_PATHS = None
+
 
-def process_seedpoint(seed_point, spacing, next_step_displacement_std):
+def _get_voxel_idxs(points, shape):
+    """
+    Voxel indices of points (truncated like int()) and if they are inside of the image.
     """
-    Create one streamline from one seed point.
+    idxs = points.astype(np.int64)
+    inside = np.all((idxs >= 0) & (idxs < np.array(shape[:3])), axis=1)
+    return idxs, inside
+
+
+def _get_at_idxs(img, idxs):
+    return img[idxs[:, 0], idxs[:, 1], idxs[:, 2]]
+
+
+def process_seedpoints(seed_points, spacing, next_step_displacement_std, random_seed=None, return_accepted=False):
+    """
+    Create streamlines from several seed points.
+
+    All streamlines (both directions of each seed point) are tracked at the same time: In each step the
+    peaks of all streamlines which are still running are looked up at once. Streamlines which stop are
+    removed from the set of running streamlines. Same stopping criteria as when tracking one streamline at a time.
 
     Args:
-        seed_point: 3d point
+        seed_points: array of 3d points [nr_seeds, 3]
         spacing: Only one value. Assumes isotropic images.
         next_step_displacement_std: stddev for gaussian distribution
+        random_seed: seed for random number generator (each worker has to use a different one, otherwise all
+            workers produce the same random numbers)
+        return_accepted: also return which seed points resulted in a streamline
     Returns:
-        (streamline, streamline_length)
+        list of streamlines (and boolean array [nr_seeds] if return_accepted)
     """
-    def get_at_idx(img, idx):
-        return img[int(idx[0]), int(idx[1]), int(idx[2])]
-
-    # Has to be sub-method otherwise not working
-    def process_one_way(peaks, streamline, max_nr_steps, step_size, probabilistic, next_step_displacement_std,
-                        max_tract_len, peak_len_thr, bundle_mask, tracking_uncertainties, reverse=False):
-        last_dir = None
-        sl_len = 0
-        for i in range(max_nr_steps):
-            last_point = streamline[-1]
-            dir_raw = get_at_idx(peaks, (last_point[0], last_point[1], last_point[2]))
-            if reverse and i == 0:
-                dir_raw = -dir_raw  # inverse first step
-
-            dir_raw_len = np.linalg.norm(dir_raw)
-            # first normalize to length=1 then set to length of step_size
-            dir_scaled = (dir_raw / (dir_raw_len + 1e-20)) * step_size
-            dir_scaled = np.nan_to_num(dir_scaled)
-
-            if i > 0:
-                angle = np.dot(dir_scaled, last_dir)
-                if angle < 0:  # flip dir if not aligned with the direction of the streamline
-                    dir_scaled = -dir_scaled
-
-            if probabilistic:
-                if tracking_uncertainties is not None:
-                    uncertainty = get_at_idx(tracking_uncertainties, (last_point[0], last_point[1], last_point[2]))
-                    # If maximal uncertainty we use full next_step_displacement_std. If minimal uncertainty we do not
-                    # use any displacement
-                    displacement_std_scaled = next_step_displacement_std * uncertainty
-                else:
-                    displacement_std_scaled = next_step_displacement_std
-                displacement = np.random.normal(0, displacement_std_scaled, 3)
-                dir_scaled = dir_scaled + displacement
-
-                # If step_size too small and next_step_displacement_std too big: sometimes even goes back
-                #  -> ends up in random places (better when normalizing peak length after random displacing,
-                #  but still happens if step_size to small)
-                # dir_scaled = (dir_scaled / (np.linalg.norm(dir_scaled) + 1e-20)) * step_size
-
-            next_point = streamline[-1] + dir_scaled
-            last_dir = dir_scaled
-
-            # stop fiber if running out of image or out of bundle mask
-            if bundle_mask is not None:
-                sh = bundle_mask.shape
-                if int(next_point[0]) >= sh[0] or int(next_point[1]) >= sh[1] or int(next_point[2]) >= sh[2]:
-                    break
-                if get_at_idx(bundle_mask, (next_point[0], next_point[1], next_point[2])) == 0:
-                    break
-
-            # This does not take too much runtime, because most of these cases already caught by previous bundle_mask
-            #  check. Here it is mainly only the good fibers (a lot less than all fibers seeded).
-            next_peak_len = np.linalg.norm(get_at_idx(peaks, (next_point[0], next_point[1], next_point[2])))
-            if next_peak_len < peak_len_thr:
-                break
-            else:
-                if sl_len < max_tract_len:
-                    streamline.append(next_point)
-                    sl_len += dir_raw_len
-                else:
-                    break
-        return streamline, sl_len
-
-    def streamline_ends_in_masks(sl, start_mask, end_mask):
-        if (get_at_idx(start_mask, (sl[0][0], sl[0][1], sl[0][2])) == 1 and
-                get_at_idx(end_mask, (sl[-1][0], sl[-1][1], sl[-1][2])) == 1):
-            return True
-
-        if (get_at_idx(start_mask, (sl[-1][0], sl[-1][1], sl[-1][2])) == 1 and
-                get_at_idx(end_mask, (sl[0][0], sl[0][1], sl[0][2])) == 1):
-            return True
-
-        return False
-
     # Parameters
     probabilistic = True
     max_nr_steps = 1000
@@ -146,40 +99,196 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
     global _TRACKING_UNCERTAINTIES
     tracking_uncertainties = _TRACKING_UNCERTAINTIES
 
-    streamline1 = []
-    if probabilistic:
-        random_seedpoint_displacement = np.random.normal(0, seedpoint_displacement_std, 3)
-        seed_point = seed_point + random_seedpoint_displacement
-    streamline1.append([seed_point[0], seed_point[1], seed_point[2]])  # add first point to streamline
-    streamline2 = list(streamline1)  # deep copy
+    random_state = np.random.RandomState(random_seed)
 
-    streamline_part1, length_1 = process_one_way(peaks, streamline1, max_nr_steps, step_size, probabilistic,
-                                                 next_step_displacement_std, max_tract_len, peak_len_thr, bundle_mask,
-                                                 tracking_uncertainties, reverse=False)
+    seed_points = np.asarray(seed_points, dtype=np.float64)
+    nr_seeds = len(seed_points)
+    if probabilistic:
+        seed_points = seed_points + random_state.normal(0, seedpoint_displacement_std, seed_points.shape)
 
+    # Streamline idx < nr_seeds: forward direction; idx >= nr_seeds: backward direction of same seed point.
     # Roughly doubles execution time but also roughly doubles number of resulting streamlines
     # Makes sense because many too short if seeding in middle of streamline.
-    streamline_part2, length_2 = process_one_way(peaks, streamline2, max_nr_steps, step_size, probabilistic,
-                                                 next_step_displacement_std, max_tract_len, peak_len_thr, bundle_mask,
-                                                 tracking_uncertainties, reverse=True)
-
-    if len(streamline_part2) > 0:
-        # remove first element of part2 otherwise we have seed_point 2 times
-        streamline = list(reversed(streamline_part2[1:])) + streamline_part1
-    else:
-        streamline = streamline_part1
+    points = np.concatenate([seed_points, seed_points])
+    reverse = np.arange(2 * nr_seeds) >= nr_seeds
+    last_dirs = np.zeros(points.shape)
+    sl_lens = np.zeros(2 * nr_seeds)
+    running = np.arange(2 * nr_seeds)
+
+    # Each point added to a streamline is stored as (streamline idx, point)
+    point_sl_idxs = [running]
+    point_coords = [points.copy()]
+
+    for i in range(max_nr_steps):
+        if len(running) == 0:
+            break
+        last_points = points[running]
+        idxs, _ = _get_voxel_idxs(last_points, peaks.shape)
+        idxs = np.clip(idxs, 0, np.array(peaks.shape[:3]) - 1)  # seed point can be slightly outside after displacing
+
+        dir_raw = _get_at_idxs(peaks, idxs)
+        if i == 0:
+            dir_raw = np.where(reverse[running][:, None], -dir_raw, dir_raw)  # inverse first step
+
+        dir_raw_len = np.linalg.norm(dir_raw, axis=1)
+        # first normalize to length=1 then set to length of step_size
+        dir_scaled = (dir_raw / (dir_raw_len[:, None] + 1e-20)) * step_size
+        dir_scaled = np.nan_to_num(dir_scaled)
+
+        if i > 0:
+            angle = np.sum(dir_scaled * last_dirs[running], axis=1)
+            dir_scaled[angle < 0] *= -1  # flip dir if not aligned with the direction of the streamline
+
+        if probabilistic:
+            if tracking_uncertainties is not None:
+                uncertainty = _get_at_idxs(tracking_uncertainties, idxs)
+                # If maximal uncertainty we use full next_step_displacement_std. If minimal uncertainty we do not
+                # use any displacement
+                displacement_std_scaled = next_step_displacement_std * uncertainty[:, None]
+            else:
+                displacement_std_scaled = next_step_displacement_std
+            displacement = random_state.normal(0, 1, dir_scaled.shape) * displacement_std_scaled
+            dir_scaled = dir_scaled + displacement
+
+        next_points = last_points + dir_scaled
+        last_dirs[running] = dir_scaled
+
+        # stop fiber if running out of image or out of bundle mask
+        next_idxs, keep = _get_voxel_idxs(next_points, peaks.shape)
+        next_idxs[~keep] = 0
+        if bundle_mask is not None:
+            keep &= _get_at_idxs(bundle_mask, next_idxs) != 0
+
+        next_peak_len = np.linalg.norm(_get_at_idxs(peaks, next_idxs), axis=1)
+        keep &= next_peak_len >= peak_len_thr
+        keep &= sl_lens[running] < max_tract_len
+
+        running = running[keep]
+        points[running] = next_points[keep]
+        sl_lens[running] += dir_raw_len[keep]
+        point_sl_idxs.append(running)
+        point_coords.append(next_points[keep])
+
+    # Group points by streamline (stable sort keeps order of steps)
+    point_sl_idxs = np.concatenate(point_sl_idxs)
+    point_coords = np.concatenate(point_coords)
+    order = np.argsort(point_sl_idxs, kind="stable")
+    nr_points = np.bincount(point_sl_idxs, minlength=2 * nr_seeds)
+    sl_parts = np.split(point_coords[order], np.cumsum(nr_points)[:-1])
 
     # Check min and max length
-    length = length_1 + length_2
-    if length < min_tract_len or length > max_tract_len:
-        return []
+    lengths = sl_lens[:nr_seeds] + sl_lens[nr_seeds:]
+    valid = (lengths >= min_tract_len) & (lengths <= max_tract_len)
 
     # Filter by start and end mask
     if start_mask is not None and end_mask is not None:
-        if streamline_ends_in_masks(streamline, start_mask, end_mask):
-            return streamline
+        first_points = np.array([sl_parts[nr_seeds + idx][-1] for idx in range(nr_seeds)])
+        last_points = np.array([sl_parts[idx][-1] for idx in range(nr_seeds)])
+        first_idxs, _ = _get_voxel_idxs(first_points, start_mask.shape)
+        last_idxs, _ = _get_voxel_idxs(last_points, start_mask.shape)
+        first_idxs = np.clip(first_idxs, 0, np.array(start_mask.shape) - 1)
+        last_idxs = np.clip(last_idxs, 0, np.array(start_mask.shape) - 1)
+        valid &= ((_get_at_idxs(start_mask, first_idxs) == 1) & (_get_at_idxs(end_mask, last_idxs) == 1)) | \
+                 ((_get_at_idxs(start_mask, last_idxs) == 1) & (_get_at_idxs(end_mask, first_idxs) == 1))
+    else:
+        valid[:] = False
+
+    streamlines = []
+    for idx in np.nonzero(valid)[0]:
+        # remove first element of backward part otherwise we have seed_point 2 times
+        streamlines.append(np.concatenate([sl_parts[nr_seeds + idx][:0:-1], sl_parts[idx]]))
+    if return_accepted:
+        return streamlines, valid
+    return streamlines
+
+
+def get_shared_tmp_dir(nbytes):
+    """
+    Directory for files shared with workers: /dev/shm (in memory) if it has enough free space, otherwise the default
+    tmp dir (e.g. docker containers only have 64MB of /dev/shm by default).
+    """
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free > 2 * nbytes:
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _share_volumes(volumes, pool):
+    """
+    Share volumes with the workers of pool.
+
+    The workers of a ThreadPool run in this process and use the arrays directly. For other pools the volumes are
+    saved to a tmp dir (float32 and uint8 for masks), so all workers can memory map them (instead of copying them to
+    each worker).
+
+    Returns:
+        dict with "tmp_dir" (None for ThreadPool), "volumes" (array or path of each volume, None if volume is None)
+        and "finished" (set to True when tracking of this bundle is finished)
+    """
+    if isinstance(pool, ThreadPool):
+        return {"tmp_dir": None, "volumes": volumes, "finished": False}
+
+    volumes = {name: None if volume is None else volume.astype(np.uint8 if name.endswith("mask") else np.float32)
+               for name, volume in volumes.items()}
+    nbytes = sum(volume.nbytes for volume in volumes.values() if volume is not None)
+    tmp_dir = tempfile.mkdtemp(dir=get_shared_tmp_dir(nbytes))
+    volume_paths = {}
+    for name, volume in volumes.items():
+        if volume is None:
+            volume_paths[name] = None
+        else:
+            volume_paths[name] = os.path.join(tmp_dir, name + ".npy")
+            np.save(volume_paths[name], volume)
+    return {"tmp_dir": tmp_dir, "volumes": volume_paths, "finished": False}
+
+
+def _load_volumes(shared_volumes):
+    """
+    Memory map volumes in worker. Only done once per bundle, afterwards the volumes are reused for each batch.
+    """
+    global _VOLUME_PATHS
+    if shared_volumes["tmp_dir"] is not None and shared_volumes["volumes"] == _VOLUME_PATHS:
+        return
+
+    def _load(name):
+        volume = shared_volumes["volumes"][name]
+        if volume is None or shared_volumes["tmp_dir"] is None:
+            return volume
+        return np.load(volume, mmap_mode="r")
 
-    return []
+    global _PEAKS
+    _PEAKS = _load("peaks")
+    global _BUNDLE_MASK
+    _BUNDLE_MASK = _load("bundle_mask")
+    global _START_MASK
+    _START_MASK = _load("start_mask")
+    global _END_MASK
+    _END_MASK = _load("end_mask")
+    global _TRACKING_UNCERTAINTIES
+    _TRACKING_UNCERTAINTIES = _load("tracking_uncertainties")
+    _VOLUME_PATHS = shared_volumes["volumes"] if shared_volumes["tmp_dir"] is not None else None
+
+
+def _process_seed_batch(shared_volumes, seed_points, random_seed, spacing, next_step_displacement_std):
+    # Tracking of this bundle is already finished (remaining batch in shared pool)
+    if shared_volumes["finished"] or (shared_volumes["tmp_dir"] is not None and
+                                      not os.path.exists(shared_volumes["tmp_dir"])):
+        return [], None
+    _load_volumes(shared_volumes)
+    return process_seedpoints(seed_points, spacing, next_step_displacement_std, random_seed=random_seed,
+                              return_accepted=True)
+
+
+def create_pool(nr_cpus=-1):
+    """
+    Create pool of tracking workers. Can be passed to track() to use the same workers for all bundles.
+
+    If only using one cpu no extra process is started (tracking runs in a thread of this process). This also works
+    inside of daemonic processes (e.g. when tracking several bundles in parallel).
+    """
+    nr_processes = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    if nr_processes == 1:
+        return ThreadPool(processes=1)
+    return multiprocessing.Pool(processes=nr_processes)
 
 
 def seed_generator(mask_coords, nr_seeds):
@@ -192,82 +301,107 @@ def seed_generator(mask_coords, nr_seeds):
     return res
 
 
-def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None,
-          start_mask=None, end_mask=None, tracking_uncertainties=None, dilation=0,
-          next_step_displacement_std=0.15, nr_cpus=-1, affine=None, spacing=None, verbose=True):
+def get_adaptive_seed_probabilities(nr_seeds_voxel, nr_accepted_voxel, exploration=0.1, prior_nr_seeds=5):
     """
-    Generate streamlines.
+    Seeding probability for each voxel of the mask for adaptive seeding.
 
-    Great speedup was archived by:
-    - only seeding in bundle_mask instead of entire image (seeding took very long)
-    - calculating fiber length on the fly instead of using extra function which has to iterate over entire fiber a
-    second time
+    Voxels are seeded proportional to their estimated acceptance rate (fraction of seeds which resulted in a valid
+    streamline). The acceptance rate of each voxel is smoothed with a Beta prior with the mean acceptance rate of
+    the entire mask, which corresponds to prior_nr_seeds seeds. So voxels with only few seeds are not dropped
+    because they did not produce a streamline by chance. A fraction of exploration of all seeds is distributed
+    uniformly over the entire mask, so each voxel gets at least exploration / nr_voxels.
+
+    The streamlines are not distributed like with uniform seeding anymore: voxels with a low acceptance rate are
+    under-represented. Weighting each streamline with 1 / (nr_voxels * probability of its seed voxel) corrects this
+    (see track()). The weights are at most 1 / exploration.
+
+    Args:
+        nr_seeds_voxel: number of seeds per voxel [nr_voxels]
+        nr_accepted_voxel: number of accepted streamlines per voxel [nr_voxels]
+        exploration: fraction of seeds distributed uniformly over all voxels
+        prior_nr_seeds: strength of the prior (in number of seeds)
+
+    Returns:
+        seeding probability per voxel [nr_voxels]
     """
+    nr_voxels = len(nr_seeds_voxel)
+    mean_acceptance = (nr_accepted_voxel.sum() + 1.) / (nr_seeds_voxel.sum() + 2.)
+    a = prior_nr_seeds * mean_acceptance
+    b = prior_nr_seeds * (1 - mean_acceptance)
+    acceptance = (nr_accepted_voxel + a) / (nr_seeds_voxel + a + b)
+    return (1 - exploration) * acceptance / acceptance.sum() + exploration / nr_voxels
 
-    peaks[:, :, :, 0] *= -1  # have to flip along x axis to work properly
-    # Add +1 dilation for start and end mask to be more robust
-    start_mask = binary_dilation(start_mask, iterations=dilation + 1).astype(np.uint8)
-    end_mask = binary_dilation(end_mask, iterations=dilation + 1).astype(np.uint8)
-    if dilation > 0:
-        bundle_mask = binary_dilation(bundle_mask, iterations=dilation).astype(np.uint8)
 
-    if tracking_uncertainties is not None:
-        tracking_uncertainties = img_utils.scale_to_range(tracking_uncertainties, range=(0, 1))
+def sample_seed_idxs(nr_seeds, cumulative_probs):
+    """
+    Sample voxel indices from cumulative seeding probabilities (importance sampling).
+    """
+    return np.searchsorted(cumulative_probs, np.random.rand(nr_seeds) * cumulative_probs[-1], side="right")
 
-    global _PEAKS
-    _PEAKS = peaks
-    global _BUNDLE_MASK
-    _BUNDLE_MASK = bundle_mask
-    global _START_MASK
-    _START_MASK = start_mask
-    global _END_MASK
-    _END_MASK = end_mask
-    global _TRACKING_UNCERTAINTIES
-    _TRACKING_UNCERTAINTIES = tracking_uncertainties
 
-    # Get list of coordinates of each voxel in mask to seed from those
-    mask_coords = np.array(np.where(bundle_mask == 1)).transpose()
+def _track_batches(shared_volumes, mask_coords, max_nr_fibers, spacing, next_step_displacement_std, nr_processes,
+                   pool, adaptive_seeding, nr_seeds_voxel, nr_accepted_voxel, verbose):
+    """
+    Generator yielding the streamlines (voxel space) of each batch of seeds as soon as it is finished, until
+    max_nr_fibers streamlines were yielded. nr_seeds_voxel and nr_accepted_voxel are updated in place.
 
+    Yields:
+        streamlines, weights (1 / (nr_voxels * seeding probability of the seed voxel) for each streamline. All 1 for
+        uniform seeding.)
+    """
     max_nr_seeds = 100 * max_nr_fibers  # after how many seeds to abort (to avoid endless runtime)
-    # How many seeds to process in each pool.map iteration
-    seeds_per_batch = 5000
+    # How many seeds to process in each task (small enough to stop soon after max_nr_fibers is reached)
+    seeds_per_batch = 1000
 
-    if nr_cpus == -1:
-        nr_processes = psutil.cpu_count()
-    else:
-        nr_processes = nr_cpus
+    nr_voxels = len(mask_coords)
+    # Adaptive seeding: uniform seeding until on average 5 seeds per voxel were tracked
+    warmup_seeds = min(5 * nr_voxels, max_nr_seeds // 10)
+    probs = np.full(nr_voxels, 1. / nr_voxels)
+    cumulative_probs = np.cumsum(probs)
 
-    streamlines = []
     fiber_ctr = 0
     seed_ctr = 0
-    # Processing seeds in batches so we can stop after we reached desired nr of streamlines. Not ideal. Could be
-    #   optimised by more multiprocessing fanciness.
+    pending = deque()
     while fiber_ctr < max_nr_fibers:
-        pool = multiprocessing.Pool(processes=nr_processes)
-        streamlines_tmp = pool.map(partial(process_seedpoint, next_step_displacement_std=next_step_displacement_std,
-                                           spacing=spacing),
-                                   seed_generator(mask_coords, seeds_per_batch))
-        # streamlines_tmp = [process_seedpoint(seed, spacing=spacing) for seed in
-        #                    seed_generator(mask_coords, seeds_per_batch)] # single threaded for debugging
-        pool.close()
-        pool.join()
-
-        streamlines_tmp = [sl for sl in streamlines_tmp if len(sl) > 0]  # filter empty ones
-        streamlines += streamlines_tmp
-        fiber_ctr = len(streamlines)
-        if verbose:
-            print("nr_fibs: {}".format(fiber_ctr))
-        seed_ctr += seeds_per_batch
-        if seed_ctr > max_nr_seeds:
+        # Keep 2 batches per worker queued so workers do not have to wait
+        while len(pending) < 2 * nr_processes and seed_ctr < max_nr_seeds:
+            seed_idxs = sample_seed_idxs(seeds_per_batch, cumulative_probs)
+            pending.append((seed_idxs, probs,
+                            pool.apply_async(_process_seed_batch,
+                                             (shared_volumes, mask_coords[seed_idxs],
+                                              np.random.randint(np.iinfo(np.int32).max), spacing,
+                                              next_step_displacement_std))))
+            seed_ctr += seeds_per_batch
+        if len(pending) == 0:
             if verbose:
                 print("Early stopping because max nr of seeds reached.")
             break
 
+        seed_idxs, seed_probs, result = pending.popleft()
+        streamlines, accepted = result.get()
+        streamlines = streamlines[:max_nr_fibers - fiber_ctr]  # remove surplus of fibers
+        weights = 1. / (nr_voxels * seed_probs[seed_idxs[accepted]][:len(streamlines)])
+        fiber_ctr += len(streamlines)
+        if verbose:
+            print("nr_fibs: {}".format(fiber_ctr))
+
+        nr_seeds_voxel += np.bincount(seed_idxs, minlength=nr_voxels)
+        nr_accepted_voxel += np.bincount(seed_idxs[accepted], minlength=nr_voxels)
+        if adaptive_seeding and nr_seeds_voxel.sum() >= warmup_seeds:
+            probs = get_adaptive_seed_probabilities(nr_seeds_voxel, nr_accepted_voxel)
+            cumulative_probs = np.cumsum(probs)
+        yield streamlines, weights
+
     if verbose:
-        print("final nr streamlines: {}".format(len(streamlines)))
+        print("final nr streamlines: {}".format(fiber_ctr))
 
-    streamlines = streamlines[:max_nr_fibers]   # remove surplus of fibers (comes from multiprocessing)
-    streamlines = Streamlines(streamlines)  # Generate streamlines object
+
+def _postprocess_streamlines(streamlines, bundle_mask, affine, flip_axes, smooth, compress):
+    """
+    Transform streamlines from voxel space to coordinate space, smooth and compress them.
+    """
+    if len(streamlines) == 0:
+        return []
 
     # Move from convention "0mm is in voxel corner" to convention "0mm is in voxel center". Most toolkits use the
     # convention "0mm is in voxel center".
@@ -277,11 +411,10 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
 
     # move streamlines to coordinate space
     #  This is doing: streamlines(coordinate_space) = affine * streamlines(voxel_space)
-    streamlines = list(transform_streamlines(streamlines, affine))
+    streamlines = transform_streamlines(streamlines, affine)
 
     # If the original image was not in MNI space we have to flip back to the original space
     # before saving the streamlines
-    flip_axes = img_utils.get_flip_axis_to_match_MNI_space(affine)
     for axis in flip_axes:
         streamlines = fiber_utils.invert_streamlines(streamlines, bundle_mask, affine, axis=axis)
 
@@ -290,6 +423,105 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
         streamlines = fiber_utils.smooth_streamlines(streamlines, smoothing_factor=smooth)
 
     if compress:
-        streamlines = fiber_utils.compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=nr_cpus)
+        streamlines = compress_streamlines_dipy(streamlines, tol_error=0.1)
 
     return streamlines
+
+
+def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None,
+          start_mask=None, end_mask=None, tracking_uncertainties=None, dilation=0,
+          next_step_displacement_std=0.15, nr_cpus=-1, affine=None, spacing=None, verbose=True, pool=None,
+          adaptive_seeding=False, return_seeding_stats=False, return_weights=False, lazy=False):
+    """
+    Generate streamlines.
+
+    Great speedup was archived by:
+    - only seeding in bundle_mask instead of entire image (seeding took very long)
+    - calculating fiber length on the fly instead of using extra function which has to iterate over entire fiber a
+    second time
+    - tracking all seeds of one batch at the same time (see process_seedpoints)
+
+    The volumes are shared with the workers via memory mapped files (see _share_volumes). Batches of seeds
+    are sent to the workers until max_nr_fibers is reached. The streamlines of each batch are transformed to
+    coordinate space, smoothed and compressed as soon as the batch is finished (while the workers continue
+    tracking).
+
+    Args:
+        pool: pool from create_pool(). If None a new pool is created for this bundle. Pass the same pool when
+            tracking several bundles to avoid starting new workers for each bundle.
+        adaptive_seeding: After a warm-up phase with uniform seeding, seed voxels proportional to their
+            acceptance rate (see get_adaptive_seed_probabilities). Less seeds are wasted on parts of the mask which
+            rarely result in valid streamlines (e.g. for thin bundles). Streamlines from voxels with a low acceptance
+            rate are under-represented then. Use the weights (return_weights) to get the same distribution as with
+            uniform seeding.
+        return_seeding_stats: also return image [x,y,z,2] with number of seeds and number of accepted streamlines
+            per voxel
+        return_weights: also return list with weight of each streamline (1 / (nr_voxels * seeding probability of
+            its seed voxel)). All 1 without adaptive_seeding.
+        lazy: return generator instead of list of streamlines. Tracking only runs while iterating over the
+            generator, so the streamlines can be written to a file (see fiber_utils.save_streamlines) without having
+            all of them in memory. The seeding stats and weights are only complete after the generator is exhausted.
+
+    Returns:
+        streamlines (and seeding stats if return_seeding_stats, and weights if return_weights)
+    """
+
+    peaks = peaks.astype(np.float32)  # copy, so the input is not modified (can also be read-only)
+    peaks[:, :, :, 0] *= -1  # have to flip along x axis to work properly
+    # Add +1 dilation for start and end mask to be more robust
+    start_mask = binary_dilation(start_mask, iterations=dilation + 1).astype(np.uint8)
+    end_mask = binary_dilation(end_mask, iterations=dilation + 1).astype(np.uint8)
+    if dilation > 0:
+        bundle_mask = binary_dilation(bundle_mask, iterations=dilation).astype(np.uint8)
+
+    if tracking_uncertainties is not None:
+        tracking_uncertainties = img_utils.scale_to_range(tracking_uncertainties, range=(0, 1))
+
+    # Get list of coordinates of each voxel in mask to seed from those
+    mask_coords = np.array(np.where(bundle_mask == 1)).transpose()
+    # Seeding statistics per voxel of mask_coords
+    nr_seeds_voxel = np.zeros(len(mask_coords), dtype=np.int64)
+    nr_accepted_voxel = np.zeros(len(mask_coords), dtype=np.int64)
+    seeding_stats = np.zeros(bundle_mask.shape + (2,), dtype=np.int32)
+    weights = []
+    flip_axes = img_utils.get_flip_axis_to_match_MNI_space(affine)
+
+    if nr_cpus == -1:
+        nr_processes = psutil.cpu_count()
+    else:
+        nr_processes = nr_cpus
+
+    def generate_streamlines():
+        own_pool = pool is None
+        tracking_pool = create_pool(nr_cpus) if own_pool else pool
+        shared_volumes = _share_volumes({"peaks": peaks, "bundle_mask": bundle_mask, "start_mask": start_mask,
+                                         "end_mask": end_mask, "tracking_uncertainties": tracking_uncertainties},
+                                        tracking_pool)
+        try:
+            for streamlines, batch_weights in _track_batches(shared_volumes, mask_coords, max_nr_fibers, spacing,
+                                                             next_step_displacement_std, nr_processes,
+                                                             tracking_pool, adaptive_seeding, nr_seeds_voxel,
+                                                             nr_accepted_voxel, verbose):
+                weights.extend(batch_weights)
+                for sl in _postprocess_streamlines(streamlines, bundle_mask, affine, flip_axes, smooth, compress):
+                    yield sl
+        finally:
+            if own_pool:
+                tracking_pool.terminate()  # do not process remaining batches
+                tracking_pool.join()
+            # Remaining batches in a shared pool are skipped because the volumes are deleted
+            shared_volumes["finished"] = True
+            if shared_volumes["tmp_dir"] is not None:
+                shutil.rmtree(shared_volumes["tmp_dir"], ignore_errors=True)
+        seeding_stats[tuple(mask_coords.T) + (0,)] = nr_seeds_voxel
+        seeding_stats[tuple(mask_coords.T) + (1,)] = nr_accepted_voxel
+
+    streamlines = generate_streamlines()
+    if not lazy:
+        streamlines = list(streamlines)
+    results = (streamlines,)
+    if return_seeding_stats:
+        results += (seeding_stats,)
+    if return_weights:
+        results += (weights,)
+    return results if len(results) > 1 else streamlines
@@ -17,8 +17,10 @@ import nibabel as nib
 
 from tractseg.libs import exp_utils
 from tractseg.libs import metric_utils
+from tractseg.libs import pytorch_utils
 from tractseg.libs import plot_utils
 from tractseg.data.data_loader_inference import DataLoaderInference
+from tractseg.data.data_loader_inference import BackgroundBatchGenerator
 from tractseg.data import dataset_specific_utils
 
 
@@ -109,6 +111,9 @@ def train_model(Config, model, data_loader):
 
                 x = batch["data"]  # (bs, nr_of_channels, x, y)
                 y = batch["seg"]  # (bs, nr_of_classes, x, y)
+                if "cache_hits" in batch:
+                    timings["cache_hits"] += batch["cache_hits"]
+                    timings["cache_misses"] += batch["cache_misses"]
 
                 timings["data_preparation_time"] += time.time() - start_time_data_preparation
                 start_time_network = time.time()
@@ -196,6 +201,10 @@ def train_model(Config, model, data_loader):
         exp_utils.print_and_save(Config.EXP_PATH, "  Epoch {}, time UNet: {}s".format(epoch_nr, timings["network_time"]))
         exp_utils.print_and_save(Config.EXP_PATH, "  Epoch {}, time metrics: {}s".format(epoch_nr, timings["metrics_time"]))
         exp_utils.print_and_save(Config.EXP_PATH, "  Epoch {}, time saving files: {}s".format(epoch_nr, timings["saving_time"]))
+        if timings["cache_hits"] + timings["cache_misses"] > 0:
+            cache_hit_rate = timings["cache_hits"] / (timings["cache_hits"] + timings["cache_misses"])
+            exp_utils.print_and_save(Config.EXP_PATH, "  Epoch {}, subject cache hit rate: {}%".format(
+                epoch_nr, round(cache_hit_rate * 100, 1)))
         exp_utils.print_and_save(Config.EXP_PATH, str(datetime.datetime.now()))
 
         # Adding next Epoch
@@ -206,8 +215,28 @@ def train_model(Config, model, data_loader):
         f.write("\n\nAverage Epoch time: {}s".format(sum(epoch_times) / float(len(epoch_times))))
 
 
+def _predict_with_memory_fallback(model, x, chunk_size):
+    """
+    Predict batch x in chunks of at most chunk_size slices. If running out of memory the chunk size is halved
+    and the prediction repeated.
+
+    Returns:
+        (predictions, chunk size which worked)
+    """
+    while True:
+        try:
+            probs = [model.predict(x[i:i + chunk_size]) for i in range(0, x.shape[0], chunk_size)]
+            return np.concatenate(probs, axis=0), chunk_size
+        except (MemoryError, RuntimeError) as e:
+            # pytorch raises RuntimeError if memory allocation fails
+            if chunk_size == 1 or not pytorch_utils.is_out_of_memory_error(e):
+                raise
+            chunk_size = max(1, chunk_size // 2)
+            print("WARNING: Not enough memory for inference. Reducing batch size to {}.".format(chunk_size))
+
+
 def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=True, only_prediction=False,
-                batch_size=1, unit_test=False):
+                batch_size=1, unit_test=False, accumulator=None):
     """
     Return predictions for one 3D image.
 
@@ -217,6 +246,13 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
           bs=48 -> 6.5min    ~30GB RAM
     - python 3 + pytorch 1.0:
           bs=1  -> 2.7min    ~7GB RAM
+
+    If batch_size is "auto" the largest batch size which fits into Config.INFERENCE_MEMORY_FRACTION of the free
+    memory is used. If memory allocation fails anyways, smaller batches are used.
+
+    If accumulator (4D array in (x, y, z, nr_classes) order) is given, the predictions of each batch are added to
+    it instead of being stored in a new image. Then accumulator is returned instead of the predictions. Used to
+    fuse several slice directions without keeping one image per direction in memory (only for 2D).
     """
     def _finalize_data(layers):
         layers = np.array(layers)
@@ -238,8 +274,11 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
         assert (layers.dtype == np.float32)
         return layers
 
+    if accumulator is not None and (Config.DIM != "2D" or scale_to_world_shape):
+        raise ValueError("accumulator only supported for 2D models without scale_to_world_shape")
+
     img_shape = [Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.NR_OF_CLASSES]
-    layers_seg = np.empty(img_shape).astype(np.float32)
+    layers_seg = np.empty(img_shape).astype(np.float32) if accumulator is None else None
     layers_y = None if only_prediction else np.empty(img_shape).astype(np.float32)
 
     if unit_test:
@@ -268,55 +307,92 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
 
         return probs, layers_y
 
-    batch_generator = data_loader.get_batch_generator(batch_size=batch_size)
-    batch_generator = list(batch_generator)
-    idx = 0
-    for batch in tqdm(batch_generator):
-        x = batch["data"]   # (bs, nr_channels, x, y)
-        y = batch["seg"]    # (bs, nr_classes, x, y)
-        y = y.numpy()
-
-        if not only_prediction:
-            y = y.astype(Config.LABELS_TYPE)
-            if Config.DIM == "2D":
-                y = y.transpose(0, 2, 3, 1) # (bs, x, y, nr_classes)
-            else:
-                y = y.transpose(0, 2, 3, 4, 1)
-
-        if Config.DROPOUT_SAMPLING:
-            # For Dropout Sampling (must set deterministic=False in model)
-            NR_SAMPLING = 30
-            samples = []
-            for i in range(NR_SAMPLING):
-                layer_probs = model.predict(x)  # (bs, x, y, nr_classes)
-                samples.append(layer_probs)
-
-            samples = np.array(samples)  # (NR_SAMPLING, bs, x, y, nr_classes)
-            layer_probs = np.std(samples, axis=0)    # (bs, x, y, nr_classes)
-        else:
-            # For normal prediction
-            layer_probs = model.predict(x)  # (bs, x, y, nr_classes)
+    if batch_size == "auto":
+        batch_size = pytorch_utils.get_auto_batch_size(Config, memory_fraction=Config.INFERENCE_MEMORY_FRACTION)
+        exp_utils.print_verbose(Config.VERBOSE, "Using inference batch size {}".format(batch_size))
+    chunk_size = batch_size  # might be reduced if running out of memory
 
-        if probs:
-            seg = layer_probs   # (x, y, nr_classes)
-        else:
-            seg = layer_probs
-            seg[seg >= Config.THRESHOLD] = 1
-            seg[seg < Config.THRESHOLD] = 0
-            seg = seg.astype(np.uint8)
+    # Prepare next batches in background thread while the network is running
+    batch_generator = BackgroundBatchGenerator(data_loader.get_batch_generator(batch_size=batch_size))
+    nr_batches = int(np.ceil(Config.INPUT_DIM[0] / float(batch_size))) if Config.DIM == "2D" else 1
+    timings = defaultdict(lambda: 0)
+    idx = 0
+    start_time_waiting = time.time()
+    try:
+        for batch in tqdm(batch_generator, total=nr_batches):
+            timings["waiting_for_data_time"] += time.time() - start_time_waiting
+            x = batch["data"]   # (bs, nr_channels, x, y)
+            y = batch["seg"]    # (bs, nr_classes, x, y)
+            y = y.numpy()
 
-        if Config.DIM == "2D":
-            layers_seg[idx*batch_size:(idx+1)*batch_size, :, :, :] = seg
-            if not only_prediction:
-                layers_y[idx*batch_size:(idx+1)*batch_size, :, :, :] = y
-        else:
-            layers_seg = np.squeeze(seg)
             if not only_prediction:
-                layers_y = np.squeeze(y)
-
-        idx += 1
+                y = y.astype(Config.LABELS_TYPE)
+                if Config.DIM == "2D":
+                    y = y.transpose(0, 2, 3, 1) # (bs, x, y, nr_classes)
+                else:
+                    y = y.transpose(0, 2, 3, 4, 1)
+
+            start_time_network = time.time()
+            if Config.DROPOUT_SAMPLING:
+                # For Dropout Sampling (must set deterministic=False in model)
+                NR_SAMPLING = 30
+                samples = []
+                for i in range(NR_SAMPLING):
+                    # (bs, x, y, nr_classes)
+                    layer_probs, chunk_size = _predict_with_memory_fallback(model, x, chunk_size)
+                    samples.append(layer_probs)
+
+                samples = np.array(samples)  # (NR_SAMPLING, bs, x, y, nr_classes)
+                layer_probs = np.std(samples, axis=0)    # (bs, x, y, nr_classes)
+            else:
+                # For normal prediction
+                layer_probs, chunk_size = _predict_with_memory_fallback(model, x, chunk_size)  # (bs, x, y, nr_classes)
+            timings["network_time"] += time.time() - start_time_network
 
-    layers_seg = _finalize_data(layers_seg)
+            start_time_storing = time.time()
+            if probs:
+                seg = layer_probs   # (x, y, nr_classes)
+            else:
+                seg = layer_probs
+                seg[seg >= Config.THRESHOLD] = 1
+                seg[seg < Config.THRESHOLD] = 0
+                seg = seg.astype(np.uint8)
+
+            if accumulator is not None:
+                start, end = idx*batch_size, idx*batch_size + seg.shape[0]
+                # Bring from (bs, ...) to (x, y, z, nr_classes) order (same as in _finalize_data)
+                if Config.SLICE_DIRECTION == "x":
+                    accumulator[start:end, :, :, :] += seg
+                elif Config.SLICE_DIRECTION == "y":
+                    accumulator[:, start:end, :, :] += seg.transpose(1, 0, 2, 3)
+                elif Config.SLICE_DIRECTION == "z":
+                    accumulator[:, :, start:end, :] += seg.transpose(1, 2, 0, 3)
+                if not only_prediction:
+                    layers_y[idx*batch_size:(idx+1)*batch_size, :, :, :] = y
+            elif Config.DIM == "2D":
+                layers_seg[idx*batch_size:(idx+1)*batch_size, :, :, :] = seg
+                if not only_prediction:
+                    layers_y[idx*batch_size:(idx+1)*batch_size, :, :, :] = y
+            else:
+                layers_seg = np.squeeze(seg)
+                if not only_prediction:
+                    layers_y = np.squeeze(y)
+            timings["storing_time"] += time.time() - start_time_storing
+
+            idx += 1
+            start_time_waiting = time.time()
+    finally:
+        batch_generator.close()  # otherwise the background thread blocks forever if the prediction failed
+
+    exp_utils.print_verbose(Config.VERBOSE, "time data preparation (background): {}s, waiting for data: {}s, "
+                                            "network: {}s, storing: {}s".format(
+        round(batch_generator.preparation_time, 2), round(timings["waiting_for_data_time"], 2),
+        round(timings["network_time"], 2), round(timings["storing_time"], 2)))
+
+    if accumulator is not None:
+        layers_seg = accumulator
+    else:
+        layers_seg = _finalize_data(layers_seg)
     if not only_prediction:
         layers_y = _finalize_data(layers_y)
     return layers_seg, layers_y
@@ -5,9 +5,11 @@ from __future__ import print_function
 
 import warnings
 import importlib
+import copy
 import time
 import os
 from os.path import join
+from collections import OrderedDict
 import numpy as np
 
 from tractseg.libs.system_config import SystemConfig as C
@@ -27,55 +29,13 @@ warnings.simplefilter("ignore", UserWarning)    #hide scipy warnings
 warnings.simplefilter("ignore", FutureWarning)    #hide h5py warnings
 
 
-def run_tractseg(data, output_type="tract_segmentation",
-                 single_orientation=False, dropout_sampling=False, threshold=0.5,
-                 bundle_specific_postprocessing=True, get_probs=False, peak_threshold=0.1,
-                 postprocess=False, peak_regression_part="All", input_type="peaks",
-                 blob_size_thr=50, nr_cpus=-1, verbose=False, manual_exp_name=None,
-                 inference_batch_size=1, tract_definition="TractQuerier+", bedpostX_input=False,
-                 tract_segmentations_path=None, TOM_dilation=1, unit_test=False):
+def _get_config(output_type, dropout_sampling=False, threshold=0.5, bundle_specific_postprocessing=True,
+                get_probs=False, input_type="peaks", nr_cpus=-1, verbose=False, manual_exp_name=None,
+                tract_definition="TractQuerier+", inference_memory_fraction=0.5):
     """
-    Run TractSeg
-
-    Args:
-        data: input peaks (4D numpy array with shape [x,y,z,9])
-        output_type: TractSeg can segment not only bundles, but also the end regions of bundles.
-            Moreover it can create Tract Orientation Maps (TOM).
-            'tract_segmentation' [DEFAULT]: Segmentation of bundles (72 bundles).
-            'endings_segmentation': Segmentation of bundle end regions (72 bundles).
-            'TOM': Tract Orientation Maps (20 bundles).
-        single_orientation: Do not run model 3 times along x/y/z orientation with subsequent mean fusion.
-        dropout_sampling: Create uncertainty map by monte carlo dropout (https://arxiv.org/abs/1506.02142)
-        threshold: Threshold for converting probability map to binary map
-        bundle_specific_postprocessing: Set threshold to lower and use hole closing for CA nd FX if incomplete
-        get_probs: Output raw probability map instead of binary map
-        peak_threshold: All peaks shorter than peak_threshold will be set to zero
-        postprocess: Simple postprocessing of segmentations: Remove small blobs and fill holes
-        peak_regression_part: Only relevant for output type 'TOM'. If set to 'All' (default) it will return all
-            72 bundles. If set to 'Part1'-'Part4' it will only run for a subset of the bundles to reduce memory
-            load.
-        input_type: Always set to "peaks"
-        blob_size_thr: If setting postprocess to True, all blobs having a smaller number of voxels than specified in
-            this threshold will be removed.
-        nr_cpus: Number of CPUs to use. -1 means all available CPUs.
-        verbose: Show debugging infos
-        manual_exp_name: Name of experiment if do not want to use pretrained model but your own one
-        inference_batch_size: batch size (higher: a bit faster but needs more RAM)
-        tract_definition: Select which tract definitions to use. 'TractQuerier+' defines tracts mainly by their
-            cortical start and end region. 'xtract' defines tracts mainly by ROIs in white matter.
-        bedpostX_input: Input peaks are generated by bedpostX
-        tract_segmentations_path: path to the bundle_segmentations (only needed for peak regression to remove peaks
-            outside of the segmentation mask)
-        TOM_dilation: Dilation applied to the tract segmentations before using them to mask the TOMs.
-
-    Returns:
-        4D numpy array with the output of tractseg
-        for tract_segmentation:     [x, y, z, nr_of_bundles]
-        for endings_segmentation:   [x, y, z, 2*nr_of_bundles]
-        for TOM:                    [x, y, z, 3*nr_of_bundles]
+    Load the Config for the given output type and set all parameters needed for inference (including the path
+    to the pretrained weights).
     """
-    start_time = time.time()
-
     if manual_exp_name is None:
         config = get_config_name(input_type, output_type, dropout_sampling=dropout_sampling,
                                  tract_definition=tract_definition)
@@ -85,11 +45,6 @@ def run_tractseg(data, output_type="tract_segmentation",
                                                      exp_utils.get_manual_exp_name_peaks(manual_exp_name, "Part1"),
                                                      "Hyperparameters.txt"))
 
-    # Do not do any postprocessing if returning probabilities (because postprocessing only works on binary)
-    if get_probs:
-        bundle_specific_postprocessing = False
-        postprocess = False
-
     Config = exp_utils.get_correct_labels_type(Config)
     Config.VERBOSE = verbose
     Config.TRAIN = False
@@ -100,6 +55,7 @@ def run_tractseg(data, output_type="tract_segmentation",
     Config.DROPOUT_SAMPLING = dropout_sampling
     Config.THRESHOLD = threshold
     Config.NR_CPUS = nr_cpus
+    Config.INFERENCE_MEMORY_FRACTION = inference_memory_fraction
     Config.INPUT_DIM = dataset_specific_utils.get_correct_input_dim(Config)
     Config.RESET_LAST_LAYER = False
 
@@ -139,115 +95,317 @@ def run_tractseg(data, output_type="tract_segmentation",
         print("Hyperparameters:")
         exp_utils.print_Configs(Config)
 
-    data = np.nan_to_num(data)
-
-    #runtime on HCP data: 0.9s
-    data, seg_None, bbox, original_shape = data_utils.crop_to_nonzero(data)
-    # runtime on HCP data: 0.5s
-    data, transformation = data_utils.pad_and_scale_img_to_square_img(data, target_size=Config.INPUT_DIM[0],
-                                                                      nr_cpus=nr_cpus)
-
-    if Config.EXPERIMENT_TYPE == "tract_segmentation" or Config.EXPERIMENT_TYPE == "endings_segmentation" or \
-            Config.EXPERIMENT_TYPE == "dm_regression":
-        print("Loading weights from: {}".format(Config.WEIGHTS_PATH))
-        Config.NR_OF_CLASSES = len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
-        utils.download_pretrained_weights(experiment_type=Config.EXPERIMENT_TYPE,
-                                          dropout_sampling=Config.DROPOUT_SAMPLING,
-                                          tract_definition=tract_definition)
-        model = BaseModel(Config, inference=True)
-        if single_orientation:  # mainly needed for testing because of less RAM requirements
-            data_loder_inference = DataLoaderInference(Config, data=data)
-            if Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS:
-                seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=True,
-                                                 scale_to_world_shape=False, only_prediction=True,
-                                                 batch_size=inference_batch_size, unit_test=unit_test)
+    return Config
+
+
+class TractSegPredictor:
+    """
+    Keeps the models of one or more output types in memory, so that TractSeg can be run for many subjects
+    without rebuilding the models and reloading the weights for every subject.
+
+    Example:
+        predictor = TractSegPredictor(output_types=["tract_segmentation", "endings_segmentation"])
+        for peaks in all_peaks:
+            bundles = predictor.predict(peaks, "tract_segmentation")
+            endings = predictor.predict(peaks, "endings_segmentation")
+    """
+
+    def __init__(self, output_types=("tract_segmentation",),
+                 single_orientation=False, dropout_sampling=False, threshold=0.5,
+                 bundle_specific_postprocessing=True, get_probs=False, peak_threshold=0.1,
+                 postprocess=False, peak_regression_part="All", input_type="peaks",
+                 blob_size_thr=50, nr_cpus=-1, verbose=False, manual_exp_name=None,
+                 inference_batch_size=1, tract_definition="TractQuerier+", bedpostX_input=False,
+                 TOM_dilation=1, unit_test=False, inference_memory_fraction=0.5):
+        """
+        Load the models for all output types. For the meaning of the arguments see run_tractseg().
+
+        Args:
+            output_types: list of output types for which a model will be loaded
+                ('tract_segmentation', 'endings_segmentation', 'TOM' or 'dm_regression').
+            peak_regression_part: Only relevant for output type 'TOM'. Which parts of the TOM model to load
+                ('All' or 'Part1'-'Part4').
+        """
+        if isinstance(output_types, str):
+            output_types = [output_types]
+
+        # Do not do any postprocessing if returning probabilities (because postprocessing only works on binary)
+        if get_probs:
+            bundle_specific_postprocessing = False
+            postprocess = False
+
+        self.output_types = list(output_types)
+        self.single_orientation = single_orientation
+        self.dropout_sampling = dropout_sampling
+        self.bundle_specific_postprocessing = bundle_specific_postprocessing
+        self.peak_threshold = peak_threshold
+        self.postprocess = postprocess
+        self.peak_regression_part = peak_regression_part
+        self.blob_size_thr = blob_size_thr
+        self.nr_cpus = nr_cpus
+        self.manual_exp_name = manual_exp_name
+        self.inference_batch_size = inference_batch_size
+        self.tract_definition = tract_definition
+        self.bedpostX_input = bedpostX_input
+        self.TOM_dilation = TOM_dilation
+        self.unit_test = unit_test
+
+        self.configs = {}
+        self.models = {}
+        for output_type in self.output_types:
+            Config = _get_config(output_type, dropout_sampling=dropout_sampling, threshold=threshold,
+                                 bundle_specific_postprocessing=bundle_specific_postprocessing,
+                                 get_probs=get_probs, input_type=input_type, nr_cpus=nr_cpus,
+                                 verbose=verbose, manual_exp_name=manual_exp_name,
+                                 tract_definition=tract_definition,
+                                 inference_memory_fraction=inference_memory_fraction)
+            self.configs[output_type] = Config
+            self.models[output_type] = self._load_models(Config)
+
+    def _load_models(self, Config):
+        """
+        Returns:
+            OrderedDict with one (Config, model) pair per part. For peak regression every part has its own
+            Config, because the Config of a part contains the classes of this part.
+        """
+        models = OrderedDict()
+
+        if Config.EXPERIMENT_TYPE == "tract_segmentation" or Config.EXPERIMENT_TYPE == "endings_segmentation" or \
+                Config.EXPERIMENT_TYPE == "dm_regression":
+            print("Loading weights from: {}".format(Config.WEIGHTS_PATH))
+            Config.NR_OF_CLASSES = len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
+            utils.download_pretrained_weights(experiment_type=Config.EXPERIMENT_TYPE,
+                                              dropout_sampling=Config.DROPOUT_SAMPLING,
+                                              tract_definition=self.tract_definition)
+            models[Config.CLASSES] = (Config, BaseModel(Config, inference=True))
+
+        elif Config.EXPERIMENT_TYPE == "peak_regression":
+            weights = {
+                "Part1": "pretrained_weights_peak_regression_part1_v2.npz",
+                "Part2": "pretrained_weights_peak_regression_part2_v2.npz",
+                "Part3": "pretrained_weights_peak_regression_part3_v2.npz",
+                "Part4": "pretrained_weights_peak_regression_part4_v2.npz",
+            }
+            if self.peak_regression_part == "All":
+                parts = ["Part1", "Part2", "Part3", "Part4"]
             else:
-                seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=False,
+                parts = [self.peak_regression_part]
+
+            for part in parts:
+                Config_part = copy.copy(Config)
+                if self.manual_exp_name is not None:
+                    manual_exp_name_peaks = exp_utils.get_manual_exp_name_peaks(self.manual_exp_name, part)
+                    Config_part.WEIGHTS_PATH = exp_utils.get_best_weights_path(
+                        join(C.EXP_PATH, manual_exp_name_peaks), True)
+                else:
+                    Config_part.WEIGHTS_PATH = join(C.TRACT_SEG_HOME, weights[part])
+                print("Loading weights from: {}".format(Config_part.WEIGHTS_PATH))
+                Config_part.CLASSES = "All_" + part
+                Config_part.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config_part.CLASSES)[1:])
+                utils.download_pretrained_weights(experiment_type=Config_part.EXPERIMENT_TYPE,
+                                                  dropout_sampling=Config_part.DROPOUT_SAMPLING, part=part,
+                                                  tract_definition=self.tract_definition)
+                models[part] = (Config_part, BaseModel(Config_part, inference=True))
+
+        return models
+
+    def predict(self, data, output_type=None, tract_segmentations_path=None, peak_regression_part=None):
+        """
+        Run TractSeg on one subject using the models which are already loaded.
+
+        Args:
+            data: input peaks (4D numpy array with shape [x,y,z,9])
+            output_type: one of the output types the predictor was created with. Can be None if the predictor
+                was only created for one output type.
+            tract_segmentations_path: path to the bundle_segmentations of this subject (only needed for TOM)
+            peak_regression_part: Only relevant for output type 'TOM'. Run only one of the loaded parts
+                ('Part1'-'Part4'). If None all loaded parts are run.
+
+        Returns:
+            4D numpy array with the output of tractseg (see run_tractseg())
+        """
+        start_time = time.time()
+
+        if output_type is None:
+            if len(self.output_types) > 1:
+                raise ValueError("output_type has to be set if predictor was created for several output types")
+            output_type = self.output_types[0]
+        if output_type not in self.models:
+            raise ValueError("No model loaded for output type {}".format(output_type))
+
+        Config = self.configs[output_type]
+        models = self.models[output_type]
+
+        data = np.nan_to_num(data)
+
+        # runtime on HCP data: 0.2s (crop_to_nonzero + pad_and_scale_img_to_square_img: 2.1s)
+        data, bbox, original_shape, transformation = \
+            data_utils.crop_pad_and_scale_img_to_square_img(data, target_size=Config.INPUT_DIM[0])
+
+        if Config.EXPERIMENT_TYPE == "tract_segmentation" or Config.EXPERIMENT_TYPE == "endings_segmentation" or \
+                Config.EXPERIMENT_TYPE == "dm_regression":
+            Config, model = models[Config.CLASSES]
+            if self.single_orientation:  # mainly needed for testing because of less RAM requirements
+                data_loder_inference = DataLoaderInference(Config, data=data)
+                if Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS:
+                    seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=True,
+                                                 scale_to_world_shape=False, only_prediction=True,
+                                                 batch_size=self.inference_batch_size, unit_test=self.unit_test)
+                else:
+                    seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=False,
                                                  scale_to_world_shape=False, only_prediction=True,
-                                                 batch_size=inference_batch_size)
-        else:
-            seg_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config, model, data=data,
-                                                                           scale_to_world_shape=False,
-                                                                           only_prediction=True,
-                                                                           batch_size=inference_batch_size)
-            if Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS:
-                seg = direction_merger.mean_fusion(Config.THRESHOLD, seg_xyz, probs=True)
+                                                 batch_size=self.inference_batch_size)
             else:
-                seg = direction_merger.mean_fusion(Config.THRESHOLD, seg_xyz, probs=False)
-
-    elif Config.EXPERIMENT_TYPE == "peak_regression":
-        weights = {
-            "Part1": "pretrained_weights_peak_regression_part1_v2.npz",
-            "Part2": "pretrained_weights_peak_regression_part2_v2.npz",
-            "Part3": "pretrained_weights_peak_regression_part3_v2.npz",
-            "Part4": "pretrained_weights_peak_regression_part4_v2.npz",
-        }
-        if peak_regression_part == "All":
-            parts = ["Part1", "Part2", "Part3", "Part4"]
-            seg_all = np.zeros((data.shape[0], data.shape[1], data.shape[2], Config.NR_OF_CLASSES * 3))
-        else:
-            parts = [peak_regression_part]
-            Config.CLASSES = "All_" + peak_regression_part
-            Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
-
-        for idx, part in enumerate(parts):
-            if manual_exp_name is not None:
-                manual_exp_name_peaks = exp_utils.get_manual_exp_name_peaks(manual_exp_name, part)
-                Config.WEIGHTS_PATH = exp_utils.get_best_weights_path(
-                    join(C.EXP_PATH, manual_exp_name_peaks), True)
+                # Fuse directions while predicting (only one image in memory instead of 4)
+                if Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS:
+                    seg, _ = direction_merger.get_seg_single_img_3_directions_fused(
+                        Config, model, data=data, only_prediction=True, batch_size=self.inference_batch_size,
+                        fusion="mean", probs=True)
+                else:
+                    seg, _ = direction_merger.get_seg_single_img_3_directions_fused(
+                        Config, model, data=data, only_prediction=True, batch_size=self.inference_batch_size,
+                        fusion="mean", probs=False)
+            classes = Config.CLASSES
+
+        elif Config.EXPERIMENT_TYPE == "peak_regression":
+            if peak_regression_part is None:
+                parts = list(models.keys())
+            elif peak_regression_part in models:
+                parts = [peak_regression_part]
             else:
-                Config.WEIGHTS_PATH = join(C.TRACT_SEG_HOME, weights[part])
-            print("Loading weights from: {}".format(Config.WEIGHTS_PATH))
-            Config.CLASSES = "All_" + part
-            Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
-            utils.download_pretrained_weights(experiment_type=Config.EXPERIMENT_TYPE,
-                                              dropout_sampling=Config.DROPOUT_SAMPLING, part=part,
-                                              tract_definition=tract_definition)
-            model = BaseModel(Config, inference=True)
+                raise ValueError("No model loaded for peak_regression_part {}".format(peak_regression_part))
 
-            if single_orientation:
-                data_loder_inference = DataLoaderInference(Config, data=data)
-                seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=True,
+            if len(parts) > 1:
+                seg_all = np.zeros((data.shape[0], data.shape[1], data.shape[2], Config.NR_OF_CLASSES * 3))
+
+            for idx, part in enumerate(parts):
+                Config_part, model = models[part]
+
+                if self.single_orientation:
+                    data_loder_inference = DataLoaderInference(Config_part, data=data)
+                    seg, _ = trainer.predict_img(Config_part, model, data_loder_inference, probs=True,
                                                  scale_to_world_shape=False, only_prediction=True,
-                                                 batch_size=inference_batch_size)
+                                                 batch_size=self.inference_batch_size)
+                else:
+                    # 3 dir for Peaks -> bad results
+                    seg_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config_part, model, data=data,
+                                                                                   scale_to_world_shape=False,
+                                                                                   only_prediction=True,
+                                                                                   batch_size=self.inference_batch_size)
+                    seg = direction_merger.mean_fusion_peaks(seg_xyz, nr_cpus=self.nr_cpus)
+
+                if len(parts) > 1:
+                    nr_part = Config_part.NR_OF_CLASSES
+                    seg_all[:, :, :, (idx*nr_part) : (idx*nr_part+nr_part)] = seg
+
+            if len(parts) > 1:
+                classes = "All"
+                seg = seg_all
             else:
-                # 3 dir for Peaks -> bad results
-                seg_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config, model, data=data,
-                                                                                  scale_to_world_shape=False,
-                                                                                  only_prediction=True,
-                                                                                  batch_size=inference_batch_size)
-                seg = direction_merger.mean_fusion_peaks(seg_xyz, nr_cpus=nr_cpus)
-
-            if peak_regression_part == "All":
-                seg_all[:, :, :, (idx*Config.NR_OF_CLASSES) : (idx*Config.NR_OF_CLASSES+Config.NR_OF_CLASSES)] = seg
-
-        if peak_regression_part == "All":
-            Config.CLASSES = "All"
-            Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
-            seg = seg_all
-
-
-    if Config.EXPERIMENT_TYPE == "tract_segmentation" and bundle_specific_postprocessing and not dropout_sampling:
-        # Runtime ~4s
-        seg = img_utils.bundle_specific_postprocessing(seg, dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
-
-    # runtime on HCP data: 5.1s
-    seg = data_utils.cut_and_scale_img_back_to_original_img(seg, transformation, nr_cpus=nr_cpus)
-    # runtime on HCP data: 1.6s
-    seg = data_utils.add_original_zero_padding_again(seg, bbox, original_shape, Config.NR_OF_CLASSES)
-
-    if Config.EXPERIMENT_TYPE == "peak_regression":
-        seg = peak_utils.mask_and_normalize_peaks(seg, tract_segmentations_path,
-                                                  dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:],
-                                                  TOM_dilation, nr_cpus=nr_cpus)
-
-    if Config.EXPERIMENT_TYPE == "tract_segmentation" and postprocess and not dropout_sampling:
-        # Runtime ~7s for 1.25mm resolution
-        # Runtime ~1.5s for  2mm resolution
-        st = time.time()
-        seg = img_utils.postprocess_segmentations(seg, dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:],
-                                                  blob_thr=blob_size_thr, hole_closing=None)
-
-    exp_utils.print_verbose(Config.VERBOSE, "Took {}s".format(round(time.time() - start_time, 2)))
-    return seg
+                classes = models[parts[0]][0].CLASSES
+
+        bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
+
+        if Config.EXPERIMENT_TYPE == "tract_segmentation" and self.bundle_specific_postprocessing and \
+                not self.dropout_sampling:
+            # Runtime ~4s
+            seg = img_utils.bundle_specific_postprocessing(seg, bundles)
+
+        # Binary segmentations do not need more than uint8
+        binary = Config.EXPERIMENT_TYPE in ["tract_segmentation", "endings_segmentation"] and \
+            not (Config.DROPOUT_SAMPLING or Config.GET_PROBS)
+        # runtime on HCP data: 0.6s (cut_and_scale_img_back_to_original_img + add_original_zero_padding_again: 12.9s)
+        seg = data_utils.cut_scale_and_pad_img_back_to_original_img(seg, transformation, bbox, original_shape,
+                                                                    dtype=np.uint8 if binary else None)
+
+        if Config.EXPERIMENT_TYPE == "peak_regression":
+            seg = peak_utils.mask_and_normalize_peaks(seg, tract_segmentations_path, bundles,
+                                                      self.TOM_dilation, nr_cpus=self.nr_cpus)
+
+        if Config.EXPERIMENT_TYPE == "tract_segmentation" and self.postprocess and not self.dropout_sampling:
+            # Runtime ~7s for 1.25mm resolution
+            # Runtime ~1.5s for  2mm resolution
+            seg = img_utils.postprocess_segmentations(seg, bundles, blob_thr=self.blob_size_thr, hole_closing=None,
+                                                      nr_cpus=self.nr_cpus)
+
+        exp_utils.print_verbose(Config.VERBOSE, "Took {}s".format(round(time.time() - start_time, 2)))
+        return seg
+
+    def predict_subjects(self, subjects_data, output_type=None, tract_segmentations_paths=None):
+        """
+        Run TractSeg on several subjects one after another.
+
+        Args:
+            subjects_data: list or iterator of input peaks (4D numpy arrays with shape [x,y,z,9])
+            output_type: see predict()
+            tract_segmentations_paths: list with one path to the bundle_segmentations per subject
+                (only needed for TOM)
+
+        Returns:
+            generator yielding the output of tractseg for each subject
+        """
+        for idx, data in enumerate(subjects_data):
+            tract_segmentations_path = None if tract_segmentations_paths is None else tract_segmentations_paths[idx]
+            yield self.predict(data, output_type=output_type, tract_segmentations_path=tract_segmentations_path)
+
+
+def run_tractseg(data, output_type="tract_segmentation",
+                 single_orientation=False, dropout_sampling=False, threshold=0.5,
+                 bundle_specific_postprocessing=True, get_probs=False, peak_threshold=0.1,
+                 postprocess=False, peak_regression_part="All", input_type="peaks",
+                 blob_size_thr=50, nr_cpus=-1, verbose=False, manual_exp_name=None,
+                 inference_batch_size=1, tract_definition="TractQuerier+", bedpostX_input=False,
+                 tract_segmentations_path=None, TOM_dilation=1, unit_test=False, inference_memory_fraction=0.5):
+    """
+    Run TractSeg
+
+    Args:
+        data: input peaks (4D numpy array with shape [x,y,z,9])
+        output_type: TractSeg can segment not only bundles, but also the end regions of bundles.
+            Moreover it can create Tract Orientation Maps (TOM).
+            'tract_segmentation' [DEFAULT]: Segmentation of bundles (72 bundles).
+            'endings_segmentation': Segmentation of bundle end regions (72 bundles).
+            'TOM': Tract Orientation Maps (20 bundles).
+        single_orientation: Do not run model 3 times along x/y/z orientation with subsequent mean fusion.
+        dropout_sampling: Create uncertainty map by monte carlo dropout (https://arxiv.org/abs/1506.02142)
+        threshold: Threshold for converting probability map to binary map
+        bundle_specific_postprocessing: Set threshold to lower and use hole closing for CA nd FX if incomplete
+        get_probs: Output raw probability map instead of binary map
+        peak_threshold: All peaks shorter than peak_threshold will be set to zero
+        postprocess: Simple postprocessing of segmentations: Remove small blobs and fill holes
+        peak_regression_part: Only relevant for output type 'TOM'. If set to 'All' (default) it will return all
+            72 bundles. If set to 'Part1'-'Part4' it will only run for a subset of the bundles to reduce memory
+            load.
+        input_type: Always set to "peaks"
+        blob_size_thr: If setting postprocess to True, all blobs having a smaller number of voxels than specified in
+            this threshold will be removed.
+        nr_cpus: Number of CPUs to use. -1 means all available CPUs.
+        verbose: Show debugging infos
+        manual_exp_name: Name of experiment if do not want to use pretrained model but your own one
+        inference_batch_size: batch size (higher: a bit faster but needs more RAM). If "auto" the largest batch
+            size fitting into inference_memory_fraction of the free memory is selected.
+        tract_definition: Select which tract definitions to use. 'TractQuerier+' defines tracts mainly by their
+            cortical start and end region. 'xtract' defines tracts mainly by ROIs in white matter.
+        bedpostX_input: Input peaks are generated by bedpostX
+        tract_segmentations_path: path to the bundle_segmentations (only needed for peak regression to remove peaks
+            outside of the segmentation mask)
+        TOM_dilation: Dilation applied to the tract segmentations before using them to mask the TOMs.
+        inference_memory_fraction: Fraction of the free memory which can be used if inference_batch_size is "auto".
 
+    Returns:
+        4D numpy array with the output of tractseg
+        for tract_segmentation:     [x, y, z, nr_of_bundles]
+        for endings_segmentation:   [x, y, z, 2*nr_of_bundles]
+        for TOM:                    [x, y, z, 3*nr_of_bundles]
+    """
+    predictor = TractSegPredictor(output_types=[output_type], single_orientation=single_orientation,
+                                  dropout_sampling=dropout_sampling, threshold=threshold,
+                                  bundle_specific_postprocessing=bundle_specific_postprocessing,
+                                  get_probs=get_probs, peak_threshold=peak_threshold, postprocess=postprocess,
+                                  peak_regression_part=peak_regression_part, input_type=input_type,
+                                  blob_size_thr=blob_size_thr, nr_cpus=nr_cpus, verbose=verbose,
+                                  manual_exp_name=manual_exp_name, inference_batch_size=inference_batch_size,
+                                  tract_definition=tract_definition, bedpostX_input=bedpostX_input,
+                                  TOM_dilation=TOM_dilation, unit_test=unit_test,
+                                  inference_memory_fraction=inference_memory_fraction)
+    return predictor.predict(data, tract_segmentations_path=tract_segmentations_path)